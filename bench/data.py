@@ -0,0 +1,170 @@
+# Copyright (c) 2014-2016, Clemson University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of Clemson University nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+'''
+Synthetic users and keys for benchmarking.
+
+Keys are random blobs laid out like real OpenSSH public keys, which is all
+django-sshkey ever looks at, so millions of them can be made quickly and
+reproducibly from a seed.
+'''
+
+import base64
+import os
+import random
+import struct
+
+# (algorithm, weight)
+KEY_TYPES = (
+  ('ssh-rsa', 50),
+  ('ssh-ed25519', 30),
+  ('ecdsa-sha2-nistp256', 15),
+  ('ssh-dss', 5),
+)
+
+
+def ssh_string(data):
+  return struct.pack('>I', len(data)) + data
+
+
+def random_bytes(rng, n):
+  return bytes(bytearray(rng.getrandbits(8) for i in range(n)))
+
+
+def mpint(rng, bits):
+  # A leading zero byte keeps the top bit from making it negative.
+  data = bytearray(random_bytes(rng, bits // 8))
+  data[0] |= 0x80
+  return ssh_string(b'\x00' + bytes(data))
+
+
+def random_keydata(rng, algorithm):
+  blob = ssh_string(algorithm.encode('ascii'))
+  if algorithm == 'ssh-rsa':
+    blob += ssh_string(b'\x01\x00\x01') + mpint(rng, 2048)
+  elif algorithm == 'ssh-ed25519':
+    blob += ssh_string(random_bytes(rng, 32))
+  elif algorithm == 'ecdsa-sha2-nistp256':
+    blob += ssh_string(b'nistp256')
+    blob += ssh_string(b'\x04' + random_bytes(rng, 64))
+  elif algorithm == 'ssh-dss':
+    for bits in (1024, 160, 1024, 1024):
+      blob += mpint(rng, bits)
+  else:
+    raise ValueError('Unknown key type: %s' % algorithm)
+  return blob
+
+
+def random_algorithm(rng):
+  n = rng.randrange(sum(weight for algorithm, weight in KEY_TYPES))
+  for algorithm, weight in KEY_TYPES:
+    if n < weight:
+      return algorithm
+    n -= weight
+
+
+def random_key(rng, comment=None):
+  '''Return a random public key in OpenSSH format.'''
+  algorithm = random_algorithm(rng)
+  b64key = base64.b64encode(random_keydata(rng, algorithm)).decode('ascii')
+  key = algorithm + ' ' + b64key
+  if comment:
+    key += ' ' + comment
+  return key
+
+
+def setup(database):
+  '''Set up Django with bench.settings and the given SQLite database'''
+  os.environ['SSHKEY_BENCH_DATABASE'] = database
+  os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'bench.settings')
+  import django
+  from django.core.management import call_command
+  django.setup()
+  call_command('migrate', verbosity=0, interactive=False)
+
+
+def random_keys(n, seed=0):
+  rng = random.Random(seed)
+  return [random_key(rng, 'key%d' % i) for i in range(n)]
+
+
+def key_rng(seed, i):
+  # One generator per key, so that the first n keys are the same however
+  # the database was grown to n.
+  return random.Random(seed << 32 | i)
+
+
+def populate(n_keys, keys_per_user=4, seed=0, batch_size=1000):
+  '''
+  Grow the database to n_keys keys, spread over users keys_per_user at a
+  time.
+
+  Rows are bulk inserted, so no signals are sent (and hence no email), and
+  their authorized_keys lines are rendered afterwards.  Returns the number
+  of keys added.
+  '''
+  from django.contrib.auth.models import User
+  from django.db import transaction
+  from django_sshkey.models import (
+    UserKey,
+    rebuild_authorized_keys_lines,
+    set_key_metadata,
+  )
+  from django_sshkey.util import pubkey_parse
+  start = UserKey.objects.count()
+  if start >= n_keys:
+    return 0
+  ids = UserKey.objects.values_list('id', flat=True)
+  last_id = ids.order_by('-id').first()
+  with transaction.atomic():
+    n_users = User.objects.count()
+    needed = (n_keys + keys_per_user - 1) // keys_per_user
+    for i in range(n_users, needed, batch_size):
+      User.objects.bulk_create([
+        User(username='user%d' % j)
+        for j in range(i, min(i + batch_size, needed))
+      ])
+    user_ids = dict(User.objects.values_list('username', 'id'))
+    batch = []
+    for i in range(start, n_keys):
+      pubkey = pubkey_parse(random_key(key_rng(seed, i), 'key%d' % i))
+      key = UserKey(
+        user_id=user_ids['user%d' % (i // keys_per_user)],
+        name=pubkey.comment,
+        key=pubkey.format_openssh(),
+        fingerprint=pubkey.fingerprint(),
+      )
+      set_key_metadata(key, pubkey)
+      batch.append(key)
+      if len(batch) == batch_size:
+        UserKey.objects.bulk_create(batch)
+        batch = []
+    UserKey.objects.bulk_create(batch)
+    rebuild_authorized_keys_lines(UserKey.objects.filter(id__gt=last_id or 0))
+  return n_keys - start
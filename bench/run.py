@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# Copyright (c) 2014-2016, Clemson University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of Clemson University nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+'''
+Time key parsing, fingerprinting, exporting and lookups.
+
+Results are written as JSON.  Given a baseline from an earlier run, each
+result is compared with it and the exit status is 1 if any got worse by
+more than the tolerance.
+'''
+
+from __future__ import print_function
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench import data  # noqa: E402
+
+clock = timeit.default_timer
+
+
+def throughput(func, items, repeat):
+  '''Best of repeat passes of func over items, in calls per second.'''
+  best = None
+  for i in range(repeat):
+    start = clock()
+    for item in items:
+      func(item)
+    elapsed = clock() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return {
+    'value': len(items) / best,
+    'unit': 'ops/s',
+    'better': 'higher',
+  }
+
+
+def percentile(values, p):
+  values = sorted(values)
+  return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def latency(func, items):
+  times = []
+  for item in items:
+    start = clock()
+    func(item)
+    times.append(clock() - start)
+  return {
+    'value': percentile(times, 0.5) * 1000,
+    'unit': 'ms',
+    'better': 'lower',
+    'p90': percentile(times, 0.9) * 1000,
+    'p99': percentile(times, 0.99) * 1000,
+    'rps': len(times) / sum(times),
+  }
+
+
+def bench_keys(results, n, repeat):
+  from django_sshkey.util import pubkey_parse
+  keys = [pubkey_parse(key) for key in data.random_keys(n)]
+  rsa_keys = [key for key in keys if key.algorithm == 'ssh-rsa']
+  texts = [
+    ('openssh', [key.format_openssh() for key in keys]),
+    ('rfc4716', [key.format_rfc4716() for key in keys]),
+    ('pem', [key.format_pem() for key in rsa_keys]),
+  ]
+  for format, items in texts:
+    results['parse.' + format] = throughput(pubkey_parse, items, repeat)
+  for hash in ('legacy', 'md5', 'sha256'):
+    results['fingerprint.' + hash] = throughput(
+      lambda key: key.fingerprint(hash), keys, repeat)
+  results['export.rfc4716'] = throughput(
+    lambda key: key.format_rfc4716(), keys, repeat)
+  results['export.pem'] = throughput(
+    lambda key: key.format_pem(), rsa_keys, repeat)
+
+
+def get(view, query):
+  from django.test import RequestFactory
+  response = view(RequestFactory().get('/sshkey/lookup', query))
+  if response.streaming:
+    return b''.join(response.streaming_content)
+  return response.content
+
+
+def bench_lookup(results, size, requests, repeat, seed):
+  from django_sshkey.models import UserKey
+  from django_sshkey.views import lookup
+  rng = random.Random(seed)
+  ids = [rng.randint(1, size) for i in range(requests)]
+  fingerprints = dict(
+    UserKey.objects.filter(id__in=ids).values_list('id', 'fingerprint'))
+  fingerprints = [fingerprints[i] for i in ids if i in fingerprints]
+  n_users = (size + 3) // 4
+  usernames = ['user%d' % rng.randrange(n_users) for i in range(requests)]
+  suffix = '.%d' % size
+  results['lookup.fingerprint' + suffix] = latency(
+    lambda fp: get(lookup, {'fingerprint': fp}), fingerprints)
+  results['lookup.username' + suffix] = latency(
+    lambda username: get(lookup, {'username': username}), usernames)
+  result = latency(lambda query: get(lookup, query), [{}] * repeat)
+  result['keys_per_second'] = size * result['rps']
+  results['lookup.all' + suffix] = result
+
+
+def compare(results, baseline, tolerance):
+  '''Print how results compare with baseline; return the regressions.'''
+  regressions = []
+  for name in sorted(results):
+    if name not in baseline:
+      continue
+    new = results[name]['value']
+    old = baseline[name]['value']
+    if new == old:
+      change = 0.0
+    elif results[name]['better'] == 'higher':
+      change = new / old - 1 if old else float('inf')
+    else:
+      change = old / new - 1 if new else float('inf')
+    status = ''
+    if change < -tolerance:
+      status = 'REGRESSION'
+      regressions.append(name)
+    print('%-28s %12.3f %12.3f %-6s %+7.1f%% %s' % (
+      name, old, new, results[name]['unit'], change * 100, status),
+      file=sys.stderr)
+  return regressions
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__.strip())
+  parser.add_argument(
+    '-s', '--sizes', default='10000',
+    help='comma separated numbers of keys to time lookups at '
+         '(default 10000; e.g. 10000,100000,1000000)')
+  parser.add_argument(
+    '-d', '--database',
+    help='SQLite database to use; it is grown as needed and kept, so it '
+         'can be reused (default: a temporary file)')
+  parser.add_argument(
+    '-k', '--keys', type=int, default=2000,
+    help='keys to parse, fingerprint and export (default 2000)')
+  parser.add_argument(
+    '-r', '--requests', type=int, default=1000,
+    help='lookups by fingerprint and by username per size (default 1000)')
+  parser.add_argument(
+    '-n', '--repeat', type=int, default=3,
+    help='passes over the keys, and full lookups per size (default 3)')
+  parser.add_argument(
+    '--seed', type=int, default=0, help='random seed (default 0)')
+  parser.add_argument(
+    '-o', '--output', help='write results here instead of stdout')
+  parser.add_argument(
+    '-b', '--baseline', help='results of an earlier run to compare with')
+  parser.add_argument(
+    '-t', '--tolerance', type=float, default=0.2,
+    help='fraction by which a result may be worse than the baseline '
+         '(default 0.2)')
+  args = parser.parse_args(argv)
+  sizes = sorted(int(size) for size in args.sizes.split(','))
+
+  temporary = args.database is None
+  if temporary:
+    fd, args.database = tempfile.mkstemp(prefix='sshkey-bench.',
+                                         suffix='.sqlite3')
+    os.close(fd)
+  import django
+  try:
+    data.setup(args.database)
+    results = {}
+    bench_keys(results, args.keys, args.repeat)
+    for size in sizes:
+      data.populate(size, seed=args.seed)
+      bench_lookup(results, size, args.requests, args.repeat, args.seed)
+  finally:
+    if temporary:
+      os.unlink(args.database)
+
+  output = {
+    'meta': {
+      'python': platform.python_version(),
+      'django': django.get_version(),
+      'platform': platform.platform(),
+      'seed': args.seed,
+      'keys': args.keys,
+      'sizes': sizes,
+    },
+    'results': results,
+  }
+  text = json.dumps(output, indent=2, sort_keys=True,
+                    separators=(',', ': ')) + '\n'
+  if args.output:
+    with open(args.output, 'w') as f:
+      f.write(text)
+  else:
+    sys.stdout.write(text)
+  if args.baseline:
+    with open(args.baseline) as f:
+      baseline = json.load(f)['results']
+    if compare(results, baseline, args.tolerance):
+      return 1
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
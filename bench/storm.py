@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+# Copyright (c) 2014-2016, Clemson University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of Clemson University nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+'''
+Simulate a login storm: many sshd processes running their
+AuthorizedKeysCommand against the lookup view at once.
+
+Each request runs one of the real lookup clients as a new process, as sshd
+does, and checks its output.  Unless --url is given, the test project is
+served locally with runserver against a database of synthetic keys.
+'''
+
+from __future__ import print_function
+import argparse
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+try:
+  from queue import Queue
+  from urllib.request import urlopen
+except ImportError:  # Python 2
+  from Queue import Queue
+  from urllib2 import urlopen
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench import data  # noqa: E402
+from bench.run import clock, compare, percentile  # noqa: E402
+
+OPERATIONS = ('fingerprint', 'username', 'miss', 'touch')
+PYLOOKUP = 'from django_sshkey.util import lookup_main; lookup_main()'
+
+
+def parse_mix(text):
+  '''Parse "fingerprint=60,username=20,..." into [(operation, weight)]'''
+  mix = []
+  for item in text.split(','):
+    operation, weight = item.split('=')
+    if operation not in OPERATIONS:
+      raise argparse.ArgumentTypeError('unknown operation: %s' % operation)
+    mix.append((operation, int(weight)))
+  return mix
+
+
+def lookup_command(client, mode, url, value):
+  if client == 'shell':
+    return [os.path.join(ROOT, 'lookup.sh'), mode, url, value]
+  return [sys.executable, '-c', PYLOOKUP, mode, url, value]
+
+
+class Storm(object):
+  def __init__(self, url, client, keys, usernames, seed):
+    self.url = url
+    self.client = client
+    self.keys = keys
+    self.usernames = usernames
+    self.rng = random.Random(seed)
+    self.env = dict(os.environ)
+    self.env['PYTHONPATH'] = ROOT
+    self.lock = threading.Lock()
+    self.times = dict((operation, []) for operation in OPERATIONS)
+    self.errors = dict((operation, 0) for operation in OPERATIONS)
+
+  def task(self, operation):
+    '''Return the command for operation and a check of its output'''
+    with self.lock:
+      key_id, fingerprint = self.rng.choice(self.keys)
+      username = self.rng.choice(self.usernames)
+      missing = '%032x' % self.rng.getrandbits(128)
+    if operation == 'fingerprint':
+      command = lookup_command(self.client, '-f', self.url, fingerprint)
+      return command, lambda out: out.count(b'\n') == 1
+    if operation == 'username':
+      command = lookup_command(self.client, '-u', self.url, username)
+      return command, lambda out: out.count(b'\n') >= 1
+    if operation == 'miss':
+      missing = ':'.join(a + b for a, b in zip(missing[::2], missing[1::2]))
+      command = lookup_command(self.client, '-f', self.url, missing)
+      return command, lambda out: out == b''
+    # The command forced by SSHKEY_AUTHORIZED_KEYS_OPTIONS would do this.
+    command = ['curl', '-s', '-f', '-d', str(key_id), self.url]
+    return command, lambda out: bool(out)
+
+  def run(self, operation):
+    command, check = self.task(operation)
+    start = clock()
+    process = subprocess.Popen(command, env=self.env, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    out, err = process.communicate()
+    elapsed = clock() - start
+    ok = process.returncode == 0 and check(out)
+    with self.lock:
+      self.times[operation].append(elapsed)
+      if not ok:
+        self.errors[operation] += 1
+
+  def storm(self, mix, requests, concurrency):
+    '''Run requests operations from mix, concurrency at a time'''
+    population = []
+    for operation, weight in mix:
+      population += [operation] * weight
+    work = Queue()
+    for i in range(requests):
+      work.put(self.rng.choice(population))
+
+    def worker():
+      while True:
+        operation = work.get()
+        if operation is None:
+          return
+        self.run(operation)
+
+    threads = [threading.Thread(target=worker) for i in range(concurrency)]
+    for thread in threads:
+      work.put(None)
+    start = clock()
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    return clock() - start
+
+  def results(self, elapsed):
+    results = {}
+    total = 0
+    errors = 0
+    for operation in OPERATIONS:
+      times = self.times[operation]
+      if not times:
+        continue
+      total += len(times)
+      errors += self.errors[operation]
+      results['storm.' + operation] = {
+        'value': percentile(times, 0.5) * 1000,
+        'unit': 'ms',
+        'better': 'lower',
+        'p90': percentile(times, 0.9) * 1000,
+        'p99': percentile(times, 0.99) * 1000,
+        'max': max(times) * 1000,
+        'requests': len(times),
+        'errors': self.errors[operation],
+      }
+    results['storm.throughput'] = {
+      'value': total / elapsed,
+      'unit': 'req/s',
+      'better': 'higher',
+    }
+    results['storm.error_rate'] = {
+      'value': float(errors) / total,
+      'unit': 'ratio',
+      'better': 'lower',
+    }
+    return results
+
+
+def free_port():
+  sock = socket.socket()
+  sock.bind(('127.0.0.1', 0))
+  port = sock.getsockname()[1]
+  sock.close()
+  return port
+
+
+def start_server(database, port):
+  env = dict(os.environ)
+  env['DJANGO_SETTINGS_MODULE'] = 'bench.settings'
+  env['SSHKEY_BENCH_DATABASE'] = database
+  env['PYTHONPATH'] = ROOT
+  with open(os.devnull, 'w') as devnull:
+    server = subprocess.Popen(
+      [sys.executable, os.path.join(ROOT, 'manage.py'), 'runserver',
+       '--noreload', '127.0.0.1:%d' % port],
+      env=env, stdout=devnull, stderr=devnull)
+  url = 'http://127.0.0.1:%d/lookup' % port
+  for i in range(100):
+    try:
+      urlopen(url + '?fingerprint=').read()
+      return server, url
+    except IOError:
+      time.sleep(0.1)
+  server.terminate()
+  raise RuntimeError('runserver did not start')
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__.strip())
+  parser.add_argument(
+    '-c', '--concurrency', type=int, default=100,
+    help='lookups running at once (default 100)')
+  parser.add_argument(
+    '-r', '--requests', type=int, default=2000,
+    help='lookups to run in total (default 2000)')
+  parser.add_argument(
+    '-m', '--mix', type=parse_mix,
+    default=parse_mix('fingerprint=60,username=20,miss=15,touch=5'),
+    help='weights of each operation (default '
+         'fingerprint=60,username=20,miss=15,touch=5)')
+  parser.add_argument(
+    '--client', choices=('shell', 'python'), default='shell',
+    help='lookup.sh or django-sshkey-pylookup (default shell)')
+  parser.add_argument(
+    '-s', '--size', type=int, default=10000,
+    help='keys in the database (default 10000)')
+  parser.add_argument(
+    '-d', '--database',
+    help='SQLite database to use; it is grown as needed and kept '
+         '(default: a temporary file)')
+  parser.add_argument(
+    '-u', '--url',
+    help='lookup URL of a running server to use instead of runserver; its '
+         'database must hold the same synthetic keys')
+  parser.add_argument(
+    '--seed', type=int, default=0, help='random seed (default 0)')
+  parser.add_argument(
+    '-o', '--output', help='write results here instead of stdout')
+  parser.add_argument(
+    '-b', '--baseline', help='results of an earlier run to compare with')
+  parser.add_argument(
+    '-t', '--tolerance', type=float, default=0.2,
+    help='fraction by which a result may be worse than the baseline '
+         '(default 0.2)')
+  args = parser.parse_args(argv)
+
+  temporary = args.database is None
+  if temporary:
+    fd, args.database = tempfile.mkstemp(prefix='sshkey-bench.',
+                                         suffix='.sqlite3')
+    os.close(fd)
+  server = None
+  try:
+    data.setup(args.database)
+    data.populate(args.size, seed=args.seed)
+    from django.contrib.auth.models import User
+    from django_sshkey.models import UserKey
+    rng = random.Random(args.seed)
+    ids = [rng.randint(1, args.size) for i in range(1000)]
+    keys = list(
+      UserKey.objects.filter(id__in=ids).values_list('id', 'fingerprint'))
+    usernames = list(User.objects.filter(
+      userkey__id__in=ids).values_list('username', flat=True).distinct())
+    url = args.url
+    if url is None:
+      server, url = start_server(args.database, free_port())
+    storm = Storm(url, args.client, keys, usernames, args.seed)
+    elapsed = storm.storm(args.mix, args.requests, args.concurrency)
+  finally:
+    if server is not None:
+      server.terminate()
+      server.wait()
+    if temporary:
+      os.unlink(args.database)
+
+  import django
+  output = {
+    'meta': {
+      'python': platform.python_version(),
+      'django': django.get_version(),
+      'platform': platform.platform(),
+      'seed': args.seed,
+      'size': args.size,
+      'client': args.client,
+      'concurrency': args.concurrency,
+      'mix': dict(args.mix),
+    },
+    'results': storm.results(elapsed),
+  }
+  text = json.dumps(output, indent=2, sort_keys=True,
+                    separators=(',', ': ')) + '\n'
+  if args.output:
+    with open(args.output, 'w') as f:
+      f.write(text)
+  else:
+    sys.stdout.write(text)
+  for name, result in sorted(output['results'].items()):
+    if 'p99' in result:
+      print('%-18s %6d req %5d err  p50 %8.1f  p90 %8.1f  p99 %8.1f ms' % (
+        name, result['requests'], result['errors'], result['value'],
+        result['p90'], result['p99']), file=sys.stderr)
+  if args.baseline:
+    with open(args.baseline) as f:
+      baseline = json.load(f)['results']
+    if compare(output['results'], baseline, args.tolerance):
+      return 1
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
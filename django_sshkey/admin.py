@@ -28,18 +28,74 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 from django.contrib import admin
-from django_sshkey.models import UserKey
+from django.core.paginator import Paginator
+from django.db import connections
+from django_sshkey import cache as lookup_cache, settings
+from django_sshkey.models import UserKey, normalize_keys, revoke_keys
+from django_sshkey.util import fingerprint_digest
+
+COUNT_CACHE_KEY = 'django_sshkey.admin.count'
+
+
+def estimated_count(queryset):
+  '''
+  Estimate the number of rows in the table of an unfiltered queryset.
+
+  PostgreSQL and MySQL provide estimates from their table statistics.  On
+  other databases the exact count is cached.
+  '''
+  connection = connections[queryset.db]
+  table = queryset.model._meta.db_table
+  if connection.vendor == 'postgresql':
+    sql = 'SELECT reltuples FROM pg_class WHERE relname = %s'
+  elif connection.vendor == 'mysql':
+    sql = (
+      'SELECT table_rows FROM information_schema.tables '
+      'WHERE table_schema = DATABASE() AND table_name = %s'
+    )
+  else:
+    sql = None
+  if sql is not None:
+    cursor = connection.cursor()
+    cursor.execute(sql, [table])
+    row = cursor.fetchone()
+    # Statistics are useless for small or never analyzed tables
+    if row and row[0] and row[0] >= 10000:
+      return int(row[0])
+    return queryset.count()
+  cache = lookup_cache.get_cache()
+  count = cache.get(COUNT_CACHE_KEY)
+  if count is None:
+    count = queryset.count()
+    cache.set(COUNT_CACHE_KEY, count,
+              settings.SSHKEY_ADMIN_COUNT_CACHE_TIMEOUT)
+  return count
+
+
+class UserKeyPaginator(Paginator):
+  def _get_count(self):
+    if self._count is None:
+      query = getattr(self.object_list, 'query', None)
+      if query is not None and not query.where:
+        self._count = estimated_count(self.object_list)
+      else:
+        self._count = super(UserKeyPaginator, self)._get_count()
+    return self._count
+  count = property(_get_count)
 
 
 def normalize_user_key(modeladmin, request, queryset):
-  for key in queryset:
-    key.full_clean()
-    key.save()
-  count = queryset.count()
+  count = normalize_keys(queryset)
   message = '%d user key(s) normalized' % count
   modeladmin.message_user(request, message)
 
 
+def revoke_user_key(modeladmin, request, queryset):
+  count = revoke_keys(queryset)
+  message = '%d user key(s) revoked' % count
+  modeladmin.message_user(request, message)
+
+
 class UserKeyAdmin(admin.ModelAdmin):
   list_display = [
     '__unicode__',
@@ -49,18 +105,41 @@ class UserKeyAdmin(admin.ModelAdmin):
     'created',
     'last_modified',
     'last_used',
+    'revoked',
+  ]
+  list_select_related = [
+    'user',
   ]
   search_fields = [
     'user__username',
   ]
   readonly_fields = [
     'fingerprint',
+    'algorithm',
+    'bits',
+    'comment',
     'created',
     'last_modified',
     'last_used',
+    'revoked',
+    'owner_active',
   ]
   actions = [
     normalize_user_key,
+    revoke_user_key,
   ]
+  paginator = UserKeyPaginator
+  show_full_result_count = False
+
+  def get_search_results(self, request, queryset, search_term):
+    # Usernames cannot contain colons but fingerprints always do.  Searching
+    # only the fingerprint lets the database use its index.
+    term = search_term.strip()
+    if ':' in term and len(term.split()) == 1:
+      if len(fingerprint_digest(term)) in (32, 43):
+        return queryset.filter(fingerprint=term), False
+      return queryset.filter(fingerprint__startswith=term), False
+    return super(UserKeyAdmin, self).get_search_results(
+      request, queryset, search_term)
 
 admin.site.register(UserKey, UserKeyAdmin)
@@ -0,0 +1,133 @@
+# Copyright (c) 2014-2016, Clemson University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of Clemson University nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+'''
+Admission control for lookups.
+
+SSHKEY_LOOKUP_CONCURRENCY limits how many lookups of each mode (as named
+by metrics.lookup_mode) may query the database at once in a process.  A
+lookup over its limit is answered from the stale copy kept in the lookup
+cache when there is one, and with a 503 otherwise, rather than waiting.
+'''
+
+import threading
+from django.http import HttpResponse
+from django_sshkey import audit, cache as lookup_cache, metrics, settings
+from django_sshkey.util import compress
+
+_lock = threading.Lock()
+_active = {}
+
+
+class Overloaded(Exception):
+  '''Raised when a lookup mode is at its concurrency limit'''
+
+
+class Slot(object):
+  '''A lookup's claim on its mode's concurrency, released once'''
+
+  def __init__(self, mode):
+    self.mode = mode
+    self.released = False
+
+  def release(self):
+    with _lock:
+      if not self.released:
+        self.released = True
+        _active[self.mode] -= 1
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.release()
+
+
+class HeldStream(object):
+  '''
+  Wrap streaming content and release a slot once it has been sent.
+
+  The response closes this when it is closed, so the slot is released even
+  if the client goes away mid-stream.
+  '''
+
+  def __init__(self, chunks, slot):
+    self.chunks = chunks
+    self.slot = slot
+
+  def __iter__(self):
+    for chunk in self.chunks:
+      yield chunk
+    self.close()
+
+  def close(self):
+    self.slot.release()
+
+
+def active(mode):
+  with _lock:
+    return _active.get(mode, 0)
+
+
+def admit(mode):
+  '''Return a Slot for a lookup of the given mode, or raise Overloaded'''
+  limit = settings.SSHKEY_LOOKUP_CONCURRENCY.get(mode)
+  with _lock:
+    count = _active.get(mode, 0)
+    if limit is not None and count >= limit:
+      raise Overloaded(mode)
+    _active[mode] = count + 1
+  return Slot(mode)
+
+
+def shed(mode, query=None, encoding=None, content_type='text/plain'):
+  '''
+  Return the response for a lookup that was not admitted: its stale copy
+  if there is one, or a 503.
+  '''
+  entry = query and lookup_cache.get_stale(query)
+  if entry:
+    metrics.inc('sshkey_lookup_shed_total',
+                (('mode', mode), ('result', 'stale')))
+    if encoding not in entry:
+      body = b''.join(compress([entry[None]], encoding))
+    else:
+      body = entry[encoding]
+    response = HttpResponse(body, content_type=content_type)
+    response.sshkey_served = audit.Served.from_entry(entry)
+    if encoding:
+      response['Content-Encoding'] = encoding
+    response['Warning'] = '110 - "Response is Stale"'
+    return response
+  metrics.inc('sshkey_lookup_shed_total',
+              (('mode', mode), ('result', 'unavailable')))
+  response = HttpResponse('Too many lookups\n', status=503,
+                          content_type='text/plain')
+  response['Retry-After'] = str(settings.SSHKEY_LOOKUP_RETRY_AFTER)
+  return response
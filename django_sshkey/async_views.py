@@ -0,0 +1,196 @@
+# Copyright (c) 2014-2016, Clemson University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of Clemson University nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+'''
+Asynchronous lookup view for ASGI deployments.
+
+This module needs Python 3.6 and Django 3.1 or later, and is only imported
+by django_sshkey.async_urls.  Queries use Django's asynchronous ORM
+interface where it has one (4.1 and later) and a worker thread otherwise.
+At most SSHKEY_ASYNC_DB_CONCURRENCY of them run at once per event loop;
+other requests wait without holding a thread or a database connection.
+'''
+
+import asyncio
+import weakref
+from asgiref.sync import sync_to_async
+from django.db import DEFAULT_DB_ALIAS
+from django.http import HttpResponse, HttpResponseNotAllowed
+from django.utils.cache import patch_vary_headers
+from django_sshkey import (
+  admission,
+  audit,
+  bloom,
+  cache as lookup_cache,
+  deadline,
+  metrics,
+  replicas,
+  settings,
+  sharding,
+)
+from django_sshkey.models import UserKey
+from django_sshkey.util import accepted_encoding, compress
+from django_sshkey.lookups import parse_lookup, rendered
+
+ASYNC_ORM = hasattr(UserKey.objects, 'aget')
+
+_db_slots = weakref.WeakKeyDictionary()
+
+
+def db_slots():
+  '''Return the semaphore bounding database access from this event loop'''
+  loop = asyncio.get_event_loop()
+  try:
+    return _db_slots[loop]
+  except KeyError:
+    slots = asyncio.Semaphore(settings.SSHKEY_ASYNC_DB_CONCURRENCY)
+    _db_slots[loop] = slots
+    return slots
+
+
+async def fetch_lines(keys, query, render, served, expires=None):
+  async with db_slots():
+    if sharding.enabled():
+      keys = await sync_to_async(sharding.gather)(keys, expires)
+      return list(rendered(keys, render, served))
+    database = await sync_to_async(replicas.lookup_database)(query)
+    keys = keys.using(database)
+    # Deadlines are set on the connection of the thread running the query,
+    # so queries with one run in a single call to that thread.
+    if ASYNC_ORM and expires is None:
+      keys = [key async for key in keys]
+      return list(rendered(keys, render, served))
+
+    def fetch():
+      with deadline.limit(database, expires):
+        return list(rendered(keys.iterator(), render, served))
+    return await sync_to_async(fetch)()
+
+
+async def touch(request, expires=None):
+  request.sshkey_key_id = key_id = int(request.body)
+  async with db_slots():
+    if ASYNC_ORM and expires is None and not sharding.enabled():
+      key = await UserKey.objects.aget(id=key_id)
+      await sync_to_async(key.touch)()
+    else:
+      def fetch_and_touch():
+        with deadline.limit(DEFAULT_DB_ALIAS, expires):
+          key = sharding.get(id=key_id)
+          key.touch()
+          return key
+      key = await sync_to_async(fetch_and_touch)()
+  return HttpResponse(str(key.last_used), content_type='text/plain')
+
+
+async def lookup(request):
+  response = await respond(request)
+  audit.record(request, response)
+  return response
+
+
+async def respond(request):
+  if request.method not in ('GET', 'POST'):
+    return HttpResponseNotAllowed(['GET', 'POST'])
+  mode = metrics.lookup_mode(request)
+  expires = deadline.from_request(request)
+  if request.method == 'POST':
+    try:
+      with admission.admit(mode):
+        return await touch(request, expires)
+    except admission.Overloaded:
+      return admission.shed(mode)
+    except deadline.DeadlineExceeded:
+      return deadline.exceeded(mode)
+  if sharding.enabled():
+    # Lookups by username find the user's shard with a query
+    parsed = await sync_to_async(parse_lookup)(request)
+  else:
+    parsed = parse_lookup(request)
+  if isinstance(parsed, HttpResponse):
+    return parsed
+  keys, query, content_type, render = parsed
+  request.sshkey_query = query
+  if bloom.enabled() and bloom.probe_item(query) is not None:
+    if await sync_to_async(bloom.definite_miss)(query):
+      metrics.inc('sshkey_lookup_bloom_total', (('result', 'miss'),))
+      return HttpResponse('', content_type=content_type)
+    metrics.inc('sshkey_lookup_bloom_total', (('result', 'maybe'),))
+  encoding = accepted_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+  try:
+    response = await lookup_response(mode, keys, query, encoding,
+                                     content_type, render, expires)
+  except admission.Overloaded:
+    response = await sync_to_async(admission.shed)(
+      mode, query, encoding, content_type)
+  except deadline.DeadlineExceeded:
+    response = deadline.exceeded(mode)
+  patch_vary_headers(response, ('Accept-Encoding',))
+  return response
+
+
+async def render_body(mode, keys, query, render, expires):
+  served = audit.Served()
+  with admission.admit(mode):
+    lines = await fetch_lines(keys, query, render, served, expires)
+    return {None: ''.join(lines).encode('utf-8'),
+            'served': served.to_entry()}
+
+
+async def lookup_response(mode, keys, query, encoding, content_type, render,
+                          expires):
+  if lookup_cache.enabled():
+    entry = await sync_to_async(lookup_cache.get)(query)
+    if entry is None or encoding not in entry:
+      metrics.inc('sshkey_lookup_cache_total', (('result', 'miss'),))
+      if entry is None:
+        entry = await render_body(mode, keys, query, render, expires)
+      if encoding:
+        entry[encoding] = b''.join(compress([entry[None]], encoding))
+      await sync_to_async(lookup_cache.store)(query, entry)
+    else:
+      metrics.inc('sshkey_lookup_cache_total', (('result', 'hit'),))
+    body = entry[encoding]
+  else:
+    entry = await render_body(mode, keys, query, render, expires)
+    if settings.SSHKEY_LOOKUP_STALE_TIMEOUT:
+      await sync_to_async(lookup_cache.store_stale)(query, entry)
+    body = entry[None]
+    if encoding:
+      body = b''.join(compress([body], encoding))
+  response = HttpResponse(body, content_type=content_type)
+  response.sshkey_served = audit.Served.from_entry(entry)
+  if encoding:
+    response['Content-Encoding'] = encoding
+  return response
+
+
+# What csrf_exempt does; its wrapper would hide that this is a coroutine on
+# Django versions before 5.0.
+lookup.csrf_exempt = True
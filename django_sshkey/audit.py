@@ -0,0 +1,282 @@
+# Copyright (c) 2014-2016, Clemson University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of Clemson University nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+'''
+Audit log of lookups and key uses.
+
+Views only put events on a bounded in-process queue, which never blocks:
+when it is full the event is dropped and counted.  A background thread
+writes queued events in batches, to a rotating file as JSON lines or to
+the LookupEvent table, depending on SSHKEY_AUDIT.
+'''
+
+import atexit
+import functools
+import json
+import logging
+import logging.handlers
+import os
+import threading
+import time
+try:
+  import queue
+except ImportError:  # Python 2
+  import Queue as queue
+from django.db import close_old_connections
+from django.utils import timezone
+from django_sshkey import metrics, settings
+
+logger = logging.getLogger(__name__)
+
+FIELDS = ('time', 'event', 'remote_addr', 'mode', 'username', 'fingerprint',
+          'blob_digest', 'key_id', 'key_count', 'key_ids', 'status')
+
+_lock = threading.Lock()
+_state = {'queue': None, 'thread': None, 'pid': None, 'dropped': 0,
+          'file': None}
+
+
+def enabled():
+  return bool(settings.SSHKEY_AUDIT)
+
+
+def get_queue():
+  '''Return this process's queue, starting its writer thread if need be'''
+  with _lock:
+    # A forked worker inherits the queue but not the thread
+    if _state['pid'] != os.getpid():
+      q = queue.Queue(settings.SSHKEY_AUDIT_QUEUE_SIZE)
+      thread = threading.Thread(target=run, args=(q,),
+                                name='django_sshkey.audit')
+      thread.daemon = True
+      thread.start()
+      _state.update(queue=q, thread=thread, pid=os.getpid(), file=None)
+    return _state['queue']
+
+
+def record(request, response):
+  '''Queue the audit event for a lookup view's response'''
+  if not enabled():
+    return
+  query = getattr(request, 'sshkey_query', None) or ()
+  served = getattr(response, 'sshkey_served', None)
+  if query[:1] == ('username',):
+    username, query = query[1], query[2:]
+  else:
+    username = ''
+  event = (
+    timezone.now(),
+    'touch' if request.method == 'POST' else 'lookup',
+    request.META.get('REMOTE_ADDR', ''),
+    metrics.lookup_mode(request),
+    username,
+    query[1] if query[:1] == ('fingerprint',) else '',
+    query[1] if query[:1] == ('key',) else '',
+    getattr(request, 'sshkey_key_id', None),
+    served.count if served is not None else None,
+    tuple(served.ids) if served is not None else (),
+    response.status_code,
+  )
+  try:
+    get_queue().put_nowait(event)
+  except queue.Full:
+    with _lock:
+      _state['dropped'] += 1
+    metrics.inc('sshkey_audit_dropped_total')
+
+
+class Served(object):
+  '''
+  The number of keys in a lookup response and the ids of the first
+  SSHKEY_AUDIT_KEY_IDS of them, so that events stay small however many keys
+  a lookup returns.
+  '''
+
+  def __init__(self, count=0, ids=()):
+    self.count = count
+    self.ids = list(ids)
+
+  @classmethod
+  def from_entry(cls, entry):
+    '''Return what a lookup cache entry served, or None if not known'''
+    if 'served' not in entry:
+      return None
+    return cls(*entry['served'])
+
+  def add(self, key_id):
+    self.count += 1
+    if len(self.ids) < settings.SSHKEY_AUDIT_KEY_IDS:
+      self.ids.append(key_id)
+
+  def to_entry(self):
+    return (self.count, tuple(self.ids))
+
+
+def trail(view):
+  '''Record the events of a lookup view in the audit log'''
+  @functools.wraps(view)
+  def wrapper(request, *args, **kwargs):
+    response = view(request, *args, **kwargs)
+    if response.streaming:
+      # The keys it serves are known once it has been sent
+      response.streaming_content = Recorded(
+        response.streaming_content, request, response)
+    else:
+      record(request, response)
+    return response
+  return wrapper
+
+
+class Recorded(object):
+  '''
+  Wrap streaming content and record its response's event once the response
+  is closed, whether or not it was sent in full.
+  '''
+
+  def __init__(self, chunks, request, response):
+    self.chunks = chunks
+    self.request = request
+    self.response = response
+
+  def __iter__(self):
+    return iter(self.chunks)
+
+  def close(self):
+    record(self.request, self.response)
+
+
+def dropped():
+  '''Return how many events this process has dropped'''
+  with _lock:
+    return _state['dropped']
+
+
+def run(q):
+  while True:
+    # Besides events, the queue carries threading.Events set by flush(),
+    # which are set once the events queued before them are written.
+    events = []
+    flushed = []
+    item = q.get()
+    deadline = time.time() + settings.SSHKEY_AUDIT_FLUSH_INTERVAL
+    while True:
+      if isinstance(item, tuple):
+        events.append(item)
+      else:
+        flushed.append(item)
+      if flushed or len(events) >= settings.SSHKEY_AUDIT_BATCH_SIZE:
+        break
+      try:
+        item = q.get(timeout=max(deadline - time.time(), 0))
+      except queue.Empty:
+        break
+    if events:
+      write_safely(events)
+      if settings.SSHKEY_AUDIT == 'database':
+        close_old_connections()
+    for done in flushed:
+      done.set()
+
+
+def flush(timeout=5):
+  '''Write the events queued in this process now'''
+  with _lock:
+    if _state['pid'] != os.getpid():
+      return
+    q, thread = _state['queue'], _state['thread']
+  if thread is not None and thread.is_alive():
+    done = threading.Event()
+    try:
+      q.put(done, timeout=timeout)
+    except queue.Full:
+      return
+    done.wait(timeout)
+    return
+  events = []
+  while True:
+    try:
+      events.append(q.get_nowait())
+    except queue.Empty:
+      break
+  if events:
+    write_safely(events)
+
+
+atexit.register(flush)
+
+
+def write_safely(events):
+  try:
+    write(events)
+  except Exception:
+    logger.exception('Failed to write %d audit events', len(events))
+    with _lock:
+      _state['dropped'] += len(events)
+    metrics.inc('sshkey_audit_dropped_total', value=len(events))
+
+
+def write(events):
+  if settings.SSHKEY_AUDIT == 'database':
+    write_database(events)
+  elif settings.SSHKEY_AUDIT == 'file':
+    write_file(events)
+  else:
+    raise ValueError('Unknown audit log: %s' % settings.SSHKEY_AUDIT)
+
+
+def write_database(events):
+  from django_sshkey.models import LookupEvent
+  rows = []
+  for event in events:
+    row = dict(zip(FIELDS, event))
+    row['key_ids'] = ','.join(str(key_id) for key_id in row['key_ids'])
+    rows.append(LookupEvent(**row))
+  LookupEvent.objects.bulk_create(rows)
+
+
+def audit_file():
+  '''Return the rotating file that events are written to'''
+  with _lock:
+    if _state['file'] is None:
+      _state['file'] = logging.handlers.RotatingFileHandler(
+        settings.SSHKEY_AUDIT_FILE.format(pid=os.getpid()),
+        maxBytes=settings.SSHKEY_AUDIT_FILE_MAX_BYTES,
+        backupCount=settings.SSHKEY_AUDIT_FILE_BACKUPS,
+      )
+    return _state['file']
+
+
+def write_file(events):
+  handler = audit_file()
+  for event in events:
+    entry = dict(zip(FIELDS, event))
+    entry['time'] = entry['time'].isoformat()
+    handler.handle(logging.makeLogRecord(
+      {'msg': json.dumps(entry, sort_keys=True)}))
+  handler.flush()
@@ -0,0 +1,130 @@
+# Copyright (c) 2014-2016, Clemson University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of Clemson University nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+'''
+Bloom filter of the keys that lookups can find.
+
+Each process keeps its own copy, built from the database and rebuilt when
+the lookup cache generation changes (which UserKey signals do) or after
+SSHKEY_LOOKUP_BLOOM_MAX_AGE seconds.  Lookups for a single fingerprint or
+key that the filter does not contain are answered without a query.
+'''
+
+import threading
+import time
+from django_sshkey import cache as lookup_cache, replicas, settings, sharding
+from django_sshkey.lookups import servable
+from django_sshkey.models import UserKey
+from django_sshkey.util import BloomFilter, bloom_item
+
+# Filters for a handful of keys would round to so few bits and hashes that
+# they let through far more than SSHKEY_LOOKUP_BLOOM_ERROR; a filter for
+# this many items takes about 1 KiB.
+MIN_CAPACITY = 1000
+
+_lock = threading.Lock()
+_state = {'filter': None, 'generation': None, 'built': 0, 'building': False}
+
+
+def enabled():
+  return bool(settings.SSHKEY_LOOKUP_BLOOM)
+
+
+def build():
+  '''Return a new filter of the fingerprints and keys that lookups return'''
+  keys = servable(UserKey.objects.all())
+  keys = keys.values_list('fingerprint', 'blob_digest')
+  if sharding.enabled():
+    entries = sharding.gather(keys)
+  else:
+    entries = list(keys.using(replicas.lookup_database()).iterator())
+  bloom = BloomFilter.for_capacity(max(2 * len(entries), MIN_CAPACITY),
+                                   settings.SSHKEY_LOOKUP_BLOOM_ERROR)
+  for fingerprint, digest in entries:
+    if fingerprint:
+      bloom.add(bloom_item('fingerprint', fingerprint))
+    if digest:
+      bloom.add(bloom_item('key', digest))
+  return bloom
+
+
+def current():
+  '''
+  Return this process's filter, rebuilding it if it is out of date.
+
+  Only one thread rebuilds at a time, outside the lock.  Meanwhile the others
+  are given the previous filter if it is merely old, since it still holds
+  every key of the current generation, and None otherwise.
+  '''
+  generation = lookup_cache.generation(lookup_cache.get_cache())
+  with _lock:
+    bloom = _state['filter']
+    current = bloom is not None and _state['generation'] == generation
+    age = time.time() - _state['built']
+    if current and age < settings.SSHKEY_LOOKUP_BLOOM_MAX_AGE:
+      return bloom
+    if _state['building']:
+      return bloom if current else None
+    _state['building'] = True
+  try:
+    bloom = build()
+  finally:
+    with _lock:
+      _state['building'] = False
+  with _lock:
+    _state.update(filter=bloom, generation=generation, built=time.time())
+  return bloom
+
+
+def reset():
+  with _lock:
+    _state.update(filter=None, generation=None, built=0)
+
+
+def probe_item(query):
+  '''
+  Return the filter item for a parse_lookup() query, or None when the
+  query is not for a single fingerprint or key.
+  '''
+  if query[0] == 'username':
+    query = query[2:]
+  if query[0] in ('fingerprint', 'key'):
+    return bloom_item(query[0], query[1])
+  return None
+
+
+def definite_miss(query):
+  '''Return whether the lookup for query is certain to find no keys'''
+  if not enabled():
+    return False
+  item = probe_item(query)
+  if item is None:
+    return False
+  bloom = current()
+  return bloom is not None and item not in bloom
@@ -0,0 +1,120 @@
+# Copyright (c) 2014-2016, Clemson University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of Clemson University nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import hashlib
+import uuid
+try:
+  from django.core.cache import caches
+except ImportError:  # Django < 1.7
+  from django.core.cache import get_cache as _get_cache
+  caches = None
+from django_sshkey import settings
+
+GENERATION_KEY = 'django_sshkey.lookup.generation'
+
+
+def get_cache():
+  if caches is None:
+    return _get_cache(settings.SSHKEY_LOOKUP_CACHE)
+  return caches[settings.SSHKEY_LOOKUP_CACHE]
+
+
+def enabled():
+  return bool(settings.SSHKEY_LOOKUP_CACHE_TIMEOUT)
+
+
+def generation(cache):
+  '''Return the current generation, which changes whenever keys do'''
+  value = cache.get(GENERATION_KEY)
+  if value is None:
+    value = uuid.uuid4().hex
+    cache.add(GENERATION_KEY, value, None)
+    value = cache.get(GENERATION_KEY, value)
+  return value
+
+
+def cache_key(cache, query):
+  # Entries are never deleted; changing the generation orphans all of them
+  # at once and they expire on their own.
+  query = repr(query).encode('utf-8')
+  return 'django_sshkey.lookup.%s.%s' % (
+    generation(cache), hashlib.md5(query).hexdigest())
+
+
+def get(query):
+  '''
+  Return the cached lookup response for query.
+
+  Entries are dicts that map a content coding (None for identity) to a
+  response body, and 'served' to audit.Served.to_entry() for lookups.
+  Returns None on a miss.
+  '''
+  cache = get_cache()
+  return cache.get(cache_key(cache, query))
+
+
+def store(query, entry):
+  cache = get_cache()
+  cache.set(cache_key(cache, query), entry,
+            settings.SSHKEY_LOOKUP_CACHE_TIMEOUT)
+  store_stale(query, entry)
+
+
+def forget(query):
+  '''Drop the cached entry for query, in the current generation'''
+  cache = get_cache()
+  cache.delete(cache_key(cache, query))
+
+
+def stale_key(query):
+  # Stale copies outlive generations, so their keys leave it out.
+  query = repr(query).encode('utf-8')
+  return 'django_sshkey.lookup.stale.%s' % hashlib.md5(query).hexdigest()
+
+
+def get_stale(query):
+  '''
+  Return the last response stored for query, even if keys have changed
+  since, or None.
+  '''
+  if not settings.SSHKEY_LOOKUP_STALE_TIMEOUT:
+    return None
+  return get_cache().get(stale_key(query))
+
+
+def store_stale(query, entry):
+  if settings.SSHKEY_LOOKUP_STALE_TIMEOUT:
+    get_cache().set(stale_key(query), entry,
+                    settings.SSHKEY_LOOKUP_STALE_TIMEOUT)
+
+
+def invalidate():
+  shared = settings.SSHKEY_LOOKUP_COALESCE == 'cache'
+  if enabled() or shared or settings.SSHKEY_LOOKUP_BLOOM:
+    get_cache().set(GENERATION_KEY, uuid.uuid4().hex, None)
@@ -0,0 +1,140 @@
+# Copyright (c) 2014-2016, Clemson University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of Clemson University nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+'''
+Coalescing of identical concurrent lookups ("single flight").
+
+With SSHKEY_LOOKUP_COALESCE set to "process", the first request for a
+lookup renders it and any identical requests arriving in the same process
+meanwhile wait for and share its result.  With "cache", requests in other
+processes also wait, using a lock and result kept in the lookup cache.
+Requests wait for at most SSHKEY_LOOKUP_COALESCE_TIMEOUT seconds, or until
+their deadline, whichever comes first.
+'''
+
+import threading
+import time
+from django_sshkey import cache as lookup_cache, deadline, metrics, settings
+
+POLL_INTERVAL = 0.01
+
+
+def wait_until(expires):
+  '''Return the time by which a waiting request must give up'''
+  until = time.time() + settings.SSHKEY_LOOKUP_COALESCE_TIMEOUT
+  if expires is not None:
+    until = min(until, expires)
+  return until
+
+
+class Call(object):
+  def __init__(self):
+    self.done = threading.Event()
+    self.waiters = 0
+    self.result = None
+    self.error = None
+
+
+class Group(object):
+  '''Run one call per key at a time, sharing its result with callers'''
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.calls = {}
+
+  def do(self, key, func, expires=None):
+    with self.lock:
+      call = self.calls.get(key)
+      leader = call is None
+      if leader:
+        call = self.calls[key] = Call()
+      else:
+        call.waiters += 1
+    if not leader:
+      metrics.inc('sshkey_lookup_coalesced_total', (('scope', 'process'),))
+      if not call.done.wait(max(wait_until(expires) - time.time(), 0)):
+        raise deadline.DeadlineExceeded()
+      if call.error is not None:
+        raise call.error
+      return call.result
+    try:
+      call.result = func()
+    except Exception as e:
+      call.error = e
+      raise
+    finally:
+      with self.lock:
+        del self.calls[key]
+      call.done.set()
+    return call.result
+
+
+group = Group()
+
+
+def do_cached(query, func, expires=None):
+  '''Coalesce calls across processes through the lookup cache'''
+  cache = lookup_cache.get_cache()
+  key = lookup_cache.cache_key(cache, ('coalesce',) + query)
+  lock_key = key + '.lock'
+  result_key = key + '.result'
+  timeout = settings.SSHKEY_LOOKUP_COALESCE_TIMEOUT
+  if not cache.add(lock_key, True, timeout):
+    until = wait_until(expires)
+    while time.time() < until:
+      result = cache.get(result_key)
+      if result is not None:
+        metrics.inc('sshkey_lookup_coalesced_total', (('scope', 'cache'),))
+        return result
+      if cache.get(lock_key) is None:
+        break  # the leader failed
+      time.sleep(POLL_INTERVAL)
+    if expires is not None and time.time() >= expires:
+      raise deadline.DeadlineExceeded()
+    return func()
+  try:
+    result = func()
+    cache.set(result_key, result, timeout)
+    return result
+  finally:
+    cache.delete(lock_key)
+
+
+def do(query, func, expires=None):
+  '''
+  Return func(), sharing it with identical lookups as configured; raises
+  DeadlineExceeded if waiting for another lookup outlasts expires or the
+  coalescing timeout.
+  '''
+  mode = settings.SSHKEY_LOOKUP_COALESCE
+  if mode == 'process':
+    return group.do(query, func, expires)
+  if mode == 'cache':
+    return group.do(query, lambda: do_cached(query, func, expires), expires)
+  return func()
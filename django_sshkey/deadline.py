@@ -0,0 +1,131 @@
+# Copyright (c) 2014-2016, Clemson University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of Clemson University nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+'''
+Deadlines for lookups.
+
+Clients send how long they will wait for a lookup in the X-SSHKey-Timeout
+header, in seconds, and SSHKEY_LOOKUP_TIMEOUT bounds it on the server.  A
+lookup whose deadline has passed is not started, and its queries are
+cancelled by the database once it passes: SQLite checks the time as the
+query runs, and PostgreSQL and MySQL are given a statement timeout.
+'''
+
+import contextlib
+import math
+import time
+from django.db import DatabaseError, OperationalError, connections
+from django.http import HttpResponse
+from django_sshkey import metrics, settings
+
+HEADER = 'HTTP_X_SSHKEY_TIMEOUT'
+
+# Virtual machine instructions SQLite runs between checks of the deadline
+SQLITE_PROGRESS_INTERVAL = 1000
+
+
+class DeadlineExceeded(Exception):
+  '''Raised when a lookup cannot finish before its deadline'''
+
+
+def from_request(request, start=None):
+  '''Return the time by which request must be answered, or None'''
+  if start is None:
+    start = time.time()
+  timeout = settings.SSHKEY_LOOKUP_TIMEOUT
+  try:
+    requested = float(request.META.get(HEADER, ''))
+  except ValueError:
+    requested = None
+  if requested is not None and 0 < requested < float('inf'):
+    if timeout is None or requested < timeout:
+      timeout = requested
+  if timeout is None:
+    return None
+  return start + timeout
+
+
+def remaining(deadline):
+  '''Return the seconds left until deadline, raising if there are none'''
+  left = deadline - time.time()
+  if left <= 0:
+    raise DeadlineExceeded()
+  return left
+
+
+@contextlib.contextmanager
+def limit(alias, deadline):
+  '''
+  Cancel the queries made on database alias that run past deadline.  With
+  no alias, the caller limits its queries itself.
+  '''
+  if deadline is None or alias is None:
+    yield
+    return
+  connection = connections[alias]
+  milliseconds = int(math.ceil(remaining(deadline) * 1000))
+  if connection.vendor == 'sqlite':
+    connection.ensure_connection()
+    connection.connection.set_progress_handler(
+      lambda: time.time() > deadline, SQLITE_PROGRESS_INTERVAL)
+
+    def reset():
+      connection.connection.set_progress_handler(
+        None, SQLITE_PROGRESS_INTERVAL)
+  elif connection.vendor in ('postgresql', 'mysql'):
+    if connection.vendor == 'postgresql':
+      variable = 'statement_timeout'
+    else:
+      variable = 'max_execution_time'
+    with connection.cursor() as cursor:
+      cursor.execute('SET SESSION %s = %d' % (variable, milliseconds))
+
+    def reset():
+      try:
+        with connection.cursor() as cursor:
+          cursor.execute('SET SESSION %s = DEFAULT' % variable)
+      except DatabaseError:
+        pass  # e.g. in a transaction aborted by the cancelled query
+  else:
+    reset = None
+  try:
+    yield
+  except OperationalError:
+    if time.time() >= deadline:
+      raise DeadlineExceeded()
+    raise
+  finally:
+    if reset is not None:
+      reset()
+
+
+def exceeded(mode):
+  metrics.inc('sshkey_lookup_deadline_exceeded_total', (('mode', mode),))
+  return HttpResponse('Deadline exceeded\n', status=504,
+                      content_type='text/plain')
@@ -0,0 +1,98 @@
+# Copyright (c) 2014-2016, Clemson University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of Clemson University nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+'''
+OpenSSH key revocation lists (KRLs), in the binary format described in
+PROTOCOL.krl of the OpenSSH sources and read by sshd's RevokedKeys.
+'''
+
+import base64
+import calendar
+import hashlib
+import struct
+from django_sshkey import cache as lookup_cache, sharding
+from django_sshkey.models import UserKey
+
+KRL_MAGIC = b'SSHKRL\n\x00'
+KRL_FORMAT_VERSION = 1
+KRL_SECTION_FINGERPRINT_SHA1 = 3
+
+
+def ssh_string(data):
+  return struct.pack('>I', len(data)) + data
+
+
+def format_krl(blobs, version=0, generated=0, comment=''):
+  '''
+  Return a KRL revoking the public keys with the given blobs.
+
+  Keys are listed by their SHA1 hashes, which every version of OpenSSH
+  that supports KRLs understands and which take 24 bytes per key.
+  '''
+  hashes = sorted(set(hashlib.sha1(blob).digest() for blob in blobs))
+  out = [
+    KRL_MAGIC,
+    struct.pack('>IQQQ', KRL_FORMAT_VERSION, version, generated, 0),
+    ssh_string(b''),  # reserved
+    ssh_string(comment.encode('utf-8')),
+  ]
+  if hashes:
+    out.append(struct.pack('B', KRL_SECTION_FINGERPRINT_SHA1))
+    out.append(ssh_string(b''.join(ssh_string(h) for h in hashes)))
+  return b''.join(out)
+
+
+def revoked_krl():
+  '''
+  Return the KRL of all revoked keys.
+
+  Its version and generation date are the time of the latest revocation,
+  so the KRL only changes when the revoked keys do.  It is kept in the
+  lookup cache when that is enabled.
+  '''
+  query = ('krl',)
+  if lookup_cache.enabled():
+    entry = lookup_cache.get(query)
+    if entry is not None:
+      return entry[None]
+  blobs = []
+  latest = 0
+  revoked = UserKey.objects.filter(revoked__isnull=False)
+  revoked = revoked.values_list('key', 'revoked')
+  if sharding.enabled():
+    revoked = sharding.gather(revoked)
+  else:
+    revoked = revoked.iterator()
+  for key, when in revoked:
+    blobs.append(base64.b64decode(key.split()[1].encode('ascii')))
+    latest = max(latest, calendar.timegm(when.utctimetuple()))
+  krl = format_krl(blobs, latest, latest, 'django-sshkey')
+  if lookup_cache.enabled():
+    lookup_cache.store(query, {None: krl})
+  return krl
@@ -0,0 +1,151 @@
+# Copyright (c) 2014-2016, Clemson University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of Clemson University nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+'''
+Parsing and rendering shared by the lookup views.
+'''
+
+import json
+import struct
+from django.http import HttpResponseBadRequest
+from django_sshkey import settings, sharding
+from django_sshkey.models import UserKey
+from django_sshkey.util import PublicKey, blob_digest
+
+# Key ids are compared with columns that are at most signed 64-bit integers.
+MIN_ID = -2 ** 63
+MAX_ID = 2 ** 63 - 1
+
+
+def stored_row(row):
+  # Text lookups fetch UserKey.authorized_keys_line as it is, with the key's
+  # id for the audit log and sharding.gather().
+  return row[1]
+
+
+def ndjson_line(key):
+  return json.dumps({
+    'id': key.id,
+    'username': key.user.username,
+    'fingerprint': key.fingerprint,
+    'key': key.key,
+    'last_used': key.last_used and key.last_used.isoformat(),
+  }, sort_keys=True)
+
+
+def rendered(rows, render, served):
+  '''Render rows as lines of a response, adding their ids to served'''
+  for row in rows:
+    served.add(sharding.row_id(row))
+    yield render(row) + '\n'
+
+
+def servable(keys):
+  '''Leave out of keys those that lookups do not return'''
+  keys = keys.filter(revoked__isnull=True)
+  if settings.SSHKEY_LOOKUP_ACTIVE_ONLY:
+    keys = keys.filter(owner_active=True)
+  return keys
+
+
+def parse_lookup(request):
+  '''
+  Find the keys that a lookup request asks for and how to render them.
+
+  Returns (keys, query, content_type, render), where query identifies the
+  response in the lookup cache, or an HttpResponseBadRequest.
+  '''
+  if 'key' in request.GET:
+    # The key type and blob, as given by sshd's %t and %k.  Clients that do
+    # not encode the query string turn the blob's +s into spaces.
+    try:
+      pubkey = PublicKey(request.GET['key'].replace(' ', '+'))
+    except (TypeError, ValueError, IndexError, struct.error):
+      return HttpResponseBadRequest('Invalid key', content_type='text/plain')
+    if request.GET.get('key_type', pubkey.algorithm) != pubkey.algorithm:
+      return HttpResponseBadRequest('Invalid key_type',
+                                    content_type='text/plain')
+    digest = blob_digest(pubkey.keydata)
+    keys = UserKey.objects.filter(blob_digest=digest)
+    query = ('key', digest)
+  elif 'fingerprint' in request.GET:
+    fingerprint = request.GET['fingerprint']
+    keys = UserKey.objects.filter(fingerprint=fingerprint)
+    query = ('fingerprint', fingerprint)
+  else:
+    keys = UserKey.objects.all()
+    query = ('all',)
+  if 'username' in request.GET:
+    # With a fingerprint this uses the (user, fingerprint) index
+    username = request.GET['username']
+    if sharding.enabled():
+      keys = sharding.for_username(keys, username)
+    else:
+      keys = keys.filter(user__username=username)
+    query = ('username', username) + query
+  keys = servable(keys)
+  format = request.GET.get('format', 'text')
+  if format == 'text':
+    content_type = 'text/plain'
+    keys = keys.values_list('id', 'authorized_keys_line')
+    render = stored_row
+  elif format == 'ndjson':
+    content_type = 'application/x-ndjson'
+    keys = sharding.with_users(keys)
+    render = ndjson_line
+  else:
+    return HttpResponseBadRequest('Invalid format', content_type='text/plain')
+  page = {}
+  for param in ('after_id', 'before_id', 'limit'):
+    if param in request.GET:
+      try:
+        page[param] = int(request.GET[param])
+      except ValueError:
+        return HttpResponseBadRequest('Invalid %s' % param,
+                                      content_type='text/plain')
+  for param in ('after_id', 'before_id'):
+    if not MIN_ID <= page.get(param, 0) <= MAX_ID:
+      return HttpResponseBadRequest('Invalid %s' % param,
+                                    content_type='text/plain')
+  if page.get('limit', 1) < 1:
+    return HttpResponseBadRequest('Invalid limit', content_type='text/plain')
+  if 'limit' in page:
+    page['limit'] = min(page['limit'], settings.SSHKEY_LOOKUP_MAX_LIMIT)
+  # Keyset pagination: pages are ranges of the primary key, so fetching one
+  # never needs to skip over the rows before it.
+  if 'after_id' in page:
+    keys = keys.filter(id__gt=page['after_id'])
+  if 'before_id' in page:
+    keys = keys.filter(id__lt=page['before_id'])
+  if page:
+    keys = keys.order_by('id')
+  if 'limit' in page:
+    keys = keys[:page['limit']]
+  query += (format, tuple(sorted(page.items())))
+  return keys, query, content_type, render
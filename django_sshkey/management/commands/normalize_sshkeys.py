@@ -29,7 +29,8 @@
 
 from django.core.management.base import BaseCommand, CommandError
 from django.contrib.auth.models import User
-from ...models import UserKey
+from ... import sharding
+from ...models import UserKey, normalize_keys
 
 
 class Command(BaseCommand):
@@ -55,18 +56,15 @@ class Command(BaseCommand):
 
     qs = UserKey.objects.all()
     if user is not None:
-      qs = qs.filter(user=user)
+      qs = sharding.user_keys(user, qs)
     if key_name is not None:
       qs = qs.filter(name=key_name)
 
-    if not qs:
+    count = normalize_keys(qs)
+    if not count:
       raise CommandError('No keys matched')
-
-    count = qs.count()
-    for key in qs:
-      key.full_clean()
-      key.save()
     if count == 1:
+      key = sharding.gather(sharding.with_users(qs))[0]
       self.stdout.write('Normalized `%s`' % key)
     else:
       self.stdout.write('Normalized %d key(s)' % count)
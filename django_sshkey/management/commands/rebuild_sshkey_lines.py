@@ -0,0 +1,57 @@
+# Copyright (c) 2014-2016, Clemson University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of Clemson University nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+from ... import sharding
+from ...models import UserKey, rebuild_authorized_keys_lines
+
+
+class Command(BaseCommand):
+  help = ('Render again the stored authorized_keys lines, e.g. after '
+          'changing SSHKEY_AUTHORIZED_KEYS_OPTIONS')
+
+  def add_arguments(self, parser):
+    parser.add_argument('username', nargs='?',
+                        help='If given, rebuild the lines of this user\'s '
+                             'keys')
+    parser.add_argument('-b', '--batch-size', type=int, default=100,
+                        help='Number of keys to read and update per batch')
+
+  def handle(self, *args, **options):
+    username = options['username']
+    qs = UserKey.objects.all()
+    if username is not None:
+      try:
+        user = User.objects.get(username=username)
+      except User.DoesNotExist:
+        raise CommandError('No such user: %s' % username)
+      qs = sharding.user_keys(user, qs)
+    count = rebuild_authorized_keys_lines(qs, options['batch_size'])
+    self.stdout.write('Rebuilt %d line(s)' % count)
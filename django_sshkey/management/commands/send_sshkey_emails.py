@@ -0,0 +1,73 @@
+# Copyright (c) 2014-2016, Clemson University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of Clemson University nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from django.core.mail import get_connection
+from django.core.management.base import BaseCommand
+from ...models import UserKeyNotification, send_email_add_key
+
+
+class Command(BaseCommand):
+  help = 'Send queued emails about keys added to user accounts'
+
+  def add_arguments(self, parser):
+    parser.add_argument('-b', '--batch-size', type=int, default=100,
+                        help='Number of users to notify per batch')
+    parser.add_argument('-m', '--max-attempts', type=int, default=5,
+                        help='Give up on a notification after this many '
+                             'failed attempts')
+
+  def handle(self, *args, **options):
+    batch_size = options['batch_size']
+    pending = UserKeyNotification.objects.filter(
+      attempts__lt=options['max_attempts'])
+
+    sent = failed = 0
+    last_user_id = 0
+    connection = get_connection()
+    connection.open()
+    try:
+      while True:
+        # Batches are made of users rather than notifications so that all of
+        # a user's pending notifications are sent as a single message.
+        user_ids = list(
+          pending.filter(user_id__gt=last_user_id)
+          .order_by('user_id')
+          .values_list('user_id', flat=True)
+          .distinct()[:batch_size]
+        )
+        if not user_ids:
+          break
+        last_user_id = user_ids[-1]
+        batch = pending.filter(user_id__in=user_ids).select_related('user')
+        s, f = send_email_add_key(list(batch), connection)
+        sent += s
+        failed += f
+    finally:
+      connection.close()
+    self.stdout.write('Sent %d email(s), %d failed' % (sent, failed))
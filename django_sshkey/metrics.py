@@ -0,0 +1,314 @@
+# Copyright (c) 2014-2016, Clemson University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of Clemson University nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import bisect
+import functools
+import threading
+import time
+from django.db import connections
+from django_sshkey import settings
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304,
+                16777216)
+
+HELP = (
+  ('sshkey_lookup_requests_total', 'counter',
+   'Lookup requests by mode.'),
+  ('sshkey_lookup_duration_seconds', 'histogram',
+   'Time spent producing lookup responses, including streaming.'),
+  ('sshkey_lookup_response_bytes', 'histogram',
+   'Size of lookup response bodies as sent.'),
+  ('sshkey_lookup_db_queries_total', 'counter',
+   'Database queries made by lookup requests.'),
+  ('sshkey_lookup_db_seconds_total', 'counter',
+   'Time spent in database queries made by lookup requests.'),
+  ('sshkey_lookup_cache_total', 'counter',
+   'Lookup cache hits and misses.'),
+  ('sshkey_lookup_coalesced_total', 'counter',
+   'Lookups that shared the result of an identical concurrent lookup.'),
+  ('sshkey_lookup_bloom_total', 'counter',
+   'Single key lookups answered by the Bloom filter (miss) or not (maybe).'),
+  ('sshkey_lookup_shed_total', 'counter',
+   'Lookups over their concurrency limit, answered stale or unavailable.'),
+  ('sshkey_lookup_deadline_exceeded_total', 'counter',
+   'Lookups abandoned because they could not finish before their deadline.'),
+  ('sshkey_audit_dropped_total', 'counter',
+   'Audit log events dropped because the queue was full or writing failed.'),
+)
+
+
+class Registry(object):
+  '''
+  Counters and histograms for this process.
+
+  Updates take a single lock for a few dictionary operations, so threads
+  serving requests never see or produce a partial sample.
+  '''
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.reset()
+
+  def reset(self):
+    with self.lock:
+      self.counters = {}
+      self.histograms = {}
+
+  def inc(self, name, labels=(), value=1):
+    key = (name, labels)
+    with self.lock:
+      self.counters[key] = self.counters.get(key, 0) + value
+
+  def observe(self, name, buckets, value, labels=()):
+    key = (name, labels)
+    i = bisect.bisect_left(buckets, value)
+    with self.lock:
+      try:
+        histogram = self.histograms[key]
+      except KeyError:
+        histogram = self.histograms[key] = [buckets, [0] * len(buckets), 0, 0]
+      if i < len(buckets):
+        histogram[1][i] += 1
+      histogram[2] += 1
+      histogram[3] += value
+
+  def render(self):
+    '''Return all metrics in the Prometheus text exposition format.'''
+    with self.lock:
+      counters = dict(self.counters)
+      histograms = dict(
+        (key, (h[0], list(h[1]), h[2], h[3]))
+        for key, h in self.histograms.items()
+      )
+    lines = []
+    for name, type, help in HELP:
+      lines.append('# HELP %s %s' % (name, help))
+      lines.append('# TYPE %s %s' % (name, type))
+      for key in sorted(counters):
+        if key[0] == name:
+          lines.append(sample(name, key[1], counters[key]))
+      for key in sorted(histograms):
+        if key[0] != name:
+          continue
+        labels = key[1]
+        buckets, counts, count, total = histograms[key]
+        cumulative = 0
+        for bound, n in zip(buckets, counts):
+          cumulative += n
+          lines.append(sample(name + '_bucket', labels + (('le', bound),),
+                              cumulative))
+        lines.append(sample(name + '_bucket', labels + (('le', '+Inf'),),
+                            count))
+        lines.append(sample(name + '_sum', labels, total))
+        lines.append(sample(name + '_count', labels, count))
+    return '\n'.join(lines) + '\n'
+
+
+def sample(name, labels, value):
+  if labels:
+    name += '{%s}' % ','.join('%s="%s"' % label for label in labels)
+  return '%s %s' % (name, repr(float(value)) if isinstance(value, float)
+                    else value)
+
+
+registry = Registry()
+
+
+def enabled():
+  return settings.SSHKEY_METRICS
+
+
+def inc(name, labels=(), value=1):
+  if enabled():
+    registry.inc(name, labels, value)
+
+
+def render():
+  return registry.render()
+
+
+class QueryCounter(object):
+  '''
+  Count the queries made on the current thread's connections to every
+  database, such as read replicas and shards.
+
+  Uses connection.execute_wrapper() where available (Django 2.0+);
+  otherwise the connections' cursor() is replaced for the duration with one
+  that hands out CountingCursors, which unlike the debug cursor keeps no log.
+  '''
+
+  def __init__(self):
+    self.count = 0
+    self.seconds = 0.0
+    self.wrappers = []
+    self.patched = []
+    for alias in connections:
+      connection = connections[alias]
+      if hasattr(connection, 'execute_wrapper'):
+        wrapper = connection.execute_wrapper(self)
+        wrapper.__enter__()
+        self.wrappers.append(wrapper)
+        continue
+      # An enclosing QueryCounter may have replaced cursor() already
+      self.patched.append((connection, connection.__dict__.get('cursor')))
+      connection.cursor = self.counting(connection.cursor)
+
+  def counting(self, cursor):
+    def wrapper():
+      return CountingCursor(cursor(), self)
+    return wrapper
+
+  def __call__(self, execute, sql, params, many, context):
+    start = time.time()
+    try:
+      return execute(sql, params, many, context)
+    finally:
+      self.count += 1
+      self.seconds += time.time() - start
+
+  def stop(self):
+    for wrapper in self.wrappers:
+      wrapper.__exit__(None, None, None)
+    for connection, cursor in reversed(self.patched):
+      if cursor is None:
+        del connection.cursor
+      else:
+        connection.cursor = cursor
+
+
+class CountingCursor(object):
+  '''Wrap a cursor and report the queries it runs to a QueryCounter'''
+
+  def __init__(self, cursor, counter):
+    self.cursor = cursor
+    self.counter = counter
+
+  def __getattr__(self, name):
+    return getattr(self.cursor, name)
+
+  def __iter__(self):
+    return iter(self.cursor)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, type, value, traceback):
+    return self.cursor.__exit__(type, value, traceback)
+
+  def execute(self, sql, params=None):
+    return self.counter(
+      lambda sql, params, many, context: self.cursor.execute(sql, params),
+      sql, params, False, {})
+
+  def executemany(self, sql, param_list):
+    return self.counter(
+      lambda sql, params, many, context: self.cursor.executemany(sql, params),
+      sql, param_list, True, {})
+
+
+def lookup_mode(request):
+  if request.method == 'POST':
+    return 'touch'
+  for mode in ('key', 'fingerprint'):
+    if mode in request.GET:
+      if 'username' in request.GET:
+        return 'username_' + mode
+      return mode
+  if 'username' in request.GET:
+    return 'username'
+  return 'all'
+
+
+def instrument(view):
+  '''
+  Record request, latency, size and query metrics for a lookup view.
+
+  Streaming responses are measured when the last chunk has been sent.
+  '''
+  @functools.wraps(view)
+  def wrapper(request, *args, **kwargs):
+    if not enabled():
+      return view(request, *args, **kwargs)
+    labels = (('mode', lookup_mode(request)),)
+    start = time.time()
+    queries = QueryCounter()
+    try:
+      response = view(request, *args, **kwargs)
+    except Exception:
+      record(labels, start, queries, None)
+      raise
+    if response.streaming:
+      response.streaming_content = StreamMeasurement(
+        response.streaming_content, labels, start, queries)
+    else:
+      record(labels, start, queries, len(response.content))
+    return response
+  return wrapper
+
+
+class StreamMeasurement(object):
+  '''
+  Wrap streaming content and record its metrics once it has been sent.
+
+  The response closes this when it is closed, so metrics are recorded (and
+  the query counter stopped) even if the client goes away mid-stream.
+  '''
+
+  def __init__(self, chunks, labels, start, queries):
+    self.chunks = chunks
+    self.labels = labels
+    self.start = start
+    self.queries = queries
+    self.size = 0
+    self.closed = False
+
+  def __iter__(self):
+    for chunk in self.chunks:
+      self.size += len(chunk)
+      yield chunk
+    self.close()
+
+  def close(self):
+    if not self.closed:
+      self.closed = True
+      record(self.labels, self.start, self.queries, self.size)
+
+
+def record(labels, start, queries, size):
+  queries.stop()
+  registry.inc('sshkey_lookup_requests_total', labels)
+  registry.observe('sshkey_lookup_duration_seconds', LATENCY_BUCKETS,
+                   time.time() - start, labels)
+  registry.inc('sshkey_lookup_db_queries_total', labels, queries.count)
+  registry.inc('sshkey_lookup_db_seconds_total', labels, queries.seconds)
+  if size is not None:
+    registry.observe('sshkey_lookup_response_bytes', SIZE_BUCKETS, size,
+                     labels)
@@ -0,0 +1,34 @@
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('django_sshkey', '0002_resize_fingerprint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserKeyNotification',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50)),
+                ('fingerprint', models.CharField(max_length=128)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('server_name', models.CharField(blank=True, max_length=255)),
+                ('remote_addr', models.CharField(blank=True, max_length=255)),
+                ('remote_host', models.CharField(blank=True, max_length=255)),
+                ('userkey_list_uri', models.TextField(blank=True)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('user', models.ForeignKey(to=settings.AUTH_USER_MODEL, on_delete=models.CASCADE)),
+            ],
+            options={
+                'db_table': 'sshkey_userkeynotification',
+            },
+            bases=(models.Model,),
+        ),
+    ]
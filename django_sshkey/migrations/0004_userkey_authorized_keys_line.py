@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+def render_lines(apps, schema_editor):
+    # A copy of how keys' lines were rendered when this migration was made
+    from django.conf import settings
+    options = getattr(settings, 'SSHKEY_AUTHORIZED_KEYS_OPTIONS', None)
+    UserKey = apps.get_model('django_sshkey', 'UserKey')
+    keys = UserKey.objects.select_related('user').order_by('id')
+    last_id = 0
+    while True:
+        batch = list(keys.filter(id__gt=last_id)[:100])
+        for key in batch:
+            line = key.key
+            if options:
+                line = options.format(
+                    username=key.user.username,
+                    key_id=key.id,
+                ) + ' ' + line
+            UserKey.objects.filter(id=key.id).update(
+                authorized_keys_line=line)
+        if len(batch) < 100:
+            break
+        last_id = batch[-1].id
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_sshkey', '0003_userkeynotification'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userkey',
+            name='authorized_keys_line',
+            field=models.TextField(editable=False, blank=True, default=''),
+            preserve_default=False,
+        ),
+        migrations.RunPython(render_lines, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import base64
+import binascii
+import struct
+
+from django.db import models, migrations
+
+# A copy of how keys' metadata was extracted when this migration was made, so
+# that later changes to django_sshkey.util do not change what it does.  Keys
+# are parsed as clean() stores them, in OpenSSH format; any others are left
+# for normalize_sshkeys.
+
+KEY_BITS = {
+    'ecdsa-sha2-nistp256': 256,
+    'ecdsa-sha2-nistp384': 384,
+    'ecdsa-sha2-nistp521': 521,
+    'sk-ecdsa-sha2-nistp256@openssh.com': 256,
+    'ssh-ed25519': 256,
+    'sk-ssh-ed25519@openssh.com': 256,
+}
+
+
+def parse_key(text):
+    """Return the algorithm, bits and comment of a key, or None"""
+    fields = text.split(None, 2)
+    if len(text.splitlines()) != 1 or len(fields) < 2:
+        return None
+    try:
+        blob = base64.b64decode(fields[1].encode('ascii'))
+        parts = []
+        while blob:
+            length = struct.unpack('>I', blob[:4])[0]
+            parts.append(blob[4:4 + length])
+            blob = blob[4 + length:]
+        algorithm = parts[0].decode('ascii')
+    except (TypeError, ValueError, IndexError, struct.error, binascii.Error):
+        return None
+    if algorithm != fields[0]:
+        return None
+    if algorithm == 'ssh-rsa' and len(parts) == 3:
+        bits = int(binascii.hexlify(parts[2]), 16).bit_length()  # modulus
+    elif algorithm == 'ssh-dss' and len(parts) == 5:
+        bits = int(binascii.hexlify(parts[1]), 16).bit_length()  # p
+    else:
+        bits = KEY_BITS.get(algorithm)
+    comment = fields[2] if len(fields) == 3 else ''
+    return algorithm, bits, comment
+
+
+def extract_metadata(apps, schema_editor):
+    UserKey = apps.get_model('django_sshkey', 'UserKey')
+    keys = UserKey.objects.order_by('id')
+    last_id = 0
+    while True:
+        batch = list(keys.filter(id__gt=last_id)[:100])
+        for key in batch:
+            metadata = parse_key(key.key)
+            if metadata is None:
+                continue
+            algorithm, bits, comment = metadata
+            UserKey.objects.filter(id=key.id).update(
+                algorithm=algorithm,
+                bits=bits,
+                comment=comment[:255],
+            )
+        if len(batch) < 100:
+            break
+        last_id = batch[-1].id
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_sshkey', '0004_userkey_authorized_keys_line'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userkey',
+            name='algorithm',
+            field=models.CharField(editable=False, max_length=64, blank=True, default=''),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='userkey',
+            name='bits',
+            field=models.PositiveIntegerField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='userkey',
+            name='comment',
+            field=models.CharField(editable=False, max_length=255, blank=True, db_index=True, default=''),
+            preserve_default=False,
+        ),
+        migrations.AlterIndexTogether(
+            name='userkey',
+            index_together=set([('algorithm', 'bits')]),
+        ),
+        migrations.RunPython(extract_metadata, migrations.RunPython.noop),
+    ]
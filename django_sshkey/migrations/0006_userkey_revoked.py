@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_sshkey', '0005_userkey_metadata'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userkey',
+            name='revoked',
+            field=models.DateTimeField(editable=False, null=True, db_index=True),
+        ),
+    ]
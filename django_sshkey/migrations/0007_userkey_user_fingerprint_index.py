@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_sshkey', '0006_userkey_revoked'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='userkey',
+            index_together=set([('algorithm', 'bits'), ('user', 'fingerprint')]),
+        ),
+    ]
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import base64
+import binascii
+import hashlib
+import struct
+
+from django.db import models, migrations
+
+
+def blob_digest(text):
+    """
+    A copy of how keys' digests were computed when this migration was made:
+    the unpadded base64 SHA256 digest of the blob of a key in OpenSSH format,
+    as clean() stores it, or None.
+    """
+    fields = text.split(None, 2)
+    if len(text.splitlines()) != 1 or len(fields) < 2:
+        return None
+    try:
+        blob = base64.b64decode(fields[1].encode('ascii'))
+        length = struct.unpack('>I', blob[:4])[0]
+        algorithm = blob[4:4 + length].decode('ascii')
+    except (TypeError, ValueError, struct.error, binascii.Error):
+        return None
+    if algorithm != fields[0]:
+        return None
+    digest = hashlib.sha256(blob).digest()
+    return base64.b64encode(digest).decode('ascii').rstrip('=')
+
+
+def compute_digests(apps, schema_editor):
+    UserKey = apps.get_model('django_sshkey', 'UserKey')
+    keys = UserKey.objects.order_by('id')
+    last_id = 0
+    while True:
+        batch = list(keys.filter(id__gt=last_id)[:100])
+        for key in batch:
+            digest = blob_digest(key.key)
+            if digest is None:
+                continue
+            UserKey.objects.filter(id=key.id).update(blob_digest=digest)
+        if len(batch) < 100:
+            break
+        last_id = batch[-1].id
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_sshkey', '0007_userkey_user_fingerprint_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userkey',
+            name='blob_digest',
+            field=models.CharField(editable=False, max_length=43, blank=True, db_index=True, default=''),
+            preserve_default=False,
+        ),
+        migrations.RunPython(compute_digests, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_sshkey', '0008_userkey_blob_digest'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LookupEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('time', models.DateTimeField(db_index=True)),
+                ('event', models.CharField(max_length=8)),
+                ('remote_addr', models.CharField(blank=True, max_length=255)),
+                ('mode', models.CharField(blank=True, max_length=32)),
+                ('username', models.CharField(blank=True, max_length=150)),
+                ('fingerprint', models.CharField(blank=True, max_length=128)),
+                ('blob_digest', models.CharField(blank=True, max_length=43)),
+                ('key_id', models.PositiveIntegerField(null=True)),
+                ('status', models.PositiveSmallIntegerField()),
+            ],
+            options={
+                'db_table': 'sshkey_lookupevent',
+            },
+            bases=(models.Model,),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+def copy_is_active(apps, schema_editor):
+    UserKey = apps.get_model('django_sshkey', 'UserKey')
+    UserKey.objects.filter(user__is_active=False).update(owner_active=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_sshkey', '0009_lookupevent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userkey',
+            name='owner_active',
+            field=models.BooleanField(default=True, db_index=True, editable=False),
+        ),
+        migrations.RunPython(copy_is_active, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+
+class AlterFieldOnShards(migrations.AlterField):
+    '''
+    Alter a field in every database other than the default one, which may
+    hold a shard of keys but never their users, leaving it and the model
+    state as they are.
+    '''
+
+    def on_shard(self, schema_editor):
+        return schema_editor.connection.alias != DEFAULT_DB_ALIAS
+
+    def state_forwards(self, app_label, state):
+        pass
+
+    def altered(self, app_label, state):
+        state = state.clone()
+        super(AlterFieldOnShards, self).state_forwards(app_label, state)
+        return state
+
+    def database_forwards(self, app_label, schema_editor, from_state,
+                          to_state):
+        if self.on_shard(schema_editor):
+            super(AlterFieldOnShards, self).database_forwards(
+                app_label, schema_editor, from_state,
+                self.altered(app_label, from_state))
+
+    def database_backwards(self, app_label, schema_editor, from_state,
+                           to_state):
+        if self.on_shard(schema_editor):
+            super(AlterFieldOnShards, self).database_forwards(
+                app_label, schema_editor, self.altered(app_label, to_state),
+                to_state)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('django_sshkey', '0010_userkey_owner_active'),
+    ]
+
+    operations = [
+        AlterFieldOnShards(
+            model_name='userkey',
+            name='user',
+            field=models.ForeignKey(db_constraint=False, on_delete=models.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.CreateModel(
+            name='UserKeyId',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+            ],
+            options={
+                'db_table': 'sshkey_userkeyid',
+            },
+        ),
+        migrations.CreateModel(
+            name='UserKeyShard',
+            fields=[
+                ('user', models.OneToOneField(related_name='sshkey_shard', primary_key=True, serialize=False, to=settings.AUTH_USER_MODEL, on_delete=models.CASCADE)),
+                ('database', models.CharField(max_length=100)),
+            ],
+            options={
+                'db_table': 'sshkey_userkeyshard',
+            },
+        ),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_sshkey', '0011_userkey_shards'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='lookupevent',
+            name='key_count',
+            field=models.PositiveIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='lookupevent',
+            name='key_ids',
+            field=models.TextField(blank=True, default=''),
+        ),
+    ]
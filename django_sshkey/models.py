@@ -27,34 +27,60 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Q
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
-from django.db.models.signals import pre_save
+from django.db.models.signals import post_delete, post_save, pre_delete
 from django.dispatch import receiver
+try:
+  from django.db.transaction import on_commit
+except ImportError:  # Django < 1.9
+  on_commit = None
+try:
+  from django.db.models import Case, Value, When
+except ImportError:  # Django < 1.8
+  Case = None
 try:
   from django.utils.timezone import now
 except ImportError:
   import datetime
   now = datetime.datetime.now
-from django_sshkey.util import PublicKeyParseError, pubkey_parse
-from django_sshkey import settings
+from django_sshkey.util import PublicKeyParseError, blob_digest, pubkey_parse
+from django_sshkey import cache as lookup_cache, replicas, settings, sharding
 
 
 class UserKey(models.Model):
-  user = models.ForeignKey(User, db_index=True)
+  # Keys may be in another database than users; see sharding and migration
+  # 0011, which drops the database constraint there
+  user = models.ForeignKey(User, db_index=True, on_delete=models.CASCADE)
   name = models.CharField(max_length=50, blank=True)
   key = models.TextField(max_length=2000)
   fingerprint = models.CharField(max_length=128, blank=True, db_index=True)
   created = models.DateTimeField(auto_now_add=True, null=True)
   last_modified = models.DateTimeField(null=True)
   last_used = models.DateTimeField(null=True)
+  authorized_keys_line = models.TextField(blank=True, editable=False)
+  blob_digest = models.CharField(max_length=43, blank=True, db_index=True,
+                                 editable=False)
+  algorithm = models.CharField(max_length=64, blank=True, editable=False)
+  bits = models.PositiveIntegerField(null=True, editable=False)
+  comment = models.CharField(max_length=255, blank=True, db_index=True,
+                             editable=False)
+  revoked = models.DateTimeField(null=True, db_index=True, editable=False)
+  # A copy of user.is_active, so that lookups need not join auth_user
+  owner_active = models.BooleanField(default=True, db_index=True,
+                                     editable=False)
 
   class Meta:
     db_table = 'sshkey_userkey'
     unique_together = [
       ('user', 'name'),
     ]
+    index_together = [
+      ('algorithm', 'bits'),
+      ('user', 'fingerprint'),
+    ]
 
   def __unicode__(self):
     return unicode(self.user) + u': ' + self.name
@@ -75,6 +101,7 @@ class UserKey(models.Model):
       raise ValidationError(str(e))
     self.key = pubkey.format_openssh()
     self.fingerprint = pubkey.fingerprint()
+    set_key_metadata(self, pubkey)
     if not self.name:
       if not pubkey.comment:
         raise ValidationError('Name or key comment required')
@@ -82,23 +109,25 @@ class UserKey(models.Model):
 
   def validate_unique(self, exclude=None):
     if self.pk is None:
-      objects = type(self).objects
+      objects = type(self).objects.all()
     else:
       objects = type(self).objects.exclude(pk=self.pk)
     if exclude is None or 'name' not in exclude:
-      if objects.filter(user=self.user, name=self.name).count():
+      same_name = sharding.user_keys(self.user, objects).filter(
+        name=self.name)
+      if same_name.count():
         message = 'You already have a key with that name'
         raise ValidationError({'name': [message]})
     if exclude is None or 'key' not in exclude:
-      try:
-        other = objects.get(fingerprint=self.fingerprint, key=self.key)
+      others = sharding.gather(
+        objects.filter(fingerprint=self.fingerprint, key=self.key))
+      if others:
+        other = others[0]
         if self.user == other.user:
           message = 'You already have that key on file (%s)' % other.name
         else:
           message = 'Somebody else already has that key on file'
         raise ValidationError({'key': [message]})
-      except type(self).DoesNotExist:
-        pass
 
   def export(self, format='RFC4716'):
     pubkey = pubkey_parse(self.key)
@@ -107,42 +136,502 @@ class UserKey(models.Model):
       return pubkey.format_rfc4716()
     if f == 'PEM':
       return pubkey.format_pem()
+    if f == 'PKCS8':
+      return pubkey.format_pkcs8()
     raise ValueError("Invalid format")
 
   def save(self, *args, **kwargs):
     if kwargs.pop('update_last_modified', True):
       self.last_modified = now()
-    super(UserKey, self).save(*args, **kwargs)
+    if self.id is None:
+      self.owner_active = self.user.is_active
+      if sharding.enabled():
+        # Ids come from one sequence, so that they are unique across shards
+        self.id = sharding.allocate_id()
+        kwargs['force_insert'] = True
+    update_fields = kwargs.get('update_fields')
+    if update_fields is None or 'authorized_keys_line' in update_fields:
+      self.authorized_keys_line = format_authorized_keys_line(
+        self.user.username, self.id, self.key)
+    options = settings.SSHKEY_AUTHORIZED_KEYS_OPTIONS
+    if self.id is not None or not options or '{key_id}' not in options:
+      super(UserKey, self).save(*args, **kwargs)
+      return
+    # {key_id} can only be filled in once the key has been inserted.
+    with transaction.atomic():
+      super(UserKey, self).save(*args, **kwargs)
+      self.authorized_keys_line = format_authorized_keys_line(
+        self.user.username, self.id, self.key)
+      UserKey.objects.filter(id=self.id).update(
+        authorized_keys_line=self.authorized_keys_line)
 
   def touch(self):
     self.last_used = now()
-    self.save(update_last_modified=False)
+    self.save(update_last_modified=False, update_fields=['last_used'])
+
+  def revoke(self):
+    '''Stop looking up this key and list it in the KRL'''
+    if self.revoked is None:
+      self.revoked = now()
+      self.save(update_last_modified=False, update_fields=['revoked'])
+
+
+KEY_METADATA_FIELDS = ('blob_digest', 'algorithm', 'bits', 'comment')
+
+
+def set_key_metadata(key, pubkey):
+  key.blob_digest = blob_digest(pubkey.keydata)
+  key.algorithm = pubkey.algorithm
+  key.bits = pubkey.bits()
+  # Only the start of a long comment is indexed
+  key.comment = (pubkey.comment or '')[:255]
+
+
+def format_authorized_keys_line(username, key_id, key):
+  if settings.SSHKEY_AUTHORIZED_KEYS_OPTIONS:
+    options = settings.SSHKEY_AUTHORIZED_KEYS_OPTIONS.format(
+      username=username,
+      key_id=key_id,
+    ) + ' '
+  else:
+    options = ''
+  return options + key
+
+
+def keys_changed(using=None, keys=None):
+  '''
+  Invalidate cached lookups, and read the lookups that may return any of keys
+  (all of them, without keys) from the default database for a while, once
+  the transaction on database using commits.  Doing so before would let
+  lookups made in the meantime cache what it has not yet written.
+  '''
+  def changed():
+    lookup_cache.invalidate()
+    replicas.pin(keys)
+  if on_commit is None:
+    changed()
+  else:
+    on_commit(changed, using=using)
+
+
+@receiver([post_save, post_delete], sender=UserKey)
+def invalidate_lookup_cache(sender, instance, **kwargs):
+  # touch() does not change what lookups return
+  if kwargs.get('update_fields') == frozenset(['last_used']):
+    return
+  keys_changed(kwargs.get('using'), [instance])
+
+
+def revoke_keys(queryset):
+  '''Revoke the keys in queryset with one query; returns how many'''
+  count = queryset.filter(revoked__isnull=True).update(revoked=now())
+  if count:
+    keys_changed(queryset.db)
+  return count
+
+
+def reconcile_owner_active(queryset=None):
+  '''
+  Correct UserKey.owner_active where it differs from the owner's is_active,
+  with two queries; returns how many keys changed.
+  '''
+  if queryset is None:
+    queryset = UserKey.objects.all()
+  if sharding.enabled():
+    # Users cannot be joined to keys in another database, so this takes one
+    # more query, and two per shard.
+    inactive = list(User.objects.filter(is_active=False).values_list(
+      'id', flat=True))
+    count = 0
+    for keys in sharding.spread(queryset):
+      count += keys.filter(owner_active=True, user_id__in=inactive).update(
+        owner_active=False)
+      count += keys.filter(owner_active=False).exclude(
+        user_id__in=inactive).update(owner_active=True)
+  else:
+    count = queryset.filter(owner_active=True, user__is_active=False).update(
+      owner_active=False)
+    count += queryset.filter(owner_active=False, user__is_active=True).update(
+      owner_active=True)
+  if count:
+    keys_changed(queryset.db)
+  return count
+
+
+NORMALIZED_FIELDS = (
+  'name',
+  'key',
+  'fingerprint',
+  'authorized_keys_line',
+) + KEY_METADATA_FIELDS
+
 
+def normalize_keys(queryset, batch_size=100):
+  '''
+  Recalculate the key data of the keys in queryset.
 
-@receiver(pre_save, sender=UserKey)
-def send_email_add_key(sender, instance, **kwargs):
-  if not settings.SSHKEY_EMAIL_ADD_KEY or instance.pk:
+  Keys are cleaned and validated as by full_clean(), but only those that
+  changed are saved, batch_size at a time with one query to validate them
+  and one to update them.  Returns the number of keys in queryset.
+  '''
+  count = 0
+  for keys in sharding.spread(queryset):
+    changed = []
+    with transaction.atomic(using=keys.db):
+      for key in sharding.with_users(keys).iterator():
+        count += 1
+        name = key.name
+        original = [getattr(key, field) for field in NORMALIZED_FIELDS]
+        key.clean_fields()
+        key.clean()
+        key.authorized_keys_line = format_authorized_keys_line(
+          key.user.username, key.id, key.key)
+        if [getattr(key, field) for field in NORMALIZED_FIELDS] != original:
+          changed.append((key, key.name != name))
+        if len(changed) == batch_size:
+          _save_normalized_keys(keys, changed)
+          changed = []
+      if changed:
+        _save_normalized_keys(keys, changed)
+  return count
+
+
+def _save_normalized_keys(queryset, changed):
+  # The same checks as UserKey.validate_unique(), made against the other
+  # keys and within the batch.  Only renamed keys can have a new name clash.
+  keys = [key for key, renamed in changed]
+  conditions = Q(fingerprint__in=set(key.fingerprint for key in keys))
+  for key, renamed in changed:
+    if renamed:
+      conditions |= Q(user_id=key.user_id, name=key.name)
+  others = sharding.gather(UserKey.objects.filter(conditions).exclude(
+    id__in=[key.id for key in keys]))
+  names = set()
+  pubkeys = {}
+  for other in others:
+    names.add((other.user_id, other.name))
+    pubkeys[(other.fingerprint, other.key)] = other
+  for key, renamed in changed:
+    if renamed and (key.user_id, key.name) in names:
+      message = 'You already have a key with that name'
+      raise ValidationError({'name': [message]})
+    other = pubkeys.get((key.fingerprint, key.key))
+    if other is not None:
+      if key.user_id == other.user_id:
+        message = 'You already have that key on file (%s)' % other.name
+      else:
+        message = 'Somebody else already has that key on file'
+      raise ValidationError({'key': [message]})
+    names.add((key.user_id, key.name))
+    pubkeys[(key.fingerprint, key.key)] = key
+
+  _update_keys(queryset, keys, NORMALIZED_FIELDS, last_modified=now())
+
+
+def rebuild_authorized_keys_lines(queryset, batch_size=100):
+  '''
+  Render again the stored authorized_keys lines of the keys in queryset.
+
+  Needed when SSHKEY_AUTHORIZED_KEYS_OPTIONS changes.  Keys are read in
+  chunks of batch_size, in order of id, and each chunk's changed lines are
+  updated with one query.  Returns the number of lines that changed.
+  '''
+  def render(key):
+    key.authorized_keys_line = format_authorized_keys_line(
+      key.user.username, key.id, key.key)
+  return _rebuild_keys(sharding.with_users(queryset), render,
+                       ('authorized_keys_line',), batch_size)
+
+
+def rebuild_key_metadata(queryset, batch_size=100,
+                         fields=KEY_METADATA_FIELDS):
+  '''
+  Extract again the blob digest, algorithm, bits and comment (or only the
+  given fields) of the keys in queryset.
+
+  Keys are read and updated as by rebuild_authorized_keys_lines(); those
+  that cannot be parsed are left alone.  Returns the number of keys that
+  changed.
+  '''
+  def extract(key):
+    try:
+      pubkey = pubkey_parse(key.key)
+    except PublicKeyParseError:
+      return
+    set_key_metadata(key, pubkey)
+  return _rebuild_keys(queryset, extract, fields, batch_size)
+
+
+def _rebuild_keys(queryset, func, fields, batch_size):
+  count = 0
+  for keys in sharding.spread(queryset.order_by('id')):
+    last_id = 0
+    while True:
+      batch = list(keys.filter(id__gt=last_id)[:batch_size])
+      changed = []
+      for key in batch:
+        original = [getattr(key, field) for field in fields]
+        func(key)
+        if [getattr(key, field) for field in fields] != original:
+          changed.append(key)
+      if changed:
+        _update_keys(keys, changed, fields)
+        count += len(changed)
+      if len(batch) < batch_size:
+        break
+      last_id = batch[-1].id
+  return count
+
+
+def _update_keys(queryset, keys, fields, **values):
+  # One UPDATE, in the database of queryset, setting each of fields to the
+  # value it has on each key.
+  model = queryset.model
+  objects = model._default_manager.using(queryset.db)
+  if Case is None:
+    for key in keys:
+      updates = dict(values)
+      for field in fields:
+        updates[field] = getattr(key, field)
+      objects.filter(id=key.id).update(**updates)
+  else:
+    for field in fields:
+      values[field] = Case(
+        *[When(id=key.id, then=Value(getattr(key, field))) for key in keys],
+        output_field=model._meta.get_field(field)
+      )
+    objects.filter(id__in=[key.id for key in keys]).update(**values)
+  keys_changed(queryset.db)
+
+
+@receiver(post_save, sender=User)
+def rebuild_user_authorized_keys_lines(sender, instance, created, **kwargs):
+  options = settings.SSHKEY_AUTHORIZED_KEYS_OPTIONS
+  if created or not options or '{username}' not in options:
+    return
+  # Logging in, for one, saves only last_login.
+  update_fields = kwargs.get('update_fields')
+  if update_fields is not None and 'username' not in update_fields:
     return
+  rebuild_authorized_keys_lines(sharding.user_keys(instance))
+
+
+@receiver(post_save, sender=User)
+def update_user_keys_owner_active(sender, instance, created, **kwargs):
+  if created:
+    return
+  update_fields = kwargs.get('update_fields')
+  if update_fields is not None and 'is_active' not in update_fields:
+    return
+  keys = sharding.user_keys(instance)
+  keys = keys.exclude(owner_active=instance.is_active)
+  if keys.update(owner_active=instance.is_active):
+    keys_changed(keys.db)
+
+
+@receiver(pre_delete, sender=User)
+def delete_user_keys(sender, instance, **kwargs):
+  # Deleting a user only cascades to the keys in the same database.
+  if sharding.enabled():
+    sharding.user_keys(instance).delete()
+
+
+@receiver(post_save, sender=User)
+def forget_user_shard(sender, instance, created, **kwargs):
+  # sharding.locate() caches each username's user id, or its absence
+  if not sharding.enabled():
+    return
+  update_fields = kwargs.get('update_fields')
+  if created:
+    def forget():
+      lookup_cache.forget(('shard', instance.username))
+  elif update_fields is None or 'username' in update_fields:
+    # The user's former name is not known
+    forget = lookup_cache.invalidate
+  else:
+    return
+  if on_commit is None:
+    forget()
+  else:
+    on_commit(forget, using=kwargs.get('using'))
+
+
+class UserKeyShard(models.Model):
+  '''
+  The shard that a user's keys were moved to by rebalance_sshkeys, when it
+  is not the one their id falls to.
+  '''
+  user = models.OneToOneField(User, primary_key=True,
+                              related_name='sshkey_shard',
+                              on_delete=models.CASCADE)
+  database = models.CharField(max_length=100)
+
+  class Meta:
+    db_table = 'sshkey_userkeyshard'
+
+  def __unicode__(self):
+    return unicode(self.user) + u': ' + self.database
+
+
+class UserKeyId(models.Model):
+  '''
+  The sequence that ids of keys are allocated from when they are sharded.
+  '''
+
+  class Meta:
+    db_table = 'sshkey_userkeyid'
+
+
+class UserKeyNotification(models.Model):
+  '''
+  A pending email notifying a user that a key was added to their account.
+
+  The name and fingerprint of the key are copied so that the notification is
+  still sent if the key is deleted in the meantime.
+  '''
+  user = models.ForeignKey(User, db_index=True, on_delete=models.CASCADE)
+  name = models.CharField(max_length=50)
+  fingerprint = models.CharField(max_length=128)
+  created = models.DateTimeField(auto_now_add=True)
+  server_name = models.CharField(max_length=255, blank=True)
+  remote_addr = models.CharField(max_length=255, blank=True)
+  remote_host = models.CharField(max_length=255, blank=True)
+  userkey_list_uri = models.TextField(blank=True)
+  attempts = models.PositiveIntegerField(default=0)
+
+  class Meta:
+    db_table = 'sshkey_userkeynotification'
+
+  def __unicode__(self):
+    return unicode(self.user) + u': ' + self.name
+
+
+class LookupEvent(models.Model):
+  '''
+  A lookup or use of a key, as recorded by the audit log.
+
+  Keys are referred to by id rather than by a foreign key, so that events
+  outlive the keys they mention and writing them takes no extra queries.
+  '''
+  time = models.DateTimeField(db_index=True)
+  event = models.CharField(max_length=8)
+  remote_addr = models.CharField(max_length=255, blank=True)
+  mode = models.CharField(max_length=32, blank=True)
+  username = models.CharField(max_length=150, blank=True)
+  fingerprint = models.CharField(max_length=128, blank=True)
+  blob_digest = models.CharField(max_length=43, blank=True)
+  key_id = models.PositiveIntegerField(null=True)
+  # How many keys a lookup returned, and the ids of the first
+  # SSHKEY_AUDIT_KEY_IDS of them, separated by commas
+  key_count = models.PositiveIntegerField(null=True)
+  key_ids = models.TextField(blank=True, default='')
+  status = models.PositiveSmallIntegerField()
+
+  class Meta:
+    db_table = 'sshkey_lookupevent'
+
+  def __unicode__(self):
+    return u'%s %s %s' % (self.time, self.event, self.remote_addr)
+
+
+def build_email_add_key(notifications, connection=None):
+  '''Build one message for a user's notifications, oldest first'''
   from django.template.loader import render_to_string
   from django.core.mail import EmailMultiAlternatives
-  from django.core.urlresolvers import reverse
+  first = notifications[0]
   context_dict = {
-    'key': instance,
+    'key': first,
+    'keys': notifications,
     'subject': settings.SSHKEY_EMAIL_ADD_KEY_SUBJECT,
+    'userkey_list_uri': first.userkey_list_uri,
   }
-  request = getattr(instance, 'request', None)
-  if request:
-    context_dict['request'] = request
-    context_dict['userkey_list_uri'] = request.build_absolute_uri(
-      reverse('django_sshkey.views.userkey_list'))
+  # Stands in for the request in templates written for synchronous emails
+  context_dict['request'] = {'META': {
+    'SERVER_NAME': first.server_name,
+    'REMOTE_ADDR': first.remote_addr,
+    'REMOTE_HOST': first.remote_host,
+  }}
   text_content = render_to_string('sshkey/add_key.txt', context_dict)
   msg = EmailMultiAlternatives(
     settings.SSHKEY_EMAIL_ADD_KEY_SUBJECT,
     text_content,
     settings.SSHKEY_FROM_EMAIL,
-    [instance.user.email],
+    [first.user.email],
+    connection=connection,
   )
   if settings.SSHKEY_SEND_HTML_EMAIL:
     html_content = render_to_string('sshkey/add_key.html', context_dict)
     msg.attach_alternative(html_content, 'text/html')
-  msg.send()
+  return msg
+
+
+def send_email_add_key(notifications, connection=None):
+  '''
+  Send notifications, one message per user.
+
+  Sent notifications are deleted; the attempts counter of those that fail is
+  incremented.  If connection is not given then one is opened and closed
+  around the whole batch.  Returns the numbers of messages sent and failed.
+  '''
+  from django.core.mail import get_connection
+  by_user = {}
+  for notification in notifications:
+    by_user.setdefault(notification.user_id, []).append(notification)
+  if connection is None:
+    connection = get_connection()
+    connection.open()
+    close = True
+  else:
+    close = False
+  sent = failed = 0
+  try:
+    for user_id in sorted(by_user):
+      group = sorted(by_user[user_id], key=lambda n: n.id)
+      pks = [n.pk for n in group]
+      try:
+        build_email_add_key(group, connection).send()
+      except Exception:
+        UserKeyNotification.objects.filter(pk__in=pks).update(
+          attempts=models.F('attempts') + 1)
+        failed += 1
+      else:
+        UserKeyNotification.objects.filter(pk__in=pks).delete()
+        sent += 1
+  finally:
+    if close:
+      connection.close()
+  return sent, failed
+
+
+@receiver(post_save, sender=UserKey)
+def queue_email_add_key(sender, instance, created, **kwargs):
+  if not settings.SSHKEY_EMAIL_ADD_KEY or not created:
+    return
+  try:
+    from django.urls import reverse
+  except ImportError:  # Django < 1.10
+    from django.core.urlresolvers import reverse
+  # Saved in the same transaction as the key, so a key that fails to save
+  # never results in an email.
+  notification = UserKeyNotification(
+    user=instance.user,
+    name=instance.name,
+    fingerprint=instance.fingerprint,
+  )
+  request = getattr(instance, 'request', None)
+  if request:
+    notification.server_name = request.META.get('SERVER_NAME', '')
+    notification.remote_addr = request.META.get('REMOTE_ADDR', '')
+    notification.remote_host = request.META.get('REMOTE_HOST', '')
+    notification.userkey_list_uri = request.build_absolute_uri(
+      reverse('django_sshkey.views.userkey_list'))
+  notification.save()
+  # Without on_commit() (Django < 1.9) the email could go out before the
+  # key is committed, so it is left to send_sshkey_emails.
+  if settings.SSHKEY_EMAIL_ADD_KEY_DEFER or on_commit is None:
+    return
+
+  def send():
+    pending = UserKeyNotification.objects.filter(pk=notification.pk)
+    send_email_add_key(list(pending.select_related('user')))
+  on_commit(send)
@@ -0,0 +1,111 @@
+# Copyright (c) 2014-2016, Clemson University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of Clemson University nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import cProfile
+import functools
+import os
+import random
+import threading
+import time
+from django.http import HttpResponse
+from django_sshkey import settings
+from django_sshkey.metrics import QueryCounter, lookup_mode
+
+PREFIX = 'lookup-'
+SUFFIX = '.prof'
+
+_lock = threading.Lock()
+_counter = [0]
+
+
+def sampled():
+  rate = settings.SSHKEY_PROFILE_RATE
+  return bool(rate) and random.random() < rate
+
+
+def dump(profile, mode):
+  '''Save profile stats and delete the oldest beyond SSHKEY_PROFILE_KEEP'''
+  directory = settings.SSHKEY_PROFILE_DIR
+  with _lock:
+    _counter[0] += 1
+    name = '%s%s-%s-%d-%d%s' % (
+      PREFIX, time.strftime('%Y%m%d%H%M%S'), mode, os.getpid(), _counter[0],
+      SUFFIX)
+    profile.dump_stats(os.path.join(directory, name))
+    dumps = [
+      os.path.join(directory, other) for other in os.listdir(directory)
+      if other.startswith(PREFIX) and other.endswith(SUFFIX)
+    ]
+    dumps.sort(key=os.path.getmtime)
+    for path in dumps[:-settings.SSHKEY_PROFILE_KEEP or None]:
+      try:
+        os.unlink(path)
+      except OSError:  # already deleted by another process
+        pass
+
+
+def sample(view):
+  '''
+  Profile a random sample of requests to a lookup view.
+
+  SSHKEY_PROFILE_RATE of requests are run under cProfile, with the
+  response body produced before returning so that streaming is included.
+  The stats are saved in SSHKEY_PROFILE_DIR, and a Server-Timing header
+  splits the time spent in the view between the database and the rest.
+  '''
+  @functools.wraps(view)
+  def wrapper(request, *args, **kwargs):
+    if not sampled():
+      return view(request, *args, **kwargs)
+    profile = cProfile.Profile()
+    start = time.time()
+    queries = QueryCounter()
+    profile.enable()
+    try:
+      response = view(request, *args, **kwargs)
+      if response.streaming:
+        streamed = response
+        response = HttpResponse(b''.join(streamed.streaming_content),
+                                status=streamed.status_code)
+        for header, value in streamed.items():
+          response[header] = value
+        streamed.close()
+    finally:
+      profile.disable()
+      queries.stop()
+    total = time.time() - start
+    response['Server-Timing'] = ', '.join([
+      'db;dur=%.3f' % (queries.seconds * 1000),
+      'render;dur=%.3f' % ((total - queries.seconds) * 1000),
+      'total;dur=%.3f' % (total * 1000),
+    ])
+    if settings.SSHKEY_PROFILE_DIR:
+      dump(profile, lookup_mode(request))
+    return response
+  return wrapper
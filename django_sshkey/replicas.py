@@ -0,0 +1,139 @@
+# Copyright (c) 2014-2016, Clemson University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of Clemson University nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+'''
+Choosing a read replica for lookups.
+
+Lookups are sent to one of SSHKEY_LOOKUP_REPLICAS, skipping replicas that
+could not be connected to in the last SSHKEY_LOOKUP_REPLICA_RETRY seconds,
+and to the default database if none is available or if a key the lookup may
+return changed in the last SSHKEY_LOOKUP_REPLICA_PIN seconds.  Everything
+else, including touches and the reads made when validating keys, uses the
+default database.
+'''
+
+import hashlib
+import random
+import threading
+import time
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+from django_sshkey import cache as lookup_cache, settings
+
+# Pins every lookup
+PIN_KEY = 'django_sshkey.replicas.pinned'
+# Pins the lookups that span every user's keys
+CHANGED_KEY = 'django_sshkey.replicas.changed'
+
+_lock = threading.Lock()
+_down = {}
+
+
+def pin_key(item):
+  item = repr(item).encode('utf-8')
+  return 'django_sshkey.replicas.pinned.%s' % hashlib.md5(item).hexdigest()
+
+
+def key_items(key):
+  '''
+  Return the lookups for one user's, one fingerprint's or one blob's keys
+  that may return key, as (kind, value) pairs, or None if its owner is gone.
+  '''
+  try:
+    username = key.user.username
+  except ObjectDoesNotExist:
+    return None
+  return [('username', username), ('fingerprint', key.fingerprint),
+          ('key', key.blob_digest)]
+
+
+def query_items(query):
+  '''
+  Return the (kind, value) pairs that a lookup cache query is narrowed to,
+  or None if it spans every user's keys.
+  '''
+  items = []
+  if query[:1] == ('username',):
+    items.append(query[:2])
+    query = query[2:]
+  if query[:1] in (('fingerprint',), ('key',)):
+    items.append(query[:2])
+  return items or None
+
+
+def pin(keys=None):
+  '''
+  Read the lookups that may return any of keys from the default database
+  for a while; with no keys, read every lookup from it.
+  '''
+  timeout = settings.SSHKEY_LOOKUP_REPLICA_PIN
+  if not settings.SSHKEY_LOOKUP_REPLICAS or not timeout:
+    return
+  items = [key_items(key) for key in keys or ()]
+  if not items or None in items:
+    pins = {PIN_KEY: True}
+  else:
+    pins = dict((pin_key(item), True) for each in items for item in each)
+    pins[CHANGED_KEY] = True
+  lookup_cache.get_cache().set_many(pins, timeout)
+
+
+def healthy(alias):
+  with _lock:
+    if _down.get(alias, 0) > time.time():
+      return False
+  try:
+    connections[alias].ensure_connection()
+  except DatabaseError:
+    with _lock:
+      _down[alias] = time.time() + settings.SSHKEY_LOOKUP_REPLICA_RETRY
+    return False
+  return True
+
+
+def lookup_database(query=None):
+  '''
+  Return the alias of the database to read lookups from, for the lookup
+  cache query if given; without one, for a lookup of every user's keys.
+  '''
+  replicas = list(settings.SSHKEY_LOOKUP_REPLICAS)
+  if not replicas:
+    return DEFAULT_DB_ALIAS
+  items = None if query is None else query_items(query)
+  if items is None:
+    pins = [PIN_KEY, CHANGED_KEY]
+  else:
+    pins = [PIN_KEY] + [pin_key(item) for item in items]
+  if any(lookup_cache.get_cache().get_many(pins).values()):
+    return DEFAULT_DB_ALIAS
+  random.shuffle(replicas)
+  for alias in replicas:
+    if healthy(alias):
+      return alias
+  return DEFAULT_DB_ALIAS
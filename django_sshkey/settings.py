@@ -35,6 +35,8 @@ SSHKEY_ALLOW_EDIT = getattr(
   settings, 'SSHKEY_ALLOW_EDIT', False)
 SSHKEY_EMAIL_ADD_KEY = getattr(
   settings, 'SSHKEY_EMAIL_ADD_KEY', True)
+SSHKEY_EMAIL_ADD_KEY_DEFER = getattr(
+  settings, 'SSHKEY_EMAIL_ADD_KEY_DEFER', True)
 SSHKEY_EMAIL_ADD_KEY_SUBJECT = getattr(
   settings, 'SSHKEY_EMAIL_ADD_KEY_SUBJECT',
   "A new public key was added to your account"
@@ -45,3 +47,69 @@ SSHKEY_SEND_HTML_EMAIL = getattr(
   settings, 'SSHKEY_SEND_HTML_EMAIL', False)
 SSHKEY_DEFAULT_HASH = getattr(
   settings, 'SSHKEY_DEFAULT_HASH', 'legacy')
+SSHKEY_LOOKUP_CACHE = getattr(
+  settings, 'SSHKEY_LOOKUP_CACHE', 'default')
+SSHKEY_LOOKUP_CACHE_TIMEOUT = getattr(
+  settings, 'SSHKEY_LOOKUP_CACHE_TIMEOUT', 0)
+SSHKEY_ADMIN_COUNT_CACHE_TIMEOUT = getattr(
+  settings, 'SSHKEY_ADMIN_COUNT_CACHE_TIMEOUT', 60)
+SSHKEY_METRICS = getattr(
+  settings, 'SSHKEY_METRICS', False)
+SSHKEY_PROFILE_RATE = getattr(
+  settings, 'SSHKEY_PROFILE_RATE', 0)
+SSHKEY_PROFILE_DIR = getattr(
+  settings, 'SSHKEY_PROFILE_DIR', None)
+SSHKEY_PROFILE_KEEP = getattr(
+  settings, 'SSHKEY_PROFILE_KEEP', 100)
+SSHKEY_ASYNC_DB_CONCURRENCY = getattr(
+  settings, 'SSHKEY_ASYNC_DB_CONCURRENCY', 10)
+SSHKEY_LOOKUP_REPLICAS = getattr(
+  settings, 'SSHKEY_LOOKUP_REPLICAS', ())
+SSHKEY_LOOKUP_REPLICA_PIN = getattr(
+  settings, 'SSHKEY_LOOKUP_REPLICA_PIN', 5)
+SSHKEY_LOOKUP_REPLICA_RETRY = getattr(
+  settings, 'SSHKEY_LOOKUP_REPLICA_RETRY', 30)
+SSHKEY_LOOKUP_COALESCE = getattr(
+  settings, 'SSHKEY_LOOKUP_COALESCE', None)
+SSHKEY_LOOKUP_COALESCE_TIMEOUT = getattr(
+  settings, 'SSHKEY_LOOKUP_COALESCE_TIMEOUT', 5)
+SSHKEY_LOOKUP_BLOOM = getattr(
+  settings, 'SSHKEY_LOOKUP_BLOOM', False)
+SSHKEY_LOOKUP_BLOOM_ERROR = getattr(
+  settings, 'SSHKEY_LOOKUP_BLOOM_ERROR', 0.01)
+SSHKEY_LOOKUP_BLOOM_MAX_AGE = getattr(
+  settings, 'SSHKEY_LOOKUP_BLOOM_MAX_AGE', 300)
+SSHKEY_LOOKUP_CONCURRENCY = getattr(
+  settings, 'SSHKEY_LOOKUP_CONCURRENCY', {})
+SSHKEY_LOOKUP_STALE_TIMEOUT = getattr(
+  settings, 'SSHKEY_LOOKUP_STALE_TIMEOUT', 0)
+SSHKEY_LOOKUP_RETRY_AFTER = getattr(
+  settings, 'SSHKEY_LOOKUP_RETRY_AFTER', 1)
+SSHKEY_LOOKUP_TIMEOUT = getattr(
+  settings, 'SSHKEY_LOOKUP_TIMEOUT', None)
+SSHKEY_AUDIT = getattr(
+  settings, 'SSHKEY_AUDIT', None)
+SSHKEY_AUDIT_FILE = getattr(
+  settings, 'SSHKEY_AUDIT_FILE', None)
+SSHKEY_AUDIT_FILE_MAX_BYTES = getattr(
+  settings, 'SSHKEY_AUDIT_FILE_MAX_BYTES', 10485760)
+SSHKEY_AUDIT_FILE_BACKUPS = getattr(
+  settings, 'SSHKEY_AUDIT_FILE_BACKUPS', 5)
+SSHKEY_AUDIT_QUEUE_SIZE = getattr(
+  settings, 'SSHKEY_AUDIT_QUEUE_SIZE', 10000)
+SSHKEY_AUDIT_BATCH_SIZE = getattr(
+  settings, 'SSHKEY_AUDIT_BATCH_SIZE', 500)
+SSHKEY_AUDIT_FLUSH_INTERVAL = getattr(
+  settings, 'SSHKEY_AUDIT_FLUSH_INTERVAL', 1)
+SSHKEY_AUDIT_KEY_IDS = getattr(
+  settings, 'SSHKEY_AUDIT_KEY_IDS', 10)
+SSHKEY_LOOKUP_ACTIVE_ONLY = getattr(
+  settings, 'SSHKEY_LOOKUP_ACTIVE_ONLY', False)
+SSHKEY_SHARDS = getattr(
+  settings, 'SSHKEY_SHARDS', ())
+SSHKEY_SHARD_WORKERS = getattr(
+  settings, 'SSHKEY_SHARD_WORKERS', 4)
+SSHKEY_SHARD_CACHE_TIMEOUT = getattr(
+  settings, 'SSHKEY_SHARD_CACHE_TIMEOUT', 300)
+SSHKEY_LOOKUP_MAX_LIMIT = getattr(
+  settings, 'SSHKEY_LOOKUP_MAX_LIMIT', 1000)
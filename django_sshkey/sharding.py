@@ -0,0 +1,372 @@
+# Copyright (c) 2014-2016, Clemson University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of Clemson University nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+'''
+Sharding keys across databases.
+
+When SSHKEY_SHARDS lists database aliases, each user's keys are kept in one
+of them: the one rebalance_sshkeys last moved them to, if any, and otherwise
+the shard that the user's id falls to.  ShardRouter sends keys that are
+saved or deleted to their owner's shard.  Lookups for one user's keys query
+that shard alone; others query every shard at once and merge the results.
+Users, and everything else, stay in the default database, and key ids come
+from one sequence there so that they are unique across shards.
+'''
+
+import os
+import threading
+import time
+try:
+  import queue
+except ImportError:  # Python 2
+  import Queue as queue
+from django.contrib.auth.models import User
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import Max
+from django_sshkey import cache as lookup_cache, deadline, replicas, settings
+
+HOME_KEY = 'django_sshkey.sharding.home.%s'
+
+_lock = threading.Lock()
+_pool = {'pid': None, 'queues': {}}
+
+
+def enabled():
+  return bool(settings.SSHKEY_SHARDS)
+
+
+def placement(user_id):
+  '''Return the shard that a user's keys go to unless moved elsewhere'''
+  shards = settings.SSHKEY_SHARDS
+  return shards[user_id % len(shards)]
+
+
+def home(user_id):
+  '''
+  Return the alias of the database that holds a user's keys.  Where
+  rebalance_sshkeys moved them, if anywhere, is cached for
+  SSHKEY_SHARD_CACHE_TIMEOUT seconds.
+  '''
+  if not enabled():
+    return DEFAULT_DB_ALIAS
+  from django_sshkey.models import UserKeyShard
+  cache = lookup_cache.get_cache()
+  key = HOME_KEY % user_id
+  database = cache.get(key)
+  if database is None:
+    moved = UserKeyShard.objects.filter(user_id=user_id)
+    database = moved.values_list('database', flat=True).first() or ''
+    cache.set(key, database, settings.SSHKEY_SHARD_CACHE_TIMEOUT)
+  return database or placement(user_id)
+
+
+def locate(username):
+  '''
+  Return the id of the user named username and the alias of the database
+  that holds their keys, or None if there is no such user.  The answer is
+  kept in the lookup cache when that is enabled, until keys or users change.
+  '''
+  query = ('shard', username)
+  if lookup_cache.enabled():
+    entry = lookup_cache.get(query)
+    if entry is not None:
+      return entry[None]
+  found = User.objects.filter(username=username).values_list(
+    'id', 'sshkey_shard__database').first()
+  if found is not None:
+    found = (found[0], found[1] or placement(found[0]))
+  if lookup_cache.enabled():
+    lookup_cache.store(query, {None: found})
+  return found
+
+
+def for_username(keys, username):
+  '''Narrow keys to those of the user named username, on their shard'''
+  found = locate(username)
+  if found is None:
+    return keys.none()
+  user_id, database = found
+  return keys.filter(user_id=user_id).using(database)
+
+
+def user_keys(user, keys=None):
+  '''Narrow keys (by default, all of them) to user's, on their shard'''
+  if keys is None:
+    from django_sshkey.models import UserKey
+    keys = UserKey.objects.all()
+  keys = keys.filter(user=user)
+  if enabled():
+    keys = keys.using(home(user.pk))
+  return keys
+
+
+def with_users(keys):
+  '''Fetch the owners of keys along with them'''
+  # Users cannot be joined to keys in another database
+  if enabled():
+    return keys.prefetch_related('user')
+  return keys.select_related('user')
+
+
+def spread(keys):
+  '''Return keys once for every shard they may be on'''
+  if not enabled() or keys._db is not None:
+    return [keys]
+  return [keys.using(alias) for alias in settings.SSHKEY_SHARDS]
+
+
+def row_id(row):
+  # Keys, or rows of values_list() that start with the id
+  return row.id if hasattr(row, 'id') else row[0]
+
+
+def worker_queue(alias):
+  '''
+  Return the queue of jobs for this process's workers on shard alias,
+  starting them if need be.
+  '''
+  with _lock:
+    # A forked worker inherits the queues but not the threads
+    if _pool['pid'] != os.getpid():
+      _pool.update(pid=os.getpid(), queues={})
+    q = _pool['queues'].get(alias)
+    if q is None:
+      q = queue.Queue()
+      for i in range(settings.SSHKEY_SHARD_WORKERS):
+        thread = threading.Thread(target=work, args=(q,),
+                                  name='django_sshkey.sharding.%s' % alias)
+        thread.daemon = True
+        thread.start()
+      _pool['queues'][alias] = q
+    return q
+
+
+def work(q):
+  # Connections are kept open between jobs, unless broken by an error
+  while True:
+    job, done = q.get()
+    try:
+      done.put(job())
+    finally:
+      for alias in (job.alias, DEFAULT_DB_ALIAS):
+        connection = connections[alias]
+        if connection.errors_occurred and connection.connection is not None:
+          if connection.is_usable():
+            connection.errors_occurred = False
+          else:
+            connection.close()
+
+
+class Fetch(object):
+  '''A query of one shard for gather(), run by a worker or inline'''
+
+  def __init__(self, index, queryset, expires):
+    self.index = index
+    self.queryset = queryset
+    self.alias = queryset.db
+    self.expires = expires
+
+  def __call__(self):
+    try:
+      with deadline.limit(self.alias, self.expires):
+        return self.index, list(self.queryset), None
+    except Exception as e:
+      return self.index, None, e
+
+
+def gather(keys, expires=None):
+  '''
+  Return a list of keys, from every shard they may be on.
+
+  The shards are queried at once by this process's workers for each shard,
+  except those the calling thread is in a transaction on, which it queries
+  itself so that it sees its own writes.  The results of keys ordered by id
+  stay in order, and those of sliced keys stay within the slice's length.
+  '''
+  querysets = spread(keys)
+  results = [None] * len(querysets)
+  errors = []
+  done = queue.Queue()
+  for i, queryset in enumerate(querysets):
+    fetch = Fetch(i, queryset, expires)
+    if len(querysets) == 1 or connections[fetch.alias].in_atomic_block:
+      done.put(fetch())
+    else:
+      worker_queue(fetch.alias).put((fetch, done))
+  for i in range(len(querysets)):
+    timeout = None if expires is None else max(expires - time.time(), 0)
+    try:
+      index, fetched, error = done.get(timeout=timeout)
+    except queue.Empty:
+      raise deadline.DeadlineExceeded()
+    results[index] = fetched
+    if error is not None:
+      errors.append(error)
+  if errors:
+    raise errors[0]
+  rows = [row for result in results for row in result]
+  if len(querysets) > 1:
+    if keys.query.order_by:
+      rows.sort(key=row_id)
+    if keys.query.high_mark is not None:
+      del rows[keys.query.high_mark - keys.query.low_mark:]
+  return rows
+
+
+def get(**kwargs):
+  '''Return the key matching kwargs, from whichever shard holds it'''
+  from django_sshkey.models import UserKey
+  keys = gather(UserKey.objects.filter(**kwargs))
+  if not keys:
+    raise UserKey.DoesNotExist('UserKey matching query does not exist.')
+  return keys[0]
+
+
+def allocate_id():
+  '''Return a new key id, unique across shards'''
+  from django_sshkey.models import UserKeyId
+  return UserKeyId.objects.create().id
+
+
+def reserve_ids():
+  '''
+  Make allocate_id() return ids above those of all existing keys, such as
+  keys added before sharding was enabled.
+  '''
+  from django.core.management.color import no_style
+  from django_sshkey.models import UserKey, UserKeyId
+  top = 0
+  for alias in sources():
+    top = max(top, UserKey.objects.using(alias).aggregate(
+      top=Max('id'))['top'] or 0)
+  if top <= (UserKeyId.objects.aggregate(top=Max('id'))['top'] or 0):
+    return
+  UserKeyId.objects.create(id=top)
+  connection = connections[DEFAULT_DB_ALIAS]
+  with connection.cursor() as cursor:
+    for sql in connection.ops.sequence_reset_sql(no_style(), [UserKeyId]):
+      cursor.execute(sql)
+
+
+def sources():
+  # Where keys may be: the shards, and the default database they were in
+  # before sharding was enabled.
+  aliases = list(settings.SSHKEY_SHARDS)
+  if DEFAULT_DB_ALIAS not in aliases:
+    aliases.append(DEFAULT_DB_ALIAS)
+  return aliases
+
+
+def move(user_id, database):
+  '''
+  Move a user's keys to the database alias, and keep them there from now
+  on; returns how many keys moved.
+
+  Keys are copied before they are deleted, so lookups find them throughout,
+  and moving them again finishes a move that was interrupted.
+  '''
+  from django_sshkey.models import UserKey, UserKeyShard
+  moving = {}
+  for alias in set(sources() + [home(user_id)]) - set([database]):
+    keys = list(UserKey.objects.using(alias).filter(user_id=user_id))
+    if keys:
+      moving[alias] = keys
+  with transaction.atomic(using=database):
+    for keys in moving.values():
+      ids = [key.id for key in keys]
+      copied = set(UserKey.objects.using(database).filter(
+        id__in=ids).values_list('id', flat=True))
+      UserKey.objects.using(database).bulk_create(
+        [key for key in keys if key.id not in copied])
+  if database == placement(user_id):
+    UserKeyShard.objects.filter(user_id=user_id).delete()
+  else:
+    UserKeyShard.objects.update_or_create(
+      user_id=user_id, defaults={'database': database})
+  lookup_cache.get_cache().delete(HOME_KEY % user_id)
+  count = 0
+  for alias, keys in moving.items():
+    count += len(keys)
+    UserKey.objects.using(alias).filter(
+      id__in=[key.id for key in keys]).delete()
+  lookup_cache.invalidate()
+  replicas.pin()
+  return count
+
+
+def rebalance():
+  '''
+  Move every user's keys that are not on their shard, e.g. after shards
+  were added to SSHKEY_SHARDS; returns how many keys moved.
+  '''
+  from django_sshkey.models import UserKey
+  count = 0
+  for alias in sources():
+    user_ids = UserKey.objects.using(alias).values_list('user_id', flat=True)
+    for user_id in set(user_ids):
+      database = home(user_id)
+      if database != alias:
+        count += move(user_id, database)
+  return count
+
+
+class ShardRouter(object):
+  '''
+  Database router that keeps each key in its owner's shard.
+
+  Only keys and users given as hints are routed: querysets of keys read the
+  default database unless spread over the shards or narrowed to a user's.
+  '''
+
+  def route(self, model, instance):
+    from django_sshkey.models import UserKey
+    if not enabled() or instance is None:
+      return None
+    if issubclass(model, UserKey):
+      if isinstance(instance, UserKey):
+        return instance._state.db or home(instance.user_id)
+      if isinstance(instance, User):
+        return home(instance.pk)
+    elif isinstance(instance, UserKey):
+      # The owner of a key, or the like
+      return DEFAULT_DB_ALIAS
+    return None
+
+  def db_for_read(self, model, **hints):
+    return self.route(model, hints.get('instance'))
+
+  def db_for_write(self, model, **hints):
+    return self.route(model, hints.get('instance'))
+
+  def allow_relation(self, obj1, obj2, **hints):
+    from django_sshkey.models import UserKey
+    if enabled() and (isinstance(obj1, UserKey) or
+                      isinstance(obj2, UserKey)):
+      return True
+    return None
@@ -27,18 +27,71 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
-from django.test import TestCase
+from django.test import (
+  RequestFactory,
+  TestCase,
+  TransactionTestCase,
+  override_settings,
+)
+from django.test.utils import CaptureQueriesContext
+from django.core import mail
+from django.core.mail.backends.base import BaseEmailBackend
+from django.db import OperationalError, connections, transaction
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
-from django.core.management import call_command
-from django.core.urlresolvers import reverse
-from django_sshkey.models import UserKey
-from django_sshkey import settings, util
+from django.core.management import CommandError, call_command
+try:
+  from django.urls import reverse
+except ImportError:  # Django < 1.10
+  from django.core.urlresolvers import reverse
+from django_sshkey.models import (
+  LookupEvent,
+  UserKey,
+  UserKeyNotification,
+  on_commit,
+  rebuild_authorized_keys_lines,
+  rebuild_key_metadata,
+  reconcile_owner_active,
+  revoke_keys,
+  set_key_metadata,
+)
+from django_sshkey import (
+  admin,
+  admission,
+  audit,
+  bloom,
+  cache,
+  coalesce,
+  deadline,
+  krl,
+  metrics,
+  models,
+  replicas,
+  settings,
+  sharding,
+  util,
+)
+from django_sshkey.util import pubkey_parse
+import base64
+import hashlib
+import json
 import os
 import shutil
+import struct
 import subprocess
 import tempfile
+import threading
+import time
 from unittest import skipIf
+try:
+  from queue import Queue
+except ImportError:  # Python 2
+  from Queue import Queue
+try:
+  from asgiref.sync import async_to_sync
+  from django_sshkey import async_views
+except (ImportError, SyntaxError):  # Python < 3.6 or Django < 3.1
+  async_views = None
 
 DEVNULL = open(os.devnull, 'w')
 
@@ -132,6 +185,15 @@ class BaseTestCase(TestCase):
       shutil.rmtree(cls.key_dir)
       cls.key_dir = None
 
+  def run_on_commit(self):
+    '''Run the on_commit() callbacks held back by the test's transaction'''
+    for alias in connections:
+      connection = connections[alias]
+      callbacks = getattr(connection, 'run_on_commit', [])
+      connection.run_on_commit = []
+      for savepoints, func in callbacks:
+        func()
+
 
 class UserKeyCreationTestCase(BaseTestCase):
   @classmethod
@@ -462,6 +524,67 @@ class PemTestCase(BaseTestCase):
     self.assertEqual(open(import_path).read().split()[:2],
                      open(self.key1_path + '.pub').read().split()[:2])
 
+  def test_import_invalid(self):
+    pem = open(self.key1_pem_path).read().splitlines()
+    pem[1] = pem[1][:8] + pem[1][12:]
+    key = UserKey(
+      user=self.user1,
+      name='name',
+      key='\n'.join(pem),
+    )
+    self.assertRaises(ValidationError, key.full_clean)
+
+  def test_export_not_rsa(self):
+    path = os.path.join(self.key_dir, 'ed25519')
+    ssh_keygen(type='ed25519', file=path)
+    key = UserKey(
+      user=self.user1,
+      name='name',
+      key=open(path + '.pub').read(),
+    )
+    self.assertRaises(TypeError, key.export, 'PEM')
+
+
+class Pkcs8TestCase(BaseTestCase):
+  @classmethod
+  def setUpClass(cls):
+    super(Pkcs8TestCase, cls).setUpClass()
+    cls.user1 = User.objects.create(username='user1')
+    cls.key1_path = os.path.join(cls.key_dir, 'key1')
+    cls.key1_pkcs8_path = os.path.join(cls.key_dir, 'key1.pkcs8')
+    ssh_keygen(comment='', file=cls.key1_path)
+    ssh_key_export(cls.key1_path, cls.key1_pkcs8_path, 'PKCS8')
+
+  @classmethod
+  def tearDownClass(cls):
+    User.objects.all().delete()
+    super(Pkcs8TestCase, cls).tearDownClass()
+
+  def tearDown(self):
+    UserKey.objects.all().delete()
+
+  def test_import(self):
+    key = UserKey(
+      user=self.user1,
+      name='name',
+      key=open(self.key1_pkcs8_path).read(),
+    )
+    key.full_clean()
+    key.save()
+    self.assertEqual(key.key.split()[:2],
+                     open(self.key1_path + '.pub').read().split()[:2])
+
+  def test_export(self):
+    key = UserKey(
+      user=self.user1,
+      name='name',
+      key=open(self.key1_path + '.pub').read(),
+    )
+    key.full_clean()
+    key.save()
+    self.assertEqual(open(self.key1_pkcs8_path).read().strip(),
+                     key.export('PKCS8'))
+
 
 class UserKeyLookupTestCase(BaseTestCase):
   @classmethod
@@ -552,6 +675,63 @@ class UserKeyLookupTestCase(BaseTestCase):
       ),
     ])
 
+  def test_lookup_by_username_and_fingerprint(self):
+    url = reverse('django_sshkey.views.lookup')
+    fingerprint = ssh_fingerprint(self.key1_path + '.pub', hash='legacy')
+    response = self.client.get(url, {
+      'username': self.user1.username,
+      'fingerprint': fingerprint,
+    })
+    self.assertHasKeys(response, [
+      'command="user1 %s" %s' % (
+        self.key1.id,
+        read_pubkey(self.key1_path + '.pub')
+      ),
+    ])
+
+  def test_lookup_by_username_and_fingerprint_other_user(self):
+    url = reverse('django_sshkey.views.lookup')
+    fingerprint = ssh_fingerprint(self.key1_path + '.pub', hash='legacy')
+    response = self.client.get(url, {
+      'username': self.user2.username,
+      'fingerprint': fingerprint,
+    })
+    self.assertHasKeys(response, [])
+
+  def test_lookup_by_key(self):
+    url = reverse('django_sshkey.views.lookup')
+    key_type, key = read_pubkey(self.key1_path + '.pub').split()[:2]
+    expected = [
+      'command="user1 %s" %s' % (
+        self.key1.id,
+        read_pubkey(self.key1_path + '.pub')
+      ),
+    ]
+    response = self.client.get(url, {'key_type': key_type, 'key': key})
+    self.assertHasKeys(response, expected)
+    response = self.client.get(url, {'key': key})
+    self.assertHasKeys(response, expected)
+    response = self.client.get(url, {'key': key, 'username': 'user2'})
+    self.assertHasKeys(response, [])
+
+  def test_lookup_by_key_unencoded(self):
+    url = reverse('django_sshkey.views.lookup')
+    key = read_pubkey(self.key1_path + '.pub').split()[1]
+    response = self.client.get(url + '?key=' + key.replace('/', '%2F'))
+    self.assertHasKeys(response, [
+      'command="user1 %s" %s' % (
+        self.key1.id,
+        read_pubkey(self.key1_path + '.pub')
+      ),
+    ])
+
+  def test_lookup_by_key_invalid(self):
+    url = reverse('django_sshkey.views.lookup')
+    key_type, key = read_pubkey(self.key1_path + '.pub').split()[:2]
+    for data in ({'key': 'x'}, {'key': key, 'key_type': 'ssh-dss'}):
+      response = self.client.get(url, data)
+      self.assertEqual(response.status_code, 400)
+
   def test_lookup_by_username_single_result(self):
     url = reverse('django_sshkey.views.lookup')
     username = self.user2.username
@@ -588,6 +768,1827 @@ class UserKeyLookupTestCase(BaseTestCase):
     response = self.client.get(url, {'username': 'batman'})
     self.assertHasKeys(response, [])
 
+  def get_ndjson(self, data):
+    url = reverse('django_sshkey.views.lookup')
+    data = dict(data, format='ndjson')
+    response = self.client.get(url, data)
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+    content = response.content.decode('ascii')
+    return [json.loads(line) for line in content.splitlines()]
+
+  def test_lookup_ndjson(self):
+    objects = self.get_ndjson({'username': self.user2.username})
+    self.assertEqual([{
+      'id': self.key3.id,
+      'username': 'user2',
+      'fingerprint': self.key3.fingerprint,
+      'key': self.key3.key,
+      'last_used': None,
+    }], objects)
+
+  def test_lookup_ndjson_paginated(self):
+    ids = sorted([self.key1.id, self.key2.id, self.key3.id])
+    objects = self.get_ndjson({'limit': 2})
+    self.assertEqual(ids[:2], [o['id'] for o in objects])
+    objects = self.get_ndjson({'limit': 2, 'after_id': objects[-1]['id']})
+    self.assertEqual(ids[2:], [o['id'] for o in objects])
+    objects = self.get_ndjson({'after_id': ids[0], 'before_id': ids[2]})
+    self.assertEqual(ids[1:2], [o['id'] for o in objects])
+
+  def test_lookup_invalid_page(self):
+    url = reverse('django_sshkey.views.lookup')
+    for data in ({'limit': 0}, {'limit': 'x'}, {'after_id': 'x'},
+                 {'format': 'xml'}, {'after_id': 2 ** 63},
+                 {'before_id': -2 ** 63 - 1}):
+      response = self.client.get(url, data)
+      self.assertEqual(response.status_code, 400)
+
+  def test_lookup_limit_clamped(self):
+    original = settings.SSHKEY_LOOKUP_MAX_LIMIT
+    settings.SSHKEY_LOOKUP_MAX_LIMIT = 2
+    try:
+      self.assertEqual(2, len(self.get_ndjson({'limit': 10 ** 30})))
+      objects = self.get_ndjson({'limit': 3, 'after_id': 2 ** 63 - 1})
+      self.assertEqual([], objects)
+    finally:
+      settings.SSHKEY_LOOKUP_MAX_LIMIT = original
+
+  def assertHasCompressedKeys(self, response, encoding):
+    self.assertEqual(response['Content-Encoding'], encoding)
+    self.assertIn('Accept-Encoding', response['Vary'])
+    if response.streaming:
+      content = b''.join(response.streaming_content)
+    else:
+      content = response.content
+    content = util.decompress(content, encoding).decode('ascii')
+    expected = self.client.get(reverse('django_sshkey.views.lookup'))
+    self.assertEqual(expected.content.decode('ascii'), content)
+
+  def test_lookup_all_gzip(self):
+    url = reverse('django_sshkey.views.lookup')
+    response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')
+    self.assertHasCompressedKeys(response, 'gzip')
+
+  def test_lookup_all_deflate(self):
+    url = reverse('django_sshkey.views.lookup')
+    response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip;q=0, deflate')
+    self.assertHasCompressedKeys(response, 'deflate')
+
+  def test_lookup_all_cached_gzip(self):
+    original_timeout = settings.SSHKEY_LOOKUP_CACHE_TIMEOUT
+    settings.SSHKEY_LOOKUP_CACHE_TIMEOUT = 60
+    try:
+      url = reverse('django_sshkey.views.lookup')
+      response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')
+      self.assertHasCompressedKeys(response, 'gzip')
+      entry = cache.get(('all', 'text', ()))
+      self.assertEqual(set([None, 'gzip', 'served']), set(entry))
+      response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')
+      self.assertEqual(entry['gzip'], response.content)
+      self.key1.touch()
+      self.assertEqual(entry, cache.get(('all', 'text', ())))
+      self.key1.save()
+      self.run_on_commit()
+      self.assertIsNone(cache.get(('all', 'text', ())))
+    finally:
+      settings.SSHKEY_LOOKUP_CACHE_TIMEOUT = original_timeout
+
+  def get_metrics(self):
+    response = self.client.get(reverse('django_sshkey.views.lookup_metrics'))
+    self.assertEqual(response.status_code, 200)
+    samples = {}
+    for line in response.content.decode('ascii').splitlines():
+      if not line.startswith('#'):
+        name, value = line.rsplit(' ', 1)
+        samples[name] = float(value)
+    return samples
+
+  def test_metrics_disabled(self):
+    response = self.client.get(reverse('django_sshkey.views.lookup_metrics'))
+    self.assertEqual(response.status_code, 404)
+
+  def test_metrics(self):
+    original_metrics = settings.SSHKEY_METRICS
+    settings.SSHKEY_METRICS = True
+    metrics.registry.reset()
+    try:
+      url = reverse('django_sshkey.views.lookup')
+      self.client.get(url)
+      response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')
+      b''.join(response.streaming_content)
+      self.client.get(url, {'username': 'user2'})
+      self.client.post(url, data=str(self.key1.id),
+                       content_type='text/plain')
+      samples = self.get_metrics()
+    finally:
+      settings.SSHKEY_METRICS = original_metrics
+    self.assertEqual(
+      2, samples['sshkey_lookup_requests_total{mode="all"}'])
+    self.assertEqual(
+      1, samples['sshkey_lookup_requests_total{mode="username"}'])
+    self.assertEqual(
+      1, samples['sshkey_lookup_requests_total{mode="touch"}'])
+    self.assertEqual(
+      2, samples['sshkey_lookup_duration_seconds_count{mode="all"}'])
+    self.assertEqual(
+      2, samples['sshkey_lookup_db_queries_total{mode="all"}'])
+    self.assertEqual(
+      1, samples['sshkey_lookup_db_queries_total{mode="username"}'])
+    self.assertEqual(
+      2, samples['sshkey_lookup_response_bytes_count{mode="all"}'])
+    self.assertEqual(
+      2, samples['sshkey_lookup_response_bytes_bucket{mode="all",le="+Inf"}'])
+    username_bytes = len(read_pubkey(self.key3_path + '.pub')) + len(
+      'command="user2 %s" \n' % self.key3.id)
+    self.assertEqual(
+      username_bytes,
+      samples['sshkey_lookup_response_bytes_sum{mode="username"}'])
+
+  def test_metrics_cache(self):
+    original_metrics = settings.SSHKEY_METRICS
+    original_timeout = settings.SSHKEY_LOOKUP_CACHE_TIMEOUT
+    settings.SSHKEY_METRICS = True
+    settings.SSHKEY_LOOKUP_CACHE_TIMEOUT = 60
+    metrics.registry.reset()
+    try:
+      url = reverse('django_sshkey.views.lookup')
+      self.client.get(url, {'username': 'user1'})
+      self.client.get(url, {'username': 'user1'})
+      self.client.get(url, {'username': 'user1'})
+      samples = self.get_metrics()
+    finally:
+      settings.SSHKEY_METRICS = original_metrics
+      settings.SSHKEY_LOOKUP_CACHE_TIMEOUT = original_timeout
+    self.assertEqual(1, samples['sshkey_lookup_cache_total{result="miss"}'])
+    self.assertEqual(2, samples['sshkey_lookup_cache_total{result="hit"}'])
+
+  def test_profile(self):
+    original = (settings.SSHKEY_PROFILE_RATE, settings.SSHKEY_PROFILE_DIR,
+                settings.SSHKEY_PROFILE_KEEP)
+    profile_dir = tempfile.mkdtemp(dir=self.key_dir)
+    settings.SSHKEY_PROFILE_RATE = 1
+    settings.SSHKEY_PROFILE_DIR = profile_dir
+    settings.SSHKEY_PROFILE_KEEP = 2
+    try:
+      url = reverse('django_sshkey.views.lookup')
+      response = self.client.get(url, {'username': 'user2'})
+      self.assertEqual(1, len(os.listdir(profile_dir)))
+      response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')
+      self.client.post(url, data=str(self.key1.id),
+                       content_type='text/plain')
+    finally:
+      (settings.SSHKEY_PROFILE_RATE, settings.SSHKEY_PROFILE_DIR,
+       settings.SSHKEY_PROFILE_KEEP) = original
+    dumps = sorted(os.listdir(profile_dir))
+    self.assertEqual(2, len(dumps))
+    self.assertTrue(any('-touch-' in name for name in dumps))
+    timing = [part.split(';')[0]
+              for part in response['Server-Timing'].split(', ')]
+    self.assertEqual(['db', 'render', 'total'], timing)
+    self.assertFalse(response.streaming)
+    self.assertHasCompressedKeys(response, 'gzip')
+
+  def test_profile_disabled(self):
+    url = reverse('django_sshkey.views.lookup')
+    response = self.client.get(url)
+    self.assertNotIn('Server-Timing', response)
+
+
+@skipIf(async_views is None, 'Python 3.6+ and Django 3.1+ required')
+class AsyncLookupTestCase(BaseTestCase):
+  @classmethod
+  def setUpClass(cls):
+    super(AsyncLookupTestCase, cls).setUpClass()
+    cls.original_options = settings.SSHKEY_AUTHORIZED_KEYS_OPTIONS
+    settings.SSHKEY_AUTHORIZED_KEYS_OPTIONS = 'command="{username} {key_id}"'
+    cls.user1 = User.objects.create(username='user1')
+    cls.user2 = User.objects.create(username='user2')
+    cls.key1 = UserKey(user=cls.user1, key=random_pubkey('key1'))
+    cls.key1.full_clean()
+    cls.key1.save()
+    cls.key2 = UserKey(user=cls.user2, key=random_pubkey('key2'))
+    cls.key2.full_clean()
+    cls.key2.save()
+
+  @classmethod
+  def tearDownClass(cls):
+    User.objects.all().delete()
+    settings.SSHKEY_AUTHORIZED_KEYS_OPTIONS = cls.original_options
+    super(AsyncLookupTestCase, cls).tearDownClass()
+
+  def lookup(self, method='get', *args, **kwargs):
+    request = getattr(RequestFactory(), method)('/sshkey/lookup', *args,
+                                                **kwargs)
+    return async_to_sync(async_views.lookup)(request)
+
+  def lines(self, response):
+    self.assertEqual(200, response.status_code)
+    return response.content.decode('ascii').splitlines()
+
+  def test_lookup(self):
+    self.assertEqual(sorted([self.key1.authorized_keys_line,
+                             self.key2.authorized_keys_line]),
+                     sorted(self.lines(self.lookup('get'))))
+    self.assertEqual([self.key1.authorized_keys_line],
+                     self.lines(self.lookup('get', {'username': 'user1'})))
+    response = self.lookup('get', {'fingerprint': self.key2.fingerprint})
+    self.assertEqual([self.key2.authorized_keys_line], self.lines(response))
+    response = self.lookup('get', {'format': 'ndjson', 'limit': 1})
+    objects = [json.loads(line) for line in self.lines(response)]
+    self.assertEqual([min(self.key1.id, self.key2.id)],
+                     [o['id'] for o in objects])
+
+  def test_lookup_gzip(self):
+    response = self.lookup('get', {'username': 'user2'},
+                           HTTP_ACCEPT_ENCODING='gzip')
+    self.assertEqual('gzip', response['Content-Encoding'])
+    content = util.decompress(response.content, 'gzip').decode('ascii')
+    self.assertEqual([self.key2.authorized_keys_line], content.splitlines())
+
+  def test_lookup_invalid(self):
+    self.assertEqual(400, self.lookup('get', {'limit': 'x'}).status_code)
+    self.assertEqual(405, self.lookup('put').status_code)
+
+  def test_touch(self):
+    response = self.lookup('post', data=str(self.key1.id),
+                           content_type='text/plain')
+    self.assertEqual(200, response.status_code)
+    key = UserKey.objects.get(id=self.key1.id)
+    self.assertEqual(str(key.last_used), response.content.decode('ascii'))
+
+
+class ReplicaTestCase(BaseTestCase):
+  multi_db = True
+
+  @classmethod
+  def setUpClass(cls):
+    super(ReplicaTestCase, cls).setUpClass()
+    cls.user1 = User.objects.create(username='user1')
+    User.objects.using('replica').create(id=cls.user1.id, username='user1')
+    cls.key1 = UserKey(user=cls.user1, key=random_pubkey('key1'))
+    cls.key1.full_clean()
+    cls.key1.save()
+    cls.key1.save(using='replica')
+    # Not replicated yet
+    cls.key2 = UserKey(user=cls.user1, key=random_pubkey('key2'))
+    cls.key2.full_clean()
+    cls.key2.save()
+
+  @classmethod
+  def tearDownClass(cls):
+    UserKey.objects.using('replica').all().delete()
+    User.objects.using('replica').all().delete()
+    User.objects.all().delete()
+    super(ReplicaTestCase, cls).tearDownClass()
+
+  def setUp(self):
+    self.original = (settings.SSHKEY_LOOKUP_REPLICAS,
+                     settings.SSHKEY_LOOKUP_REPLICA_PIN)
+    settings.SSHKEY_LOOKUP_REPLICAS = ('replica',)
+    # Pins left by other tests
+    cache.get_cache().clear()
+
+  def tearDown(self):
+    (settings.SSHKEY_LOOKUP_REPLICAS,
+     settings.SSHKEY_LOOKUP_REPLICA_PIN) = self.original
+    replicas._down.clear()
+
+  def lookup_names(self):
+    response = self.client.get(reverse('django_sshkey.views.lookup'),
+                               {'format': 'ndjson'})
+    return [json.loads(line)['key'].split()[-1]
+            for line in response.content.decode('ascii').splitlines()]
+
+  def test_no_replicas(self):
+    settings.SSHKEY_LOOKUP_REPLICAS = ()
+    self.assertEqual(['key1', 'key2'], self.lookup_names())
+
+  def test_lookup_from_replica(self):
+    self.assertEqual(['key1'], self.lookup_names())
+    response = self.client.get(reverse('django_sshkey.views.lookup_tree'),
+                               {'keys': ''})
+    self.assertEqual(1, len(response.content.splitlines()))
+
+  def test_touch_on_primary(self):
+    url = reverse('django_sshkey.views.lookup')
+    response = self.client.post(url, data=str(self.key2.id),
+                                content_type='text/plain')
+    self.assertEqual(200, response.status_code)
+    self.assertIsNotNone(UserKey.objects.get(id=self.key2.id).last_used)
+    self.assertEqual(['key1'], self.lookup_names())
+
+  def test_read_your_writes(self):
+    settings.SSHKEY_LOOKUP_REPLICA_PIN = 60
+    key3 = UserKey(user=self.user1, key=random_pubkey('key3'))
+    key3.full_clean()
+    key3.save()
+    self.run_on_commit()
+    self.assertEqual(['key1', 'key2', 'key3'], self.lookup_names())
+    cache.get_cache().clear()
+    self.assertEqual(['key1'], self.lookup_names())
+
+  def test_pins_follow_keys(self):
+    settings.SSHKEY_LOOKUP_REPLICA_PIN = 60
+    key3 = UserKey(user=self.user1, key=random_pubkey('key3'))
+    key3.full_clean()
+    key3.save()
+    self.run_on_commit()
+    for query in (None,
+                  ('username', 'user1', 'all', 'text', ()),
+                  ('fingerprint', key3.fingerprint, 'text', ()),
+                  ('key', key3.blob_digest, 'text', ())):
+      self.assertEqual('default', replicas.lookup_database(query))
+    for query in (('username', 'user2', 'all', 'text', ()),
+                  ('fingerprint', self.key1.fingerprint, 'text', ())):
+      self.assertEqual('replica', replicas.lookup_database(query))
+    replicas.pin()
+    self.assertEqual('default', replicas.lookup_database(query))
+
+  def test_unhealthy_replica(self):
+    connection = connections['replica']
+
+    def ensure_connection():
+      raise OperationalError('unable to open database file')
+    connection.ensure_connection = ensure_connection
+    try:
+      self.assertEqual(['key1', 'key2'], self.lookup_names())
+    finally:
+      del connection.ensure_connection
+    # Not retried until SSHKEY_LOOKUP_REPLICA_RETRY has passed
+    self.assertEqual(['key1', 'key2'], self.lookup_names())
+    replicas._down.clear()
+    self.assertEqual(['key1'], self.lookup_names())
+
+  def test_cache_hit_chooses_no_database(self):
+    original = settings.SSHKEY_LOOKUP_CACHE_TIMEOUT
+    settings.SSHKEY_LOOKUP_CACHE_TIMEOUT = 60
+    self.assertEqual(['key1'], self.lookup_names())
+    chosen = []
+    lookup_database = replicas.lookup_database
+    replicas.lookup_database = lambda query=None: chosen.append(query)
+    try:
+      self.assertEqual(['key1'], self.lookup_names())
+    finally:
+      replicas.lookup_database = lookup_database
+      settings.SSHKEY_LOOKUP_CACHE_TIMEOUT = original
+    self.assertEqual([], chosen)
+
+  def test_queries_counted_on_replica(self):
+    queries = metrics.QueryCounter()
+    try:
+      UserKey.objects.using('default').count()
+      UserKey.objects.using('replica').count()
+      # Counted without the debug cursor's query log
+      self.assertFalse(connections['default'].queries_logged)
+    finally:
+      queries.stop()
+    self.assertEqual(2, queries.count)
+    UserKey.objects.count()
+    self.assertEqual(2, queries.count)
+
+
+class CoalesceTestCase(BaseTestCase):
+  @classmethod
+  def setUpClass(cls):
+    super(CoalesceTestCase, cls).setUpClass()
+    cls.user1 = User.objects.create(username='user1')
+    cls.key1 = UserKey(user=cls.user1, key=random_pubkey('key1'))
+    cls.key1.full_clean()
+    cls.key1.save()
+
+  @classmethod
+  def tearDownClass(cls):
+    User.objects.all().delete()
+    super(CoalesceTestCase, cls).tearDownClass()
+
+  def setUp(self):
+    self.original = settings.SSHKEY_LOOKUP_COALESCE
+
+  def tearDown(self):
+    settings.SSHKEY_LOOKUP_COALESCE = self.original
+
+  def test_group_shares_result(self):
+    group = coalesce.Group()
+    release = threading.Event()
+    calls = []
+    results = []
+
+    def func():
+      calls.append(None)
+      release.wait()
+      return 'result'
+
+    def call():
+      results.append(group.do('key', func))
+    threads = [threading.Thread(target=call) for i in range(5)]
+    threads[0].start()
+    while 'key' not in group.calls:
+      time.sleep(0.001)
+    for thread in threads[1:]:
+      thread.start()
+    while group.calls['key'].waiters < 4:
+      time.sleep(0.001)
+    release.set()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(1, len(calls))
+    self.assertEqual(['result'] * 5, results)
+    self.assertEqual({}, group.calls)
+
+  def test_group_wait_bounded(self):
+    original = settings.SSHKEY_LOOKUP_COALESCE_TIMEOUT
+    group = coalesce.Group()
+    release = threading.Event()
+    thread = threading.Thread(target=group.do,
+                              args=('key', lambda: release.wait()))
+    thread.start()
+    try:
+      while 'key' not in group.calls:
+        time.sleep(0.001)
+      self.assertRaises(deadline.DeadlineExceeded, group.do, 'key',
+                        lambda: 'result', time.time() + 0.05)
+      settings.SSHKEY_LOOKUP_COALESCE_TIMEOUT = 0.05
+      self.assertRaises(deadline.DeadlineExceeded, group.do, 'key',
+                        lambda: 'result')
+    finally:
+      settings.SSHKEY_LOOKUP_COALESCE_TIMEOUT = original
+      release.set()
+      thread.join()
+
+  def test_group_shares_error(self):
+    group = coalesce.Group()
+    release = threading.Event()
+    errors = []
+
+    def func():
+      release.wait()
+      raise ValueError('failed')
+
+    def call():
+      try:
+        group.do('key', func)
+      except ValueError as e:
+        errors.append(e)
+    threads = [threading.Thread(target=call) for i in range(2)]
+    threads[0].start()
+    while 'key' not in group.calls:
+      time.sleep(0.001)
+    threads[1].start()
+    while group.calls['key'].waiters < 1:
+      time.sleep(0.001)
+    release.set()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(2, len(errors))
+    self.assertIs(errors[0], errors[1])
+
+  def test_lookup(self):
+    url = reverse('django_sshkey.views.lookup')
+    expected = self.client.get(url).content
+    for mode in ('process', 'cache'):
+      settings.SSHKEY_LOOKUP_COALESCE = mode
+      self.assertEqual(expected, self.client.get(url).content)
+      response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')
+      self.assertEqual(expected, util.decompress(response.content, 'gzip'))
+
+  def test_lookup_waits_for_other_process(self):
+    settings.SSHKEY_LOOKUP_COALESCE = 'cache'
+    backend = cache.get_cache()
+    key = cache.cache_key(backend, ('coalesce', 'all', 'text', ()))
+    backend.set(key + '.lock', True)
+    backend.set(key + '.result', {None: b'shared\n', 'served': (1, ())})
+    try:
+      with self.assertNumQueries(0):
+        response = self.client.get(reverse('django_sshkey.views.lookup'))
+    finally:
+      backend.delete(key + '.lock')
+      backend.delete(key + '.result')
+    self.assertEqual(b'shared\n', response.content)
+
+
+class AdmissionTestCase(BaseTestCase):
+  @classmethod
+  def setUpClass(cls):
+    super(AdmissionTestCase, cls).setUpClass()
+    cls.user1 = User.objects.create(username='user1')
+    cls.key1 = UserKey(user=cls.user1, key=random_pubkey('key1'))
+    cls.key1.full_clean()
+    cls.key1.save()
+
+  @classmethod
+  def tearDownClass(cls):
+    User.objects.all().delete()
+    super(AdmissionTestCase, cls).tearDownClass()
+
+  def setUp(self):
+    self.original = (settings.SSHKEY_LOOKUP_CONCURRENCY,
+                     settings.SSHKEY_LOOKUP_STALE_TIMEOUT)
+
+  def tearDown(self):
+    (settings.SSHKEY_LOOKUP_CONCURRENCY,
+     settings.SSHKEY_LOOKUP_STALE_TIMEOUT) = self.original
+
+  def lookup(self, query={}, **extra):
+    url = reverse('django_sshkey.views.lookup')
+    return self.client.get(url, query, **extra)
+
+  def test_admit(self):
+    settings.SSHKEY_LOOKUP_CONCURRENCY = {'all': 1}
+    slot = admission.admit('all')
+    self.assertRaises(admission.Overloaded, admission.admit, 'all')
+    admission.admit('fingerprint').release()
+    slot.release()
+    slot.release()
+    self.assertEqual(0, admission.active('all'))
+    admission.admit('all').release()
+
+  def test_modes_limited_separately(self):
+    settings.SSHKEY_LOOKUP_CONCURRENCY = {'all': 1, 'fingerprint': 16}
+    slots = [admission.admit('all')]
+    try:
+      self.assertEqual(503, self.lookup().status_code)
+      response = self.lookup({'fingerprint': self.key1.fingerprint})
+      self.assertEqual(200, response.status_code)
+    finally:
+      for slot in slots:
+        slot.release()
+
+  def test_unavailable(self):
+    settings.SSHKEY_LOOKUP_CONCURRENCY = {'all': 0}
+    response = self.lookup()
+    self.assertEqual(503, response.status_code)
+    self.assertEqual('1', response['Retry-After'])
+    response = self.lookup({'fingerprint': self.key1.fingerprint})
+    self.assertEqual(200, response.status_code)
+    self.assertEqual(self.key1.key + '\n', response.content.decode('ascii'))
+
+  def test_stale(self):
+    settings.SSHKEY_LOOKUP_STALE_TIMEOUT = 60
+    expected = self.lookup().content
+    key2 = UserKey(user=self.user1, key=random_pubkey('key2'))
+    key2.full_clean()
+    key2.save()
+    settings.SSHKEY_LOOKUP_CONCURRENCY = {'all': 0}
+    with self.assertNumQueries(0):
+      response = self.lookup()
+    self.assertEqual(200, response.status_code)
+    self.assertEqual(expected, response.content)
+    self.assertIn('110', response['Warning'])
+    response = self.lookup(HTTP_ACCEPT_ENCODING='gzip')
+    self.assertEqual(expected, util.decompress(response.content, 'gzip'))
+    settings.SSHKEY_LOOKUP_CONCURRENCY = {'username': 0}
+    self.assertEqual(503, self.lookup({'username': 'user1'}).status_code)
+    key2.delete()
+
+  def test_stream_holds_slot(self):
+    response = self.lookup(HTTP_ACCEPT_ENCODING='gzip')
+    self.assertTrue(response.streaming)
+    self.assertEqual(1, admission.active('all'))
+    b''.join(response.streaming_content)
+    self.assertEqual(0, admission.active('all'))
+
+
+class DeadlineTestCase(BaseTestCase):
+  @classmethod
+  def setUpClass(cls):
+    super(DeadlineTestCase, cls).setUpClass()
+    cls.user1 = User.objects.create(username='user1')
+    cls.key1 = UserKey(user=cls.user1, key=random_pubkey('key1'))
+    cls.key1.full_clean()
+    cls.key1.save()
+
+  @classmethod
+  def tearDownClass(cls):
+    User.objects.all().delete()
+    super(DeadlineTestCase, cls).tearDownClass()
+
+  def setUp(self):
+    self.original = settings.SSHKEY_LOOKUP_TIMEOUT
+
+  def tearDown(self):
+    settings.SSHKEY_LOOKUP_TIMEOUT = self.original
+
+  def lookup(self, query={}, **extra):
+    url = reverse('django_sshkey.views.lookup')
+    return self.client.get(url, query, **extra)
+
+  def test_from_request(self):
+    request = RequestFactory().get('/', HTTP_X_SSHKEY_TIMEOUT='5')
+    self.assertEqual(105, deadline.from_request(request, 100))
+    settings.SSHKEY_LOOKUP_TIMEOUT = 2
+    self.assertEqual(102, deadline.from_request(request, 100))
+    request = RequestFactory().get('/', HTTP_X_SSHKEY_TIMEOUT='never')
+    self.assertEqual(102, deadline.from_request(request, 100))
+    settings.SSHKEY_LOOKUP_TIMEOUT = None
+    self.assertIsNone(deadline.from_request(request, 100))
+    request = RequestFactory().get('/', HTTP_X_SSHKEY_TIMEOUT='-1')
+    self.assertIsNone(deadline.from_request(request, 100))
+
+  def test_expired(self):
+    with self.assertNumQueries(0):
+      response = self.lookup(HTTP_X_SSHKEY_TIMEOUT='1e-9')
+    self.assertEqual(504, response.status_code)
+
+  def test_in_time(self):
+    response = self.lookup(HTTP_X_SSHKEY_TIMEOUT='60',
+                           HTTP_ACCEPT_ENCODING='gzip')
+    self.assertFalse(response.streaming)
+    self.assertEqual(self.key1.key + '\n',
+                     util.decompress(response.content, 'gzip').decode('ascii'))
+
+  @skipIf(connections['default'].vendor != 'sqlite',
+          'Deadlines are enforced differently by each database')
+  def test_query_cancelled(self):
+    sql = (
+      'WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c) '
+      'SELECT count(*) FROM (SELECT x FROM c LIMIT 100000000)'
+    )
+    start = time.time()
+    with self.assertRaises(deadline.DeadlineExceeded):
+      with deadline.limit('default', time.time() + 0.05):
+        with connections['default'].cursor() as cursor:
+          cursor.execute(sql)
+    self.assertLess(time.time() - start, 5)
+    with connections['default'].cursor() as cursor:
+      cursor.execute('SELECT 1')
+      self.assertEqual((1,), cursor.fetchone())
+
+  def test_client_timeout(self):
+    original = os.environ.get('SSHKEY_LOOKUP_TIMEOUT')
+    try:
+      os.environ['SSHKEY_LOOKUP_TIMEOUT'] = '2.5'
+      self.assertEqual(2.5, util.lookup_timeout())
+      os.environ['SSHKEY_LOOKUP_TIMEOUT'] = 'x'
+      self.assertIsNone(util.lookup_timeout())
+    finally:
+      if original is None:
+        del os.environ['SSHKEY_LOOKUP_TIMEOUT']
+      else:
+        os.environ['SSHKEY_LOOKUP_TIMEOUT'] = original
+
+
+class AuditTestCase(BaseTestCase):
+  @classmethod
+  def setUpClass(cls):
+    super(AuditTestCase, cls).setUpClass()
+    cls.user1 = User.objects.create(username='user1')
+    cls.key1 = UserKey(user=cls.user1, key=random_pubkey('key1'))
+    cls.key1.full_clean()
+    cls.key1.save()
+    cls.audit_path = os.path.join(cls.key_dir, 'audit-%d.log' % os.getpid())
+
+  @classmethod
+  def tearDownClass(cls):
+    User.objects.all().delete()
+    super(AuditTestCase, cls).tearDownClass()
+
+  def setUp(self):
+    self.original = (settings.SSHKEY_AUDIT, settings.SSHKEY_AUDIT_FILE,
+                     settings.SSHKEY_AUDIT_FLUSH_INTERVAL)
+    self.original_state = dict(audit._state)
+    settings.SSHKEY_AUDIT_FILE = os.path.join(self.key_dir, 'audit-{pid}.log')
+    # Queue events without a writer thread; the test flushes them itself.
+    self.queue = audit.queue.Queue(2)
+    audit._state.update(queue=self.queue, thread=None, pid=os.getpid(),
+                        file=None)
+
+  def tearDown(self):
+    (settings.SSHKEY_AUDIT, settings.SSHKEY_AUDIT_FILE,
+     settings.SSHKEY_AUDIT_FLUSH_INTERVAL) = self.original
+    if audit._state['file'] is not None:
+      audit._state['file'].close()
+    audit._state.clear()
+    audit._state.update(self.original_state)
+    if os.path.exists(self.audit_path):
+      os.unlink(self.audit_path)
+
+  def lookup(self, query={}, **extra):
+    url = reverse('django_sshkey.views.lookup')
+    return self.client.get(url, query, REMOTE_ADDR='192.0.2.1', **extra)
+
+  def read_log(self):
+    with open(self.audit_path) as f:
+      return [json.loads(line) for line in f]
+
+  def test_disabled(self):
+    settings.SSHKEY_AUDIT = None
+    self.lookup()
+    self.assertTrue(self.queue.empty())
+
+  def test_file(self):
+    settings.SSHKEY_AUDIT = 'file'
+    self.lookup({'username': 'user1', 'fingerprint': self.key1.fingerprint})
+    url = reverse('django_sshkey.views.lookup')
+    self.client.post(url, data=str(self.key1.id), content_type='text/plain',
+                     REMOTE_ADDR='192.0.2.1')
+    audit.flush()
+    lookup, touch = self.read_log()
+    self.assertEqual('lookup', lookup['event'])
+    self.assertEqual('username_fingerprint', lookup['mode'])
+    self.assertEqual('user1', lookup['username'])
+    self.assertEqual(self.key1.fingerprint, lookup['fingerprint'])
+    self.assertEqual('192.0.2.1', lookup['remote_addr'])
+    self.assertEqual(200, lookup['status'])
+    self.assertEqual(1, lookup['key_count'])
+    self.assertEqual([self.key1.id], lookup['key_ids'])
+    self.assertEqual('touch', touch['event'])
+    self.assertEqual(self.key1.id, touch['key_id'])
+    self.assertEqual((None, []), (touch['key_count'], touch['key_ids']))
+
+  def test_database(self):
+    settings.SSHKEY_AUDIT = 'database'
+    blob = self.key1.key.split()[1]
+    self.lookup({'key': blob})
+    with self.assertNumQueries(1):
+      audit.flush()
+    event = LookupEvent.objects.get()
+    self.assertEqual(('lookup', 'key', self.key1.blob_digest, 1,
+                      str(self.key1.id), 200),
+                     (event.event, event.mode, event.blob_digest,
+                      event.key_count, event.key_ids, event.status))
+
+  def test_key_ids_limited(self):
+    settings.SSHKEY_AUDIT = 'file'
+    original = settings.SSHKEY_AUDIT_KEY_IDS
+    settings.SSHKEY_AUDIT_KEY_IDS = 1
+    key2 = UserKey(user=self.user1, key=random_pubkey('key2'))
+    key2.full_clean()
+    key2.save()
+    try:
+      self.lookup({'limit': 2})
+    finally:
+      settings.SSHKEY_AUDIT_KEY_IDS = original
+    audit.flush()
+    event = self.read_log()[0]
+    self.assertEqual((2, [self.key1.id]),
+                     (event['key_count'], event['key_ids']))
+
+  def test_key_ids_streamed(self):
+    settings.SSHKEY_AUDIT = 'file'
+    response = self.lookup(HTTP_ACCEPT_ENCODING='gzip')
+    self.assertTrue(response.streaming)
+    self.assertTrue(self.queue.empty())
+    b''.join(response.streaming_content)
+    audit.flush()
+    self.assertEqual([self.key1.id], self.read_log()[0]['key_ids'])
+
+  def test_key_ids_cached(self):
+    settings.SSHKEY_AUDIT = 'file'
+    original = settings.SSHKEY_LOOKUP_CACHE_TIMEOUT
+    settings.SSHKEY_LOOKUP_CACHE_TIMEOUT = 60
+    cache.invalidate()
+    try:
+      self.lookup({'username': 'user1'})
+      self.lookup({'username': 'user1'}, HTTP_ACCEPT_ENCODING='gzip')
+    finally:
+      settings.SSHKEY_LOOKUP_CACHE_TIMEOUT = original
+    audit.flush()
+    self.assertEqual([[self.key1.id], [self.key1.id]],
+                     [event['key_ids'] for event in self.read_log()])
+
+  def test_full_queue_drops(self):
+    settings.SSHKEY_AUDIT = 'file'
+    dropped = audit.dropped()
+    for i in range(3):
+      self.assertEqual(200, self.lookup().status_code)
+    self.assertEqual(dropped + 1, audit.dropped())
+    audit.flush()
+    self.assertEqual(2, len(self.read_log()))
+
+  def test_write_failure_drops(self):
+    settings.SSHKEY_AUDIT = 'file'
+    settings.SSHKEY_AUDIT_FILE = os.path.join(self.key_dir, 'missing', 'log')
+    dropped = audit.dropped()
+    self.lookup()
+    audit.logger.disabled = True
+    try:
+      audit.flush()
+    finally:
+      audit.logger.disabled = False
+    self.assertEqual(dropped + 1, audit.dropped())
+
+  def test_writer_thread(self):
+    settings.SSHKEY_AUDIT = 'file'
+    settings.SSHKEY_AUDIT_FLUSH_INTERVAL = 60
+    audit._state.update(queue=None, pid=None)
+    self.lookup()
+    audit.flush()
+    self.assertEqual(1, len(self.read_log()))
+
+
+class KeyTreeTestCase(BaseTestCase):
+  @classmethod
+  def setUpClass(cls):
+    super(KeyTreeTestCase, cls).setUpClass()
+    cls.original_options = settings.SSHKEY_AUTHORIZED_KEYS_OPTIONS
+    settings.SSHKEY_AUTHORIZED_KEYS_OPTIONS = 'command="{username} {key_id}"'
+    cls.user1 = User.objects.create(username='user1')
+    cls.user2 = User.objects.create(username='user2')
+    for i in range(6):
+      path = os.path.join(cls.key_dir, 'key%d' % i)
+      ssh_keygen(file=path)
+      key = UserKey(
+        user=cls.user1 if i % 2 else cls.user2,
+        name='key%d' % i,
+        key=open(path + '.pub').read(),
+      )
+      key.full_clean()
+      key.save()
+
+  @classmethod
+  def tearDownClass(cls):
+    settings.SSHKEY_AUTHORIZED_KEYS_OPTIONS = cls.original_options
+    User.objects.all().delete()
+    super(KeyTreeTestCase, cls).tearDownClass()
+
+  def urlopen(self, request):
+    self.requests.append(request.get_full_url())
+    response = self.client.get(
+      request.get_full_url(),
+      HTTP_ACCEPT_ENCODING=request.get_header('Accept-encoding'),
+    )
+    self.assertEqual(response.status_code, 200)
+
+    class Response(object):
+      def read(self):
+        if response.streaming:
+          return b''.join(response.streaming_content)
+        return response.content
+
+      def info(self):
+        return response
+    return Response()
+
+  def lookup_all(self):
+    url = reverse('django_sshkey.views.lookup')
+    return self.client.get(url).content.decode('ascii').splitlines(True)
+
+  def sync(self, lines, threshold=32):
+    self.requests = []
+    original_urlopen = util.urlopen
+    util.urlopen = self.urlopen
+    try:
+      url = reverse('django_sshkey.views.lookup')
+      return util.lookup_sync(url, lines, threshold)
+    finally:
+      util.urlopen = original_urlopen
+
+  def test_tree_root(self):
+    url = reverse('django_sshkey.views.lookup_tree')
+    response = self.client.get(url)
+    self.assertEqual(response['X-SSHKey-Hash'], settings.SSHKEY_DEFAULT_HASH)
+    entries = []
+    for line in self.lookup_all():
+      digest = util.fingerprint_digest(
+        util.authorized_keys_pubkey(line).fingerprint())
+      entries.append((digest, util.keytree_leaf(line.rstrip('\n'))))
+    children = util.keytree_children(entries)
+    expected = set('%s %d %s' % ((c,) + children[c]) for c in children)
+    actual = set(response.content.decode('ascii').splitlines())
+    self.assertEqual(expected, actual)
+
+  def test_tree_cached(self):
+    original = settings.SSHKEY_LOOKUP_CACHE_TIMEOUT
+    settings.SSHKEY_LOOKUP_CACHE_TIMEOUT = 60
+    try:
+      cache.invalidate()
+      url = reverse('django_sshkey.views.lookup_tree')
+      expected = self.client.get(url).content
+      with self.assertNumQueries(0):
+        self.assertEqual(expected, self.client.get(url).content)
+      key = UserKey.objects.get(name='key1')
+      key.revoke()
+      self.run_on_commit()
+      lines = self.client.get(url).content.decode('ascii').splitlines()
+      self.assertEqual(5, sum(int(line.split()[1]) for line in lines))
+    finally:
+      settings.SSHKEY_LOOKUP_CACHE_TIMEOUT = original
+
+  def test_tree_bucket_keys(self):
+    url = reverse('django_sshkey.views.lookup_tree')
+    key = UserKey.objects.get(name='key1')
+    prefix = util.fingerprint_digest(key.fingerprint)[:2]
+    response = self.client.get(url, {'prefix': prefix, 'keys': '1'})
+    lines = response.content.decode('ascii').splitlines()
+    self.assertIn('command="user1 %d" %s' % (key.id, key.key), lines)
+    for line in lines:
+      digest = util.fingerprint_digest(
+        util.authorized_keys_pubkey(line).fingerprint())
+      self.assertTrue(digest.startswith(prefix))
+
+  def test_tree_node(self):
+    url = reverse('django_sshkey.views.lookup_tree')
+    key = UserKey.objects.get(name='key1')
+    prefix = util.fingerprint_digest(key.fingerprint)[:1]
+    response = self.client.get(url, {'prefix': prefix})
+    lines = response.content.decode('ascii').splitlines()
+    self.assertTrue(lines)
+    for line in lines:
+      child = line.split()[0]
+      self.assertEqual(2, len(child))
+      self.assertTrue(child.startswith(prefix))
+
+  def test_sync_unchanged(self):
+    lines = self.lookup_all()
+    self.assertEqual(sorted(lines), sorted(self.sync(lines)))
+    self.assertEqual(1, len(self.requests))
+
+  def test_sync_changed(self):
+    lines = self.lookup_all()
+    expected = sorted(lines)
+    lines = lines[1:] + ['command="user3 99" ' + lines[0].split(None, 2)[2]]
+    self.assertEqual(expected, sorted(self.sync(lines, threshold=1)))
+
+  def test_sync_empty(self):
+    self.assertEqual(sorted(self.lookup_all()), sorted(self.sync([])))
+
+  def test_sync_same_key(self):
+    key = UserKey.objects.get(name='key1')
+    pubkey = pubkey_parse(key.key)
+    for i in range(3):
+      other = UserKey(
+        user=self.user2,
+        name='copy%d' % i,
+        key='%s %s copy%d' % (pubkey.algorithm, pubkey.b64key, i),
+      )
+      other.full_clean()
+      other.save()
+    self.assertEqual(sorted(self.lookup_all()),
+                     sorted(self.sync([], threshold=1)))
+
+
+class AuthorizedKeysLineTestCase(BaseTestCase):
+  @classmethod
+  def setUpClass(cls):
+    super(AuthorizedKeysLineTestCase, cls).setUpClass()
+    cls.original_options = settings.SSHKEY_AUTHORIZED_KEYS_OPTIONS
+    settings.SSHKEY_AUTHORIZED_KEYS_OPTIONS = 'command="{username} {key_id}"'
+
+  @classmethod
+  def tearDownClass(cls):
+    settings.SSHKEY_AUTHORIZED_KEYS_OPTIONS = cls.original_options
+    super(AuthorizedKeysLineTestCase, cls).tearDownClass()
+
+  def setUp(self):
+    self.user = User.objects.create(username='user1')
+    self.key = UserKey(user=self.user, name='key1', key=random_pubkey('key1'))
+    self.key.full_clean()
+    self.key.save()
+
+  def tearDown(self):
+    settings.SSHKEY_AUTHORIZED_KEYS_OPTIONS = 'command="{username} {key_id}"'
+
+  def stored_line(self):
+    return UserKey.objects.get(id=self.key.id).authorized_keys_line
+
+  def lookup(self):
+    url = reverse('django_sshkey.views.lookup')
+    response = self.client.get(url)
+    self.assertEqual(response.status_code, 200)
+    if response.streaming:
+      return b''.join(response.streaming_content).decode('ascii')
+    return response.content.decode('ascii')
+
+  def test_save(self):
+    expected = 'command="user1 %d" %s' % (self.key.id, self.key.key)
+    self.assertEqual(expected, self.key.authorized_keys_line)
+    self.assertEqual(expected, self.stored_line())
+    self.assertEqual(expected + '\n', self.lookup())
+
+  def test_save_without_options(self):
+    settings.SSHKEY_AUTHORIZED_KEYS_OPTIONS = None
+    key = UserKey(user=self.user, name='key2', key=random_pubkey('key2'))
+    key.full_clean()
+    key.save()
+    self.assertEqual(key.key, key.authorized_keys_line)
+
+  def test_touch(self):
+    settings.SSHKEY_AUTHORIZED_KEYS_OPTIONS = None
+    self.key.touch()
+    self.assertEqual('command="user1 %d" %s' % (self.key.id, self.key.key),
+                     self.stored_line())
+
+  def test_rename_user(self):
+    self.user.username = 'user2'
+    self.user.save()
+    self.assertEqual('command="user2 %d" %s' % (self.key.id, self.key.key),
+                     self.stored_line())
+
+  def test_rename_user_other_fields(self):
+    User.objects.filter(id=self.user.id).update(username='user2')
+    self.user.username = 'user2'
+    self.user.save(update_fields=['last_login'])
+    self.assertEqual('command="user1 %d" %s' % (self.key.id, self.key.key),
+                     self.stored_line())
+
+  def test_rebuild_command(self):
+    self.lookup()
+    settings.SSHKEY_AUTHORIZED_KEYS_OPTIONS = 'no-pty'
+    call_command('rebuild_sshkey_lines', stdout=DEVNULL)
+    self.assertEqual('no-pty ' + self.key.key + '\n', self.lookup())
+    settings.SSHKEY_AUTHORIZED_KEYS_OPTIONS = None
+    call_command('rebuild_sshkey_lines', 'user1', stdout=DEVNULL)
+    self.assertEqual(self.key.key + '\n', self.lookup())
+
+  def test_rebuild_command_no_such_user(self):
+    with self.assertRaises(CommandError):
+      call_command('rebuild_sshkey_lines', 'nobody', stdout=DEVNULL)
+
+  def test_rebuild_batches(self):
+    for i in range(2, 6):
+      key = UserKey(user=self.user, name='key%d' % i,
+                    key=random_pubkey('key%d' % i))
+      key.full_clean()
+      key.save()
+    settings.SSHKEY_AUTHORIZED_KEYS_OPTIONS = None
+    count = rebuild_authorized_keys_lines(UserKey.objects.all(), batch_size=2)
+    self.assertEqual(5, count)
+    for key in UserKey.objects.all():
+      self.assertEqual(key.key, key.authorized_keys_line)
+
+  def test_lookup_without_join(self):
+    url = reverse('django_sshkey.views.lookup')
+    with CaptureQueriesContext(connections['default']) as queries:
+      response = self.client.get(url, {'fingerprint': self.key.fingerprint})
+      self.assertEqual(response.status_code, 200)
+      b''.join(response.streaming_content if response.streaming
+               else [response.content])
+    self.assertEqual(1, len(queries))
+    sql = queries[0]['sql']
+    self.assertNotIn('JOIN', sql)
+    self.assertNotIn('"key"', sql.split(' FROM ')[0])
+
+
+class KrlTestCase(BaseTestCase):
+  @classmethod
+  def setUpClass(cls):
+    super(KrlTestCase, cls).setUpClass()
+    cls.user = User.objects.create(username='user1')
+    cls.user.set_password('password')
+    cls.user.save()
+    cls.key1_path = os.path.join(cls.key_dir, 'key1')
+    cls.key2_path = os.path.join(cls.key_dir, 'key2')
+    ssh_keygen(comment='key1', file=cls.key1_path)
+    ssh_keygen(comment='key2', file=cls.key2_path)
+    cls.krl_path = os.path.join(cls.key_dir, 'krl')
+
+  @classmethod
+  def tearDownClass(cls):
+    User.objects.all().delete()
+    super(KrlTestCase, cls).tearDownClass()
+
+  def setUp(self):
+    self.key1 = UserKey(user=self.user,
+                        key=read_pubkey(self.key1_path + '.pub'))
+    self.key1.full_clean()
+    self.key1.save()
+    self.key2 = UserKey(user=self.user,
+                        key=read_pubkey(self.key2_path + '.pub'))
+    self.key2.full_clean()
+    self.key2.save()
+
+  def tearDown(self):
+    if os.path.exists(self.krl_path):
+      os.unlink(self.krl_path)
+
+  def revoked(self, pubkey_path):
+    '''Check a key against the KRL file with ssh-keygen'''
+    cmd = ['ssh-keygen', '-Q', '-f', self.krl_path, pubkey_path]
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = p.communicate()
+    return p.returncode != 0
+
+  def lookup_keys(self, query={}):
+    url = reverse('django_sshkey.views.lookup')
+    response = self.client.get(url, query)
+    self.assertEqual(response.status_code, 200)
+    if response.streaming:
+      body = b''.join(response.streaming_content)
+    else:
+      body = response.content
+    return body.decode('ascii').splitlines()
+
+  def test_revoke(self):
+    self.key1.revoke()
+    self.assertEqual([self.key2.key], self.lookup_keys())
+    self.assertEqual(
+      [], self.lookup_keys({'fingerprint': self.key1.fingerprint}))
+    self.assertEqual([self.key2.key], self.lookup_keys({'username': 'user1'}))
+    url = reverse('django_sshkey.views.lookup_tree')
+    response = self.client.get(url, {'keys': ''})
+    self.assertEqual([self.key2.key],
+                     response.content.decode('ascii').splitlines())
+
+  def test_revoke_keys(self):
+    self.assertEqual(2, revoke_keys(UserKey.objects.all()))
+    self.assertEqual(0, revoke_keys(UserKey.objects.all()))
+    self.assertEqual([], self.lookup_keys())
+
+  def test_krl(self):
+    self.key1.revoke()
+    call_command('export_sshkey_krl', self.krl_path, stdout=DEVNULL)
+    self.assertTrue(self.revoked(self.key1_path + '.pub'))
+    self.assertFalse(self.revoked(self.key2_path + '.pub'))
+
+  def test_krl_empty(self):
+    call_command('export_sshkey_krl', self.krl_path, stdout=DEVNULL)
+    self.assertFalse(self.revoked(self.key1_path + '.pub'))
+    self.assertEqual(krl.format_krl([], comment='django-sshkey'),
+                     open(self.krl_path, 'rb').read())
+
+  def test_krl_unchanged(self):
+    self.key1.revoke()
+    call_command('export_sshkey_krl', self.krl_path, stdout=DEVNULL)
+    os.utime(self.krl_path, (0, 0))
+    call_command('export_sshkey_krl', self.krl_path, stdout=DEVNULL)
+    self.assertEqual(0, os.stat(self.krl_path).st_mtime)
+    self.key2.revoke()
+    call_command('export_sshkey_krl', self.krl_path, stdout=DEVNULL)
+    self.assertTrue(self.revoked(self.key2_path + '.pub'))
+
+  def test_lookup_krl(self):
+    url = reverse('django_sshkey.views.lookup_krl')
+    response = self.client.get(url)
+    self.assertEqual(200, response.status_code)
+    empty = response['ETag']
+    self.key1.revoke()
+    response = self.client.get(url, HTTP_IF_NONE_MATCH=empty)
+    self.assertEqual(200, response.status_code)
+    with open(self.krl_path, 'wb') as f:
+      f.write(response.content)
+    self.assertTrue(self.revoked(self.key1_path + '.pub'))
+    response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+    self.assertEqual(304, response.status_code)
+
+  def test_revoked_key_cannot_be_deleted(self):
+    self.key1.revoke()
+    self.client.login(username='user1', password='password')
+    url = reverse('django_sshkey.views.userkey_delete', args=[self.key1.id])
+    response = self.client.get(url)
+    self.assertEqual(403, response.status_code)
+    self.assertTrue(UserKey.objects.filter(id=self.key1.id).exists())
+
+
+class BloomTestCase(BaseTestCase):
+  @classmethod
+  def setUpClass(cls):
+    super(BloomTestCase, cls).setUpClass()
+    cls.user1 = User.objects.create(username='user1')
+
+  @classmethod
+  def tearDownClass(cls):
+    User.objects.all().delete()
+    super(BloomTestCase, cls).tearDownClass()
+
+  def setUp(self):
+    self.original = settings.SSHKEY_LOOKUP_BLOOM
+    settings.SSHKEY_LOOKUP_BLOOM = True
+    bloom.reset()
+    self.key1 = UserKey(user=self.user1, key=random_pubkey('key1'))
+    self.key1.full_clean()
+    self.key1.save()
+
+  def tearDown(self):
+    settings.SSHKEY_LOOKUP_BLOOM = self.original
+    bloom.reset()
+
+  def lookup(self, query):
+    url = reverse('django_sshkey.views.lookup')
+    response = self.client.get(url, query)
+    self.assertEqual(200, response.status_code)
+    return response.content.decode('ascii').splitlines()
+
+  def test_filter(self):
+    f = util.BloomFilter.for_capacity(100, 0.01)
+    items = ['fingerprint:%d' % i for i in range(100)]
+    for item in items:
+      f.add(item)
+    for item in items:
+      self.assertIn(item, f)
+    misses = sum('other:%d' % i in f for i in range(1000))
+    self.assertLess(misses, 50)
+    g = util.BloomFilter.from_bytes(f.to_bytes())
+    self.assertEqual((f.size, f.count, f.bits), (g.size, g.count, g.bits))
+
+  def test_from_bytes_invalid(self):
+    data = util.BloomFilter.for_capacity(10).to_bytes()
+    self.assertRaises(ValueError, util.BloomFilter.from_bytes, b'XXXX')
+    self.assertRaises(ValueError, util.BloomFilter.from_bytes, data[:-1])
+
+  def test_minimum_size(self):
+    # Sized for far more keys than these tests have, so that their misses
+    # are not false positives
+    expected = util.BloomFilter.for_capacity(
+      bloom.MIN_CAPACITY, settings.SSHKEY_LOOKUP_BLOOM_ERROR)
+    self.assertEqual(expected.size, bloom.current().size)
+
+  def test_miss_without_query(self):
+    self.lookup({'fingerprint': 'SHA256:warm'})
+    with self.assertNumQueries(0):
+      self.assertEqual([], self.lookup({'fingerprint': 'SHA256:none'}))
+    with self.assertNumQueries(0):
+      self.assertEqual([], self.lookup({'username': 'user1',
+                                        'fingerprint': 'SHA256:none'}))
+    self.assertEqual([self.key1.key],
+                     self.lookup({'fingerprint': self.key1.fingerprint}))
+    blob = self.key1.key.split()[1]
+    self.assertEqual([self.key1.key], self.lookup({'key': blob}))
+
+  def test_follows_key_changes(self):
+    self.lookup({'fingerprint': 'SHA256:warm'})
+    key2 = UserKey(user=self.user1, key=random_pubkey('key2'))
+    key2.full_clean()
+    key2.save()
+    self.run_on_commit()
+    self.assertEqual([key2.key],
+                     self.lookup({'fingerprint': key2.fingerprint}))
+    key2.revoke()
+    self.run_on_commit()
+    item = util.bloom_item('fingerprint', key2.fingerprint)
+    self.assertNotIn(item, bloom.current())
+
+  def test_served_during_rebuild(self):
+    old = bloom.current()
+    bloom._state.update(building=True, built=0)
+    try:
+      with self.assertNumQueries(0):
+        self.assertIs(old, bloom.current())
+      bloom._state.update(generation=None)
+      with self.assertNumQueries(0):
+        self.assertIsNone(bloom.current())
+      self.assertFalse(bloom.definite_miss(('fingerprint', 'SHA256:none')))
+    finally:
+      bloom._state.update(building=False)
+    self.assertIsNot(old, bloom.current())
+
+  def test_other_lookups_not_filtered(self):
+    self.assertIsNone(bloom.probe_item(('all', 'text', ())))
+    self.assertIsNone(bloom.probe_item(('username', 'user1', 'all')))
+    self.assertEqual([self.key1.key], self.lookup({'username': 'user1'}))
+
+  def test_lookup_bloom(self):
+    url = reverse('django_sshkey.views.lookup_bloom')
+    response = self.client.get(url)
+    self.assertEqual(200, response.status_code)
+    f = util.BloomFilter.from_bytes(response.content)
+    self.assertIn(util.bloom_item('fingerprint', self.key1.fingerprint), f)
+    self.assertIn(util.bloom_item('key', self.key1.blob_digest), f)
+    response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+    self.assertEqual(304, response.status_code)
+    settings.SSHKEY_LOOKUP_BLOOM = False
+    self.assertEqual(404, self.client.get(url).status_code)
+
+  def test_read_bloom(self):
+    path = os.path.join(self.key_dir, 'bloom')
+    self.assertIsNone(util.read_bloom(path))
+    with open(path, 'wb') as f:
+      f.write(bloom.current().to_bytes())
+    f = util.read_bloom(path)
+    self.assertIn(util.bloom_item('fingerprint', self.key1.fingerprint), f)
+    os.unlink(path)
+
+
+class OwnerActiveTestCase(BaseTestCase):
+  @classmethod
+  def setUpClass(cls):
+    super(OwnerActiveTestCase, cls).setUpClass()
+    cls.user1 = User.objects.create(username='user1')
+    cls.user2 = User.objects.create(username='user2')
+
+  @classmethod
+  def tearDownClass(cls):
+    User.objects.all().delete()
+    super(OwnerActiveTestCase, cls).tearDownClass()
+
+  def setUp(self):
+    self.original = settings.SSHKEY_LOOKUP_ACTIVE_ONLY
+    settings.SSHKEY_LOOKUP_ACTIVE_ONLY = True
+    # Tests change the users, so use fresh copies
+    self.user1 = User.objects.get(id=self.user1.id)
+    self.user2 = User.objects.get(id=self.user2.id)
+    self.key1 = UserKey(user=self.user1, key=random_pubkey('key1'))
+    self.key1.full_clean()
+    self.key1.save()
+    self.key2 = UserKey(user=self.user2, key=random_pubkey('key2'))
+    self.key2.full_clean()
+    self.key2.save()
+
+  def tearDown(self):
+    settings.SSHKEY_LOOKUP_ACTIVE_ONLY = self.original
+
+  def lookup(self, query={}):
+    url = reverse('django_sshkey.views.lookup')
+    response = self.client.get(url, query)
+    self.assertEqual(200, response.status_code)
+    return response.content.decode('ascii').splitlines()
+
+  def owner_active(self, key):
+    return UserKey.objects.get(id=key.id).owner_active
+
+  def test_deactivate_user(self):
+    self.user1.is_active = False
+    self.user1.save()
+    self.assertFalse(self.owner_active(self.key1))
+    self.assertTrue(self.owner_active(self.key2))
+    self.assertEqual([self.key2.key], self.lookup())
+    self.assertEqual([], self.lookup({'fingerprint': self.key1.fingerprint}))
+    self.user1.is_active = True
+    self.user1.save(update_fields=['is_active'])
+    self.assertTrue(self.owner_active(self.key1))
+    self.assertEqual(2, len(self.lookup()))
+
+  def test_setting_off(self):
+    self.user1.is_active = False
+    self.user1.save()
+    settings.SSHKEY_LOOKUP_ACTIVE_ONLY = False
+    self.assertEqual(2, len(self.lookup()))
+
+  def test_no_join(self):
+    with CaptureQueriesContext(connections['default']) as queries:
+      self.lookup()
+    self.assertNotIn('auth_user', queries[0]['sql'])
+    self.assertIn('owner_active', queries[0]['sql'])
+
+  def test_new_key_of_inactive_user(self):
+    self.user1.is_active = False
+    self.user1.save()
+    key = UserKey(user=self.user1, key=random_pubkey('key3'))
+    key.full_clean()
+    key.save()
+    self.assertFalse(self.owner_active(key))
+
+  def test_reconcile(self):
+    User.objects.filter(id=self.user1.id).update(is_active=False)
+    self.assertEqual(2, len(self.lookup()))
+    self.assertEqual(1, reconcile_owner_active())
+    self.assertEqual(0, reconcile_owner_active())
+    self.assertEqual([self.key2.key], self.lookup())
+    User.objects.filter(id=self.user1.id).update(is_active=True)
+    call_command('reconcile_sshkey_owners', stdout=DEVNULL)
+    self.assertTrue(self.owner_active(self.key1))
+
+
+class ShardingTestCase(BaseTestCase):
+  multi_db = True
+
+  @classmethod
+  def setUpClass(cls):
+    super(ShardingTestCase, cls).setUpClass()
+    cls.user1 = User.objects.create(username='user1')
+    cls.user2 = User.objects.create(username='user2')
+
+  @classmethod
+  def tearDownClass(cls):
+    User.objects.all().delete()
+    super(ShardingTestCase, cls).tearDownClass()
+
+  def setUp(self):
+    self.original = settings.SSHKEY_SHARDS
+    settings.SSHKEY_SHARDS = ('default', 'shard')
+    # Homes cached by earlier tests, whose moves were rolled back
+    cache.get_cache().clear()
+    self.shard1 = sharding.home(self.user1.id)
+    self.shard2 = sharding.home(self.user2.id)
+    self.key1 = UserKey(user=self.user1, key=random_pubkey('key1'))
+    self.key1.full_clean()
+    self.key1.save()
+    self.key2 = UserKey(user=self.user2, key=random_pubkey('key2'))
+    self.key2.full_clean()
+    self.key2.save()
+
+  def tearDown(self):
+    settings.SSHKEY_SHARDS = self.original
+
+  def lookup(self, query={}):
+    url = reverse('django_sshkey.views.lookup')
+    response = self.client.get(url, query)
+    self.assertEqual(200, response.status_code)
+    return response.content.decode('ascii').splitlines()
+
+  def ids_on(self, alias):
+    return sorted(UserKey.objects.using(alias).values_list('id', flat=True))
+
+  def test_keys_on_owners_shard(self):
+    self.assertNotEqual(self.shard1, self.shard2)
+    self.assertEqual([self.key1.id], self.ids_on(self.shard1))
+    self.assertEqual([self.key2.id], self.ids_on(self.shard2))
+    self.assertEqual(self.key2.id, sharding.get(id=self.key2.id).id)
+    self.assertEqual('user2', sharding.get(id=self.key2.id).user.username)
+
+  def test_lookup_by_username(self):
+    with CaptureQueriesContext(connections[self.shard1]) as queries:
+      self.assertEqual([self.key2.key], self.lookup({'username': 'user2'}))
+    self.assertNotIn('sshkey_userkey', ''.join(q['sql'] for q in queries))
+    self.assertEqual([], self.lookup({'username': 'nobody'}))
+
+  def test_lookup_gathers_shards(self):
+    keys = sorted([self.key1, self.key2], key=lambda key: key.id)
+    self.assertEqual(sorted(key.key for key in keys), sorted(self.lookup()))
+    self.assertEqual([self.key2.key],
+                     self.lookup({'fingerprint': self.key2.fingerprint}))
+    self.assertEqual([keys[0].key], self.lookup({'limit': 1}))
+    self.assertEqual([keys[1].key],
+                     self.lookup({'after_id': keys[0].id, 'limit': 1}))
+    lines = self.lookup({'format': 'ndjson', 'before_id': keys[1].id})
+    self.assertEqual([keys[0].user.username],
+                     [json.loads(line)['username'] for line in lines])
+    response = self.client.get(reverse('django_sshkey.views.lookup_tree'),
+                               {'keys': ''})
+    self.assertEqual(2, len(response.content.splitlines()))
+    self.key2.revoke()
+    self.assertEqual([self.key1.key], self.lookup())
+    blob = pubkey_parse(self.key2.key).keydata
+    self.assertIn(hashlib.sha1(blob).digest(), krl.revoked_krl())
+
+  def test_home_cached(self):
+    with self.assertNumQueries(0):
+      self.assertEqual(self.shard2, sharding.home(self.user2.id))
+    sharding.move(self.user2.id, self.shard1)
+    with self.assertNumQueries(1):
+      self.assertEqual(self.shard1, sharding.home(self.user2.id))
+    with self.assertNumQueries(0):
+      self.assertEqual(self.shard1, sharding.home(self.user2.id))
+
+  def test_locate_follows_renames(self):
+    original = settings.SSHKEY_LOOKUP_CACHE_TIMEOUT
+    settings.SSHKEY_LOOKUP_CACHE_TIMEOUT = 60
+    try:
+      self.assertIsNone(sharding.locate('user3'))
+      user3 = User.objects.create(username='user3')
+      self.run_on_commit()
+      self.assertEqual(user3.id, sharding.locate('user3')[0])
+      user3.username = 'user4'
+      user3.save()
+      self.run_on_commit()
+      self.assertIsNone(sharding.locate('user3'))
+      self.assertEqual(user3.id, sharding.locate('user4')[0])
+    finally:
+      settings.SSHKEY_LOOKUP_CACHE_TIMEOUT = original
+
+  def test_touch(self):
+    url = reverse('django_sshkey.views.lookup')
+    response = self.client.post(url, data=str(self.key2.id),
+                                content_type='text/plain')
+    self.assertEqual(200, response.status_code)
+    key = UserKey.objects.using(self.shard2).get(id=self.key2.id)
+    self.assertIsNotNone(key.last_used)
+
+  def test_validate_unique_across_shards(self):
+    key = UserKey(user=self.user1, key=self.key2.key)
+    with self.assertRaises(ValidationError) as cm:
+      key.full_clean()
+    self.assertIn('Somebody else', str(cm.exception))
+    key = UserKey(user=self.user2, name='key2', key=random_pubkey('key3'))
+    with self.assertRaises(ValidationError) as cm:
+      key.full_clean()
+    self.assertIn('already have a key with that name', str(cm.exception))
+
+  def test_move_user(self):
+    call_command('rebalance_sshkeys', 'user1', self.shard2, stdout=DEVNULL)
+    self.assertEqual(self.shard2, sharding.home(self.user1.id))
+    self.assertEqual([], self.ids_on(self.shard1))
+    self.assertEqual(sorted([self.key1.id, self.key2.id]),
+                     self.ids_on(self.shard2))
+    self.assertEqual([self.key1.key], self.lookup({'username': 'user1'}))
+    # The user's new keys go to the shard they were moved to
+    key = UserKey(user=self.user1, key=random_pubkey('key3'))
+    key.full_clean()
+    key.save()
+    self.assertIn(key.id, self.ids_on(self.shard2))
+    self.assertEqual(0, sharding.rebalance())
+    sharding.move(self.user1.id, self.shard1)
+    self.assertEqual(self.shard1, sharding.home(self.user1.id))
+    self.assertEqual(2, len(self.ids_on(self.shard1)))
+    with self.assertRaises(CommandError):
+      call_command('rebalance_sshkeys', 'user1', 'replica', stdout=DEVNULL)
+
+  def test_enable_sharding(self):
+    settings.SSHKEY_SHARDS = ()
+    UserKey.objects.using('shard').all().delete()
+    user3 = User.objects.create(username='user3')
+    key3 = UserKey(user=user3, key=random_pubkey('key3'))
+    key3.full_clean()
+    key3.save()
+    settings.SSHKEY_SHARDS = ('shard',)
+    self.assertEqual(2, sharding.rebalance())
+    self.assertEqual([], self.ids_on('default'))
+    self.assertIn(key3.id, self.ids_on('shard'))
+    sharding.reserve_ids()
+    key4 = UserKey(user=user3, key=random_pubkey('key4'))
+    key4.full_clean()
+    key4.save()
+    self.assertGreater(key4.id, key3.id)
+
+  def test_delete_user(self):
+    User.objects.get(id=self.user2.id).delete()
+    self.assertEqual([], self.ids_on(self.shard2))
+    self.assertEqual([self.key1.id], self.ids_on(self.shard1))
+
+  def test_reconcile_owner_active(self):
+    User.objects.filter(id=self.user2.id).update(is_active=False)
+    self.assertEqual(1, reconcile_owner_active())
+    self.assertFalse(UserKey.objects.using(self.shard2).get().owner_active)
+    User.objects.filter(id=self.user2.id).update(is_active=True)
+    self.assertEqual(1, reconcile_owner_active())
+
+
+class ShardThreadTestCase(TransactionTestCase):
+  multi_db = True
+
+  def setUp(self):
+    self.original = settings.SSHKEY_SHARDS
+    settings.SSHKEY_SHARDS = ('default', 'shard')
+
+  def tearDown(self):
+    settings.SSHKEY_SHARDS = self.original
+
+  # Workers have connections of their own, which only see the same test
+  # database if it is in a file or a shared in-memory one.
+  # Django 2.1+ dropped the feature, which every SQLite it supports has
+  @skipIf(not getattr(connections['default'].features,
+                      'can_share_in_memory_db', True),
+          'SQLite shared cache required')
+  def test_gather_in_threads(self):
+    keys = []
+    for username in ('user1', 'user2'):
+      user = User.objects.create(username=username)
+      key = UserKey(user=user, key=random_pubkey(username))
+      key.full_clean()
+      key.save()
+      keys.append(key)
+    original = settings.SSHKEY_SHARD_WORKERS
+    settings.SSHKEY_SHARD_WORKERS = 1
+    sharding._pool.update(pid=None)
+    started = []
+    start = threading.Thread.start
+
+    def record(thread):
+      started.append(thread)
+      start(thread)
+    threading.Thread.start = record
+    try:
+      for i in range(2):
+        gathered = sharding.gather(UserKey.objects.order_by('id'))
+        self.assertEqual([created.id for created in keys],
+                         [row.id for row in gathered])
+    finally:
+      threading.Thread.start = start
+      settings.SSHKEY_SHARD_WORKERS = original
+    # The workers started by the first are reused
+    self.assertEqual(2, len(started))
+
+  def test_gather_past_deadline(self):
+    # Shards whose workers are busy
+    sharding._pool.update(pid=os.getpid(),
+                          queues={'default': Queue(), 'shard': Queue()})
+    try:
+      self.assertRaises(deadline.DeadlineExceeded, sharding.gather,
+                        UserKey.objects.all(), time.time() + 0.05)
+    finally:
+      sharding._pool.update(pid=None)
+
+
+class AdminTestCase(BaseTestCase):
+  @classmethod
+  def setUpClass(cls):
+    super(AdminTestCase, cls).setUpClass()
+    cls.admin = User.objects.create_superuser('admin', 'admin@example.com',
+                                              'password')
+    cls.user1 = User.objects.create(username='user1')
+    cls.key1_path = os.path.join(cls.key_dir, 'key1')
+    ssh_keygen(comment='key1', file=cls.key1_path)
+    cls.key2_path = os.path.join(cls.key_dir, 'key2')
+    ssh_keygen(comment='key2', file=cls.key2_path)
+
+  @classmethod
+  def tearDownClass(cls):
+    User.objects.all().delete()
+    super(AdminTestCase, cls).tearDownClass()
+
+  def setUp(self):
+    cache.get_cache().delete(admin.COUNT_CACHE_KEY)
+    self.key1 = UserKey(
+      user=self.user1,
+      key=read_pubkey(self.key1_path + '.pub'),
+    )
+    self.key1.full_clean()
+    self.key1.save()
+
+  def tearDown(self):
+    UserKey.objects.all().delete()
+
+  def search(self, term):
+    self.client.login(username='admin', password='password')
+    url = reverse('admin:django_sshkey_userkey_changelist')
+    response = self.client.get(url, {'q': term})
+    self.assertEqual(response.status_code, 200)
+    return list(response.context['cl'].result_list)
+
+  def test_search_fingerprint_exact(self):
+    self.assertEqual([self.key1], self.search(self.key1.fingerprint))
+
+  def test_search_fingerprint_prefix(self):
+    self.assertEqual([self.key1], self.search(self.key1.fingerprint[:5]))
+
+  def test_search_username(self):
+    self.assertEqual([self.key1], self.search('user1'))
+    self.assertEqual([], self.search('admin'))
+
+  def test_unfiltered_count_is_cached(self):
+    paginator = admin.UserKeyPaginator(UserKey.objects.all(), 100)
+    self.assertEqual(1, paginator.count)
+    key2 = UserKey(user=self.user1, key=read_pubkey(self.key2_path + '.pub'))
+    key2.full_clean()
+    key2.save()
+    paginator = admin.UserKeyPaginator(UserKey.objects.all(), 100)
+    self.assertEqual(1, paginator.count)
+    paginator = admin.UserKeyPaginator(
+      UserKey.objects.filter(user=self.user1), 100)
+    self.assertEqual(2, paginator.count)
+
+
+class FailingEmailBackend(BaseEmailBackend):
+  def send_messages(self, email_messages):
+    raise IOError('SMTP server unavailable')
+
+
+class EmailTestCase(BaseTestCase):
+  @classmethod
+  def setUpClass(cls):
+    super(EmailTestCase, cls).setUpClass()
+    cls.user1 = User.objects.create(username='user1',
+                                    email='user1@example.com')
+    cls.user2 = User.objects.create(username='user2',
+                                    email='user2@example.com')
+    cls.key_paths = []
+    for i in range(3):
+      path = os.path.join(cls.key_dir, 'key%d' % i)
+      ssh_keygen(comment='key%d' % i, file=path)
+      cls.key_paths.append(path + '.pub')
+
+  @classmethod
+  def tearDownClass(cls):
+    User.objects.all().delete()
+    super(EmailTestCase, cls).tearDownClass()
+
+  def setUp(self):
+    self._defer = settings.SSHKEY_EMAIL_ADD_KEY_DEFER
+    settings.SSHKEY_EMAIL_ADD_KEY_DEFER = True
+    mail.outbox = []
+
+  def tearDown(self):
+    settings.SSHKEY_EMAIL_ADD_KEY_DEFER = self._defer
+    UserKey.objects.all().delete()
+    UserKeyNotification.objects.all().delete()
+
+  def add_key(self, user, path):
+    key = UserKey(user=user, key=read_pubkey(path))
+    key.full_clean()
+    key.save()
+    return key
+
+  def test_deferred_digest(self):
+    self.add_key(self.user1, self.key_paths[0])
+    self.add_key(self.user1, self.key_paths[1])
+    self.add_key(self.user2, self.key_paths[2])
+    self.assertEqual([], mail.outbox)
+    self.assertEqual(3, UserKeyNotification.objects.count())
+    call_command('send_sshkey_emails', batch_size=1, stdout=DEVNULL)
+    self.assertEqual(2, len(mail.outbox))
+    message1, message2 = mail.outbox
+    self.assertEqual(['user1@example.com'], message1.to)
+    self.assertIn('key0', message1.body)
+    self.assertIn('key1', message1.body)
+    self.assertEqual(['user2@example.com'], message2.to)
+    self.assertIn('key2', message2.body)
+    self.assertEqual(0, UserKeyNotification.objects.count())
+
+  def test_deleted_key_still_notified(self):
+    self.add_key(self.user1, self.key_paths[0]).delete()
+    call_command('send_sshkey_emails', stdout=DEVNULL)
+    self.assertEqual(1, len(mail.outbox))
+    self.assertIn('key0', mail.outbox[0].body)
+
+  @override_settings(
+    EMAIL_BACKEND='django_sshkey.tests.FailingEmailBackend')
+  def test_retry(self):
+    self.add_key(self.user1, self.key_paths[0])
+    call_command('send_sshkey_emails', max_attempts=2, stdout=DEVNULL)
+    notification = UserKeyNotification.objects.get()
+    self.assertEqual(1, notification.attempts)
+    call_command('send_sshkey_emails', max_attempts=2, stdout=DEVNULL)
+    call_command('send_sshkey_emails', max_attempts=2, stdout=DEVNULL)
+    notification = UserKeyNotification.objects.get()
+    self.assertEqual(2, notification.attempts)
+
+  def test_disabled(self):
+    original = settings.SSHKEY_EMAIL_ADD_KEY
+    settings.SSHKEY_EMAIL_ADD_KEY = False
+    try:
+      self.add_key(self.user1, self.key_paths[0])
+    finally:
+      settings.SSHKEY_EMAIL_ADD_KEY = original
+    self.assertEqual(0, UserKeyNotification.objects.count())
+
+
+class EmailOnCommitTestCase(TransactionTestCase):
+  def setUp(self):
+    self.key_dir = tempfile.mkdtemp(prefix='sshkey-test.')
+    self.key_path = os.path.join(self.key_dir, 'key')
+    ssh_keygen(comment='key', file=self.key_path)
+    self.user = User.objects.create(username='user1',
+                                    email='user1@example.com')
+    mail.outbox = []
+
+  def tearDown(self):
+    shutil.rmtree(self.key_dir)
+
+  def save_key(self):
+    key = UserKey(user=self.user, key=read_pubkey(self.key_path + '.pub'))
+    key.full_clean()
+    key.save()
+
+  def test_deferred_by_default(self):
+    self.save_key()
+    self.assertEqual([], mail.outbox)
+    self.assertEqual(1, UserKeyNotification.objects.count())
+
+  @skipIf(on_commit is None, 'Django 1.9+ required')
+  def test_sent_after_commit(self):
+    original = settings.SSHKEY_EMAIL_ADD_KEY_DEFER
+    settings.SSHKEY_EMAIL_ADD_KEY_DEFER = False
+    try:
+      with transaction.atomic():
+        self.save_key()
+        self.assertEqual([], mail.outbox)
+    finally:
+      settings.SSHKEY_EMAIL_ADD_KEY_DEFER = original
+    self.assertEqual(1, len(mail.outbox))
+    self.assertEqual(0, UserKeyNotification.objects.count())
+
+  def test_queued_without_on_commit(self):
+    original = (settings.SSHKEY_EMAIL_ADD_KEY_DEFER, models.on_commit)
+    settings.SSHKEY_EMAIL_ADD_KEY_DEFER = False
+    models.on_commit = None
+    try:
+      self.save_key()
+    finally:
+      settings.SSHKEY_EMAIL_ADD_KEY_DEFER, models.on_commit = original
+    self.assertEqual([], mail.outbox)
+    self.assertEqual(1, UserKeyNotification.objects.count())
+
+  def test_not_sent_on_rollback(self):
+    try:
+      with transaction.atomic():
+        key = UserKey(user=self.user,
+                      key=read_pubkey(self.key_path + '.pub'))
+        key.full_clean()
+        key.save()
+        raise RuntimeError
+    except RuntimeError:
+      pass
+    self.assertEqual([], mail.outbox)
+    self.assertEqual(0, UserKeyNotification.objects.count())
+
+
+class InvalidateOnCommitTestCase(TransactionTestCase):
+  def setUp(self):
+    self.original = (settings.SSHKEY_LOOKUP_CACHE_TIMEOUT,
+                     settings.SSHKEY_LOOKUP_BLOOM)
+    settings.SSHKEY_LOOKUP_CACHE_TIMEOUT = 60
+    settings.SSHKEY_LOOKUP_BLOOM = True
+    cache.invalidate()
+    bloom.reset()
+    self.user = User.objects.create(username='user1')
+
+  def tearDown(self):
+    (settings.SSHKEY_LOOKUP_CACHE_TIMEOUT,
+     settings.SSHKEY_LOOKUP_BLOOM) = self.original
+    bloom.reset()
+
+  def lookup(self, query):
+    url = reverse('django_sshkey.views.lookup')
+    response = self.client.get(url, query)
+    self.assertEqual(200, response.status_code)
+    return response.content.decode('ascii').splitlines()
+
+  @skipIf(on_commit is None, 'Django 1.9+ required')
+  def test_lookups_during_transaction(self):
+    key = UserKey(user=self.user, key=random_pubkey('key1'))
+    key.full_clean()
+    self.assertEqual([], self.lookup({'username': 'user1'}))
+    self.assertEqual([], self.lookup({'fingerprint': key.fingerprint}))
+    with transaction.atomic():
+      key.save()
+      # What lookups on other connections see until the commit
+      generation = cache.generation(cache.get_cache())
+      cache.store(('username', 'user1', 'all', 'text', ()), {None: b''})
+      bloom._state.update(filter=util.BloomFilter.for_capacity(1, 0.01),
+                          generation=generation, built=time.time())
+    self.assertEqual([key.key], self.lookup({'username': 'user1'}))
+    self.assertEqual([key.key], self.lookup({'fingerprint': key.fingerprint}))
+
 
 class FingerprintTestCase(BaseTestCase):
   @classmethod
@@ -637,6 +2638,71 @@ class FingerprintTestCase(BaseTestCase):
     self.assertEqual('Unknown hash type: xxx', cm.exception.args[0])
 
 
+class KeyMetadataTestCase(BaseTestCase):
+  @classmethod
+  def setUpClass(cls):
+    super(KeyMetadataTestCase, cls).setUpClass()
+    cls.user = User.objects.create(username='user1')
+
+  @classmethod
+  def tearDownClass(cls):
+    User.objects.all().delete()
+    super(KeyMetadataTestCase, cls).tearDownClass()
+
+  def make_key(self, type):
+    path = os.path.join(self.key_dir, type)
+    if not os.path.exists(path):
+      ssh_keygen(type=type, comment=type + '@example.com', file=path)
+    key = UserKey(user=self.user, key=read_pubkey(path + '.pub'))
+    key.full_clean()
+    key.save()
+    p = subprocess.Popen(['ssh-keygen', '-lf', path + '.pub'],
+                         stdout=subprocess.PIPE)
+    bits = int(p.communicate()[0].split()[0])
+    return key, bits
+
+  def assertMetadata(self, type, algorithm):
+    key, bits = self.make_key(type)
+    key = UserKey.objects.get(id=key.id)
+    self.assertEqual(algorithm, key.algorithm)
+    self.assertEqual(bits, key.bits)
+    self.assertEqual(type + '@example.com', key.comment)
+
+  def test_rsa(self):
+    self.assertMetadata('rsa', 'ssh-rsa')
+
+  def test_ecdsa(self):
+    self.assertMetadata('ecdsa', 'ecdsa-sha2-nistp256')
+
+  def test_ed25519(self):
+    self.assertMetadata('ed25519', 'ssh-ed25519')
+
+  def test_unknown_algorithm(self):
+    pubkey = util.PublicKey(base64.b64encode(
+      struct.pack('>I', 7) + b'ssh-foo').decode('ascii'))
+    self.assertEqual('ssh-foo', pubkey.algorithm)
+    self.assertIsNone(pubkey.bits())
+
+  def test_normalize(self):
+    key, bits = self.make_key('rsa')
+    UserKey.objects.update(algorithm='', bits=None, comment='')
+    call_command('normalize_sshkeys', stdout=DEVNULL)
+    key = UserKey.objects.get(id=key.id)
+    self.assertEqual(('ssh-rsa', bits), (key.algorithm, key.bits))
+
+  def test_rebuild(self):
+    key1, bits1 = self.make_key('rsa')
+    key2, bits2 = self.make_key('ed25519')
+    UserKey.objects.update(algorithm='', bits=None, comment='')
+    self.assertEqual(2, rebuild_key_metadata(UserKey.objects.all(), 1))
+    self.assertEqual(0, rebuild_key_metadata(UserKey.objects.all()))
+    self.assertEqual(
+      [('ssh-rsa', bits1, 'rsa@example.com'),
+       ('ssh-ed25519', bits2, 'ed25519@example.com')],
+      list(UserKey.objects.order_by('id').values_list(
+        'algorithm', 'bits', 'comment')))
+
+
 class ManagementTestCase(BaseTestCase):
 
   @classmethod
@@ -708,3 +2774,162 @@ class ManagementTestCase(BaseTestCase):
     self.assertEqual(self.key1.fingerprint, key1.fingerprint)
     self.assertEqual(self.wrong_fingerprint, key2.fingerprint)
     self.assertEqual(self.wrong_fingerprint, key3.fingerprint)
+
+  def test_normalize_sshkey_duplicate(self):
+    '''Normalizing fails if two keys become the same'''
+    self.setup_fixture()
+    UserKey.objects.filter(name='key3').update(key=self.key1.key)
+    with self.assertRaises(ValidationError):
+      call_command('normalize_sshkeys', stdout=DEVNULL)
+    key1 = UserKey.objects.get(name='key1')
+    self.assertEqual(self.wrong_fingerprint, key1.fingerprint)
+
+
+def random_pubkey(comment):
+  '''Make a well formed Ed25519 public key without running ssh-keygen'''
+  keydata = b''
+  for part in (b'ssh-ed25519', os.urandom(32)):
+    keydata += struct.pack('>I', len(part)) + part
+  return 'ssh-ed25519 %s %s' % (base64.b64encode(keydata).decode('ascii'),
+                                comment)
+
+
+class QueryBudgetTestCase(BaseTestCase):
+  '''
+  The number of queries made by each view and command must not depend on
+  the number of keys; each test checks this at several sizes.
+  '''
+  sizes = (2, 10, 50)
+
+  @classmethod
+  def setUpClass(cls):
+    super(QueryBudgetTestCase, cls).setUpClass()
+    cls.original_options = settings.SSHKEY_AUTHORIZED_KEYS_OPTIONS
+    settings.SSHKEY_AUTHORIZED_KEYS_OPTIONS = 'command="{username} {key_id}"'
+    User.objects.create_superuser('admin', 'admin@example.com', 'password')
+    cls.users = [User.objects.create(username='user%d' % i) for i in range(3)]
+
+  @classmethod
+  def tearDownClass(cls):
+    settings.SSHKEY_AUTHORIZED_KEYS_OPTIONS = cls.original_options
+    User.objects.all().delete()
+    super(QueryBudgetTestCase, cls).tearDownClass()
+
+  def grow(self, size):
+    '''Add keys, shared round robin by the users, until there are size'''
+    keys = []
+    for i in range(UserKey.objects.count(), size):
+      pubkey = pubkey_parse(random_pubkey('key%d' % i))
+      key = UserKey(
+        user=self.users[i % len(self.users)],
+        name=pubkey.comment,
+        key=pubkey.format_openssh(),
+        fingerprint=pubkey.fingerprint(),
+      )
+      set_key_metadata(key, pubkey)
+      keys.append(key)
+    UserKey.objects.bulk_create(keys)
+    rebuild_authorized_keys_lines(
+      UserKey.objects.filter(authorized_keys_line=''))
+
+  def assertQueryBudget(self, budget, func, *args, **kwargs):
+    for size in self.sizes:
+      self.grow(size)
+      with self.assertNumQueries(budget):
+        func(*args, **kwargs)
+
+  def get(self, url, query={}):
+    response = self.client.get(url, query)
+    self.assertEqual(response.status_code, 200)
+    if response.streaming:
+      return b''.join(response.streaming_content)
+    return response.content
+
+  def test_lookup_all(self):
+    url = reverse('django_sshkey.views.lookup')
+    self.assertQueryBudget(1, self.get, url)
+
+  def test_lookup_all_ndjson(self):
+    url = reverse('django_sshkey.views.lookup')
+    self.assertQueryBudget(1, self.get, url, {'format': 'ndjson'})
+
+  def test_lookup_by_username(self):
+    url = reverse('django_sshkey.views.lookup')
+    self.assertQueryBudget(1, self.get, url, {'username': 'user0'})
+
+  def test_lookup_by_fingerprint(self):
+    self.grow(1)
+    fingerprint = UserKey.objects.all()[0].fingerprint
+    url = reverse('django_sshkey.views.lookup')
+    self.assertQueryBudget(1, self.get, url, {'fingerprint': fingerprint})
+
+  def test_lookup_by_username_and_fingerprint(self):
+    self.grow(1)
+    key = UserKey.objects.select_related('user')[0]
+    url = reverse('django_sshkey.views.lookup')
+    query = {'username': key.user.username, 'fingerprint': key.fingerprint}
+    self.assertQueryBudget(1, self.get, url, query)
+
+  def test_lookup_by_key(self):
+    self.grow(1)
+    key = UserKey.objects.all()[0].key.split()[1]
+    url = reverse('django_sshkey.views.lookup')
+    self.assertQueryBudget(1, self.get, url, {'key': key})
+
+  def test_lookup_tree(self):
+    url = reverse('django_sshkey.views.lookup_tree')
+    self.assertQueryBudget(1, self.get, url)
+    self.assertQueryBudget(1, self.get, url, {'keys': ''})
+
+  def test_touch(self):
+    self.grow(1)
+    key = UserKey.objects.all()[0]
+    url = reverse('django_sshkey.views.lookup')
+    self.assertQueryBudget(
+      2, self.client.post, url, data=str(key.id), content_type='text/plain')
+
+  def test_admin_changelist(self):
+    self.client.login(username='admin', password='password')
+    url = reverse('admin:django_sshkey_userkey_changelist')
+
+    def changelist():
+      cache.get_cache().delete(admin.COUNT_CACHE_KEY)
+      self.get(url)
+    self.assertQueryBudget(4, changelist)
+
+  def test_import_sshkey(self):
+    paths = []
+
+    def import_sshkey():
+      path = os.path.join(self.key_dir, 'import%d.pub' % len(paths))
+      with open(path, 'w') as f:
+        f.write(random_pubkey('import%d' % len(paths)))
+      paths.append(path)
+      call_command('import_sshkey', 'user0', path, stdout=DEVNULL)
+    self.assertQueryBudget(8, import_sshkey)
+
+  def test_normalize_sshkeys_unchanged(self):
+    self.assertQueryBudget(
+      3, call_command, 'normalize_sshkeys', stdout=DEVNULL)
+
+  def test_normalize_sshkeys_changed(self):
+    def normalize_sshkeys():
+      UserKey.objects.update(fingerprint='')
+      call_command('normalize_sshkeys', stdout=DEVNULL)
+    self.assertQueryBudget(6, normalize_sshkeys)
+    self.assertFalse(UserKey.objects.filter(fingerprint=''))
+
+  def test_rebuild_sshkey_lines(self):
+    self.assertQueryBudget(
+      2, call_command, 'rebuild_sshkey_lines', 'user0', stdout=DEVNULL)
+
+  def test_rename_user(self):
+    def rename_user():
+      user = self.users[0]
+      user.username += 'x'
+      user.save()
+    self.assertQueryBudget(4, rename_user)
+
+  def test_reconcile_sshkey_owners(self):
+    self.assertQueryBudget(
+      2, call_command, 'reconcile_sshkey_owners', stdout=DEVNULL)
@@ -34,6 +34,10 @@ except ImportError:
 
 urlpatterns = patterns('django_sshkey.views',
   url(r'^lookup$', 'lookup'),  # noqa
+  url(r'^lookup/tree$', 'lookup_tree'),
+  url(r'^lookup/krl$', 'lookup_krl'),
+  url(r'^lookup/bloom$', 'lookup_bloom'),
+  url(r'^lookup/metrics$', 'lookup_metrics'),
   url(r'^$', 'userkey_list'),
   url(r'^add$', 'userkey_add'),
   url(r'^(?P<pk>\d+)$', 'userkey_edit'),
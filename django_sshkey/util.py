@@ -31,31 +31,41 @@ from . import settings
 
 import base64
 import binascii
+import hashlib
+import math
 import struct
+import zlib
+try:
+  from urllib.parse import urlencode
+  from urllib.request import Request, urlopen
+except ImportError:  # Python 2
+  from urllib import urlencode
+  from urllib2 import Request, urlopen
 
 SSHKEY_LOOKUP_URL_DEFAULT = 'http://localhost:8000/sshkey/lookup'
 
+# Sizes of the keys whose algorithm determines them
+KEY_BITS = {
+  'ecdsa-sha2-nistp256': 256,
+  'ecdsa-sha2-nistp384': 384,
+  'ecdsa-sha2-nistp521': 521,
+  'sk-ecdsa-sha2-nistp256@openssh.com': 256,
+  'ssh-ed25519': 256,
+  'sk-ssh-ed25519@openssh.com': 256,
+}
+
 
 def wrap(text, width, wrap_end=None):
-  n = 0
-  t = ''
   if wrap_end is None:
-    while n < len(text):
-      m = n + width
-      t += text[n:m]
-      if len(text) <= m:
-        return t
-      t += '\n'
-      n = m
-  else:
-    while n < len(text):
-      m = n + width
-      if len(text) <= m:
-        return t + text[n:m]
-      m -= len(wrap_end)
-      t += text[n:m] + wrap_end + '\n'
-      n = m
-  return t
+    wrap_end = ''
+  step = width - len(wrap_end)
+  lines = []
+  n = 0
+  while len(text) - n > width:
+    lines.append(text[n:n + step] + wrap_end)
+    n += step
+  lines.append(text[n:])
+  return '\n'.join(lines)
 
 
 def bytes2int(b):
@@ -78,6 +88,181 @@ class PublicKeyParseError(Exception):
     return "Unrecognized public key format"
 
 
+DER_INTEGER = 0x02
+DER_BIT_STRING = 0x03
+DER_NULL = 0x05
+DER_OBJECT_IDENTIFIER = 0x06
+DER_SEQUENCE = 0x30
+
+# 1.2.840.113549.1.1.1
+RSA_ENCRYPTION_OID = b'\x2a\x86\x48\x86\xf7\x0d\x01\x01\x01'
+
+
+def der_encode(tag, value):
+  '''Encode one DER element'''
+  if len(value) < 0x80:
+    length = struct.pack('B', len(value))
+  else:
+    octets = bytes(int2bytes(len(value)))
+    length = struct.pack('B', 0x80 | len(octets)) + octets
+  return struct.pack('B', tag) + length + value
+
+
+def der_decode(data, tag):
+  '''
+  Decode the DER element at the start of data, which must have the given
+  tag.  Returns its value and the data following it.
+  '''
+  header = bytearray(data[:2])
+  if len(header) < 2 or header[0] != tag:
+    raise ValueError('Expected DER tag 0x%02x' % tag)
+  start = 2
+  length = header[1]
+  if length & 0x80:
+    start += length & 0x7f
+    if start == 2 or len(data) < start:
+      raise ValueError('Invalid DER length')
+    length = bytes2int(data[2:start])
+  end = start + length
+  if len(data) < end:
+    raise ValueError('Truncated DER element')
+  return data[start:end], data[end:]
+
+
+def der_encode_rsa(e, n):
+  '''
+  Encode an RSAPublicKey (PKCS #1) from the exponent and modulus as SSH
+  mpints, which are already in the form of DER INTEGER contents.
+  '''
+  return der_encode(
+    DER_SEQUENCE,
+    der_encode(DER_INTEGER, n or b'\x00') +
+    der_encode(DER_INTEGER, e or b'\x00')
+  )
+
+
+def der_decode_rsa(der):
+  '''Decode an RSAPublicKey (PKCS #1) into its exponent and modulus'''
+  seq, rest = der_decode(der, DER_SEQUENCE)
+  n, seq = der_decode(seq, DER_INTEGER)
+  e, seq = der_decode(seq, DER_INTEGER)
+  if rest or seq:
+    raise ValueError('Trailing data after RSAPublicKey')
+  return der_mpint(e), der_mpint(n)
+
+
+def der_encode_spki(rsa_der):
+  '''Wrap an RSAPublicKey in a SubjectPublicKeyInfo'''
+  algorithm = der_encode(
+    DER_SEQUENCE,
+    der_encode(DER_OBJECT_IDENTIFIER, RSA_ENCRYPTION_OID) +
+    der_encode(DER_NULL, b'')
+  )
+  return der_encode(
+    DER_SEQUENCE,
+    algorithm + der_encode(DER_BIT_STRING, b'\x00' + rsa_der)
+  )
+
+
+def der_decode_spki(der):
+  '''Unwrap the RSAPublicKey in a SubjectPublicKeyInfo'''
+  seq, rest = der_decode(der, DER_SEQUENCE)
+  algorithm, seq = der_decode(seq, DER_SEQUENCE)
+  oid, algorithm = der_decode(algorithm, DER_OBJECT_IDENTIFIER)
+  if oid != RSA_ENCRYPTION_OID:
+    raise ValueError('Not an RSA public key')
+  bits, seq = der_decode(seq, DER_BIT_STRING)
+  if rest or seq or bits[:1] != b'\x00':
+    raise ValueError('Invalid SubjectPublicKeyInfo')
+  return bits[1:]
+
+
+def der_mpint(value):
+  '''Convert the contents of a positive DER INTEGER to an SSH mpint'''
+  b = bytearray(value)
+  if not b or b[0] & 0x80:
+    raise ValueError('Expected a positive INTEGER')
+  i = 0
+  while i < len(b) - 1 and b[i] == 0 and not b[i + 1] & 0x80:
+    i += 1
+  return bytes(b[i:])
+
+
+def blob_digest(keydata):
+  '''Return the unpadded base64 SHA256 digest of a key blob'''
+  digest = hashlib.sha256(keydata).digest()
+  return base64.b64encode(digest).decode('ascii').rstrip('=')
+
+
+class BloomFilter(object):
+  '''
+  A set of strings that may report false positives but no false negatives.
+
+  Each item sets count bits chosen by double hashing its SHA256 digest.
+  The serialized form is the magic SKBF, a version byte, the number of bits
+  as a 32-bit integer, count as a byte, and then the bits themselves.
+  '''
+  MAGIC = b'SKBF'
+  VERSION = 1
+  HEADER = struct.Struct('>BIB')
+
+  def __init__(self, size, count, bits=None):
+    self.size = size
+    self.count = count
+    if bits is None:
+      bits = bytearray((size + 7) // 8)
+    self.bits = bits
+
+  @classmethod
+  def for_capacity(cls, capacity, error=0.01):
+    '''Return an empty filter sized for capacity items at the given error'''
+    capacity = max(capacity, 1)
+    size = int(math.ceil(-capacity * math.log(error) / math.log(2) ** 2))
+    count = int(round(float(size) / capacity * math.log(2)))
+    return cls(max(size, 8), max(count, 1))
+
+  @classmethod
+  def from_bytes(cls, data):
+    if data[:4] != cls.MAGIC:
+      raise ValueError('Not a Bloom filter')
+    version, size, count = cls.HEADER.unpack(data[4:4 + cls.HEADER.size])
+    if version != cls.VERSION:
+      raise ValueError('Unknown Bloom filter version: %d' % version)
+    bits = bytearray(data[4 + cls.HEADER.size:])
+    if len(bits) != (size + 7) // 8:
+      raise ValueError('Truncated Bloom filter')
+    return cls(size, count, bits)
+
+  def to_bytes(self):
+    return (self.MAGIC +
+            self.HEADER.pack(self.VERSION, self.size, self.count) +
+            bytes(self.bits))
+
+  def indexes(self, item):
+    digest = hashlib.sha256(item.encode('utf-8')).digest()
+    h1, h2 = struct.unpack('>QQ', digest[:16])
+    h2 |= 1
+    return ((h1 + i * h2) % self.size for i in range(self.count))
+
+  def add(self, item):
+    for i in self.indexes(item):
+      self.bits[i >> 3] |= 1 << (i & 7)
+
+  def __contains__(self, item):
+    return all(self.bits[i >> 3] & (1 << (i & 7))
+               for i in self.indexes(item))
+
+
+def bloom_item(kind, value):
+  '''
+  Return the string that a Bloom filter of keys holds for a lookup.
+
+  kind is 'fingerprint' for a fingerprint as stored, or 'key' for the
+  blob_digest() of a key blob.
+  '''
+  return kind + ':' + value
+
+
 class PublicKey(object):
   def __init__(self, b64key, comment=None):
     self.b64key = b64key
@@ -94,8 +279,15 @@ class PublicKey(object):
       self.parts.append(data)
     self.algorithm = self.parts[0].decode('ascii')
 
+  def bits(self):
+    '''Return the size of the key in bits, or None if it is not known'''
+    if self.algorithm == 'ssh-rsa' and len(self.parts) == 3:
+      return bytes2int(self.parts[2]).bit_length()  # modulus
+    if self.algorithm == 'ssh-dss' and len(self.parts) == 5:
+      return bytes2int(self.parts[1]).bit_length()  # p
+    return KEY_BITS.get(self.algorithm)
+
   def fingerprint(self, hash=None):
-    import hashlib
     if hash is None:
       hash = settings.SSHKEY_DEFAULT_HASH
     if hash in ('md5', 'legacy'):
@@ -106,9 +298,7 @@ class PublicKey(object):
       else:
         return fp
     elif hash == 'sha256':
-      fp = hashlib.sha256(self.keydata).digest()
-      fp = base64.b64encode(fp).decode('ascii').rstrip('=')
-      return 'SHA256:' + fp
+      return 'SHA256:' + blob_digest(self.keydata)
     else:
       raise ValueError('Unknown hash type: %s' % hash)
 
@@ -119,31 +309,32 @@ class PublicKey(object):
     return out
 
   def format_rfc4716(self):
-    out = '---- BEGIN SSH2 PUBLIC KEY ----\n'
+    lines = ['---- BEGIN SSH2 PUBLIC KEY ----']
     if self.comment:
-      comment = 'Comment: "%s"' % self.comment
-      out += wrap(comment, 72, '\\') + '\n'
-    out += wrap(self.b64key, 72) + '\n'
-    out += '---- END SSH2 PUBLIC KEY ----'
-    return out
+      lines.append(wrap('Comment: "%s"' % self.comment, 72, '\\'))
+    lines.append(wrap(self.b64key, 72))
+    lines.append('---- END SSH2 PUBLIC KEY ----')
+    return '\n'.join(lines)
 
-  def format_pem(self):
-    if self.algorithm != 'ssh-rsa' and len(self.parts) == 3:
+  def rsa_der(self):
+    if self.algorithm != 'ssh-rsa' or len(self.parts) != 3:
       raise TypeError("key is not a valid RSA key")
-    from pyasn1.codec.der import encoder as der_encoder
-    from pyasn1.type import univ
-    e = bytes2int(self.parts[1])
-    n = bytes2int(self.parts[2])
-    pkcs1_seq = univ.Sequence()
-    pkcs1_seq.setComponentByPosition(0, univ.Integer(n))
-    pkcs1_seq.setComponentByPosition(1, univ.Integer(e))
-    der = der_encoder.encode(pkcs1_seq)
-    out = (
-      '-----BEGIN RSA PUBLIC KEY-----\n' +
-      wrap(base64.b64encode(der).decode('ascii'), 64) + '\n' +
-      '-----END RSA PUBLIC KEY-----'
-    )
-    return out
+    return der_encode_rsa(self.parts[1], self.parts[2])
+
+  def format_pem(self):
+    return '\n'.join([
+      '-----BEGIN RSA PUBLIC KEY-----',
+      wrap(base64.b64encode(self.rsa_der()).decode('ascii'), 64),
+      '-----END RSA PUBLIC KEY-----',
+    ])
+
+  def format_pkcs8(self):
+    der = der_encode_spki(self.rsa_der())
+    return '\n'.join([
+      '-----BEGIN PUBLIC KEY-----',
+      wrap(base64.b64encode(der).decode('ascii'), 64),
+      '-----END PUBLIC KEY-----',
+    ])
 
 
 def pubkey_parse_openssh(text):
@@ -169,54 +360,60 @@ def pubkey_parse_rfc4716(text):
     lines[-1] == '---- END SSH2 PUBLIC KEY ----'
   ):
     raise PublicKeyParseError(text)
-  lines = lines[1:-1]
-  b64key = ''
+  b64key = []
   headers = {}
-  while lines:
-    line = lines.pop(0)
+  i, end = 1, len(lines) - 1
+  while i < end:
+    line = lines[i]
+    i += 1
     if ':' in line:
-      while line[-1] == '\\':
-        line = line[:-1] + lines.pop(0)
-      k, v = line.split(':', 1)
+      header = []
+      while line.endswith('\\'):
+        if i == end:
+          raise PublicKeyParseError(text)
+        header.append(line[:-1])
+        line = lines[i]
+        i += 1
+      header.append(line)
+      k, v = ''.join(header).split(':', 1)
       headers[k.lower()] = v.lstrip()
     else:
-      b64key += line
+      b64key.append(line)
   comment = headers.get('comment')
   if comment and comment[0] in ('"', "'") and comment[0] == comment[-1]:
     comment = comment[1:-1]
   try:
-    return PublicKey(b64key, comment)
+    return PublicKey(''.join(b64key), comment)
   except TypeError:
     raise PublicKeyParseError(text)
 
 
+PEM_BOUNDARIES = {
+  '-----BEGIN RSA PUBLIC KEY-----': '-----END RSA PUBLIC KEY-----',
+  '-----BEGIN PUBLIC KEY-----': '-----END PUBLIC KEY-----',
+}
+
+
 def pubkey_parse_pem(text):
-  from pyasn1.codec.der import decoder as der_decoder
   lines = text.splitlines()
-  if not (
-    lines[0] == '-----BEGIN RSA PUBLIC KEY-----' and
-    lines[-1] == '-----END RSA PUBLIC KEY-----'
-  ):
+  if PEM_BOUNDARIES.get(lines[0]) != lines[-1]:
+    raise PublicKeyParseError(text)
+  try:
+    der = base64.b64decode(''.join(lines[1:-1]).encode('ascii'))
+    if lines[0] == '-----BEGIN PUBLIC KEY-----':
+      der = der_decode_spki(der)
+    e, n = der_decode_rsa(der)
+  except (TypeError, ValueError, binascii.Error):
     raise PublicKeyParseError(text)
-  der = base64.b64decode(''.join(lines[1:-1]).encode('ascii'))
-  pkcs1_seq = der_decoder.decode(der)
-  n_val = pkcs1_seq[0][0]
-  e_val = pkcs1_seq[0][1]
-  n = int2bytes(n_val)
-  e = int2bytes(e_val)
-  if n[0] & 0x80:
-      n = b'\x00' + n
-  if e[0] & 0x80:
-      e = b'\x00' + e
   algorithm = 'ssh-rsa'.encode('ascii')
-  keydata = (
-    struct.pack('>I', len(algorithm)) +
-    algorithm +
-    struct.pack('>I', len(e)) +
-    e +
-    struct.pack('>I', len(n)) +
-    n
-  )
+  keydata = b''.join([
+    struct.pack('>I', len(algorithm)),
+    algorithm,
+    struct.pack('>I', len(e)),
+    e,
+    struct.pack('>I', len(n)),
+    n,
+  ])
   b64key = base64.b64encode(keydata).decode('ascii')
   return PublicKey(b64key)
 
@@ -230,30 +427,259 @@ def pubkey_parse(text):
   if lines[0] == '---- BEGIN SSH2 PUBLIC KEY ----':
     return pubkey_parse_rfc4716(text)
 
-  if lines[0] == '-----BEGIN RSA PUBLIC KEY-----':
+  if lines[0] in PEM_BOUNDARIES:
     return pubkey_parse_pem(text)
 
   raise PublicKeyParseError(text)
 
 
+def authorized_keys_pubkey(line):
+  '''Find and parse the public key in an authorized_keys line'''
+  fields = line.split()
+  for i in range(len(fields) - 1):
+    try:
+      key = PublicKey(fields[i + 1])
+    except (TypeError, ValueError, IndexError, struct.error):
+      continue
+    if key.algorithm == fields[i]:
+      return key
+  raise PublicKeyParseError(line)
+
+
+def fingerprint_digest(fingerprint):
+  '''Strip the hash name and colons from a fingerprint'''
+  if fingerprint.startswith(('MD5:', 'SHA256:')):
+    fingerprint = fingerprint.split(':', 1)[1]
+  return fingerprint.replace(':', '')
+
+
+# The length of fingerprint_digest() for each hash
+DIGEST_LENGTHS = {'legacy': 32, 'md5': 32, 'sha256': 43}
+
+
+def fingerprint_prefix(digest, hash=None):
+  '''Format the leading part of a fingerprint digest like a fingerprint'''
+  if hash is None:
+    hash = settings.SSHKEY_DEFAULT_HASH
+  if hash == 'sha256':
+    return 'SHA256:' + digest
+  elif hash in ('md5', 'legacy'):
+    fp = ':'.join(digest[i:i + 2] for i in range(0, len(digest), 2))
+    if hash == 'md5':
+      return 'MD5:' + fp
+    else:
+      return fp
+  else:
+    raise ValueError('Unknown hash type: %s' % hash)
+
+
+def keytree_leaf(line):
+  if not isinstance(line, bytes):
+    line = line.encode('utf-8')
+  return hashlib.sha1(line).hexdigest()
+
+
+def keytree_children(entries, prefix=''):
+  '''
+  Summarize the children of a node of the key hash tree.
+
+  The tree buckets keys by successive characters of their fingerprint digest.
+  entries is an iterable of (digest, leaf) pairs, where leaf is the
+  keytree_leaf() of the key's authorized_keys line.  Returns a dict that maps
+  each child of prefix to a (count, hash) pair.
+  '''
+  n = len(prefix)
+  leaves = {}
+  for digest, leaf in entries:
+    if len(digest) > n and digest.startswith(prefix):
+      leaves.setdefault(digest[:n + 1], []).append(leaf)
+  children = {}
+  for child, hashes in leaves.items():
+    hashes.sort()
+    h = hashlib.sha1(''.join(hashes).encode('ascii')).hexdigest()
+    children[child] = (len(hashes), h)
+  return children
+
+
+def accepted_encoding(accept_encoding):
+  '''Choose gzip or deflate from an Accept-Encoding header, if allowed'''
+  accepted = {}
+  for item in accept_encoding.split(','):
+    params = item.split(';')
+    q = 1.0
+    for param in params[1:]:
+      name, _, value = param.partition('=')
+      if name.strip() == 'q':
+        try:
+          q = float(value)
+        except ValueError:
+          q = 0.0
+    accepted[params[0].strip().lower()] = q
+  for encoding in ('gzip', 'deflate'):
+    if accepted.get(encoding, accepted.get('*', 0.0)) > 0.0:
+      return encoding
+  return None
+
+
+def compress(chunks, encoding):
+  '''Incrementally compress an iterable of strings'''
+  if encoding == 'gzip':
+    z = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+  elif encoding == 'deflate':
+    z = zlib.compressobj(6)
+  else:
+    raise ValueError('Unknown content coding: %s' % encoding)
+  for chunk in chunks:
+    if not isinstance(chunk, bytes):
+      chunk = chunk.encode('utf-8')
+    data = z.compress(chunk)
+    if data:
+      yield data
+  yield z.flush()
+
+
+def decompress(data, encoding):
+  if encoding == 'gzip':
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+  elif encoding == 'deflate':
+    try:
+      return zlib.decompress(data)
+    except zlib.error:  # some servers send raw deflate data
+      return zlib.decompress(data, -zlib.MAX_WBITS)
+  elif encoding in (None, 'identity'):
+    return data
+  else:
+    raise ValueError('Unknown content coding: %s' % encoding)
+
+
+def lookup_timeout():
+  '''Return the timeout in SSHKEY_LOOKUP_TIMEOUT, in seconds, or None'''
+  import os
+  try:
+    return float(os.getenv('SSHKEY_LOOKUP_TIMEOUT', '')) or None
+  except ValueError:
+    return None
+
+
+def lookup_request(url, query=None):
+  '''
+  Fetch url, asking for a compressed response.
+
+  Gives up after SSHKEY_LOOKUP_TIMEOUT seconds if that is set in the
+  environment, and tells the server so that it gives up too.  Returns the
+  lines of the decoded response body and the response headers.
+  '''
+  if query:
+    url += '?' + urlencode(query)
+  headers = {'Accept-Encoding': 'gzip, deflate'}
+  timeout = lookup_timeout()
+  if timeout is None:
+    response = urlopen(Request(url, headers=headers))
+  else:
+    headers['X-SSHKey-Timeout'] = '%g' % timeout
+    response = urlopen(Request(url, headers=headers), timeout=timeout)
+  headers = response.info()
+  body = decompress(response.read(), headers.get('Content-Encoding'))
+  if not isinstance(body, str):
+    body = body.decode('utf-8')
+  return body.splitlines(True), headers
+
+
 def lookup_all(url):
-  import urllib
-  response = urllib.urlopen(url)
-  return response.readlines()
+  return lookup_request(url)[0]
 
 
 def lookup_by_username(url, username):
-  import urllib
-  url += '?' + urllib.urlencode({'username': username})
-  response = urllib.urlopen(url)
-  return response.readlines()
+  return lookup_request(url, {'username': username})[0]
 
 
 def lookup_by_fingerprint(url, fingerprint):
-  import urllib
-  url += '?' + urllib.urlencode({'fingerprint': fingerprint})
-  response = urllib.urlopen(url)
-  return response.readlines()
+  return lookup_request(url, {'fingerprint': fingerprint})[0]
+
+
+def lookup_by_key(url, key_type, key):
+  return lookup_request(url, [('key_type', key_type), ('key', key)])[0]
+
+
+def lookup_by_username_and_fingerprint(url, username, fingerprint):
+  query = [('username', username), ('fingerprint', fingerprint)]
+  return lookup_request(url, query)[0]
+
+
+def lookup_bloom(url):
+  '''Fetch the server's Bloom filter of keys'''
+  response = urlopen(Request(url + '/bloom'))
+  return BloomFilter.from_bytes(response.read())
+
+
+def read_bloom(path):
+  '''
+  Return the Bloom filter saved at path, or None if there is no usable one.
+  '''
+  try:
+    with open(path, 'rb') as f:
+      return BloomFilter.from_bytes(f.read())
+  except (IOError, OSError, ValueError, struct.error):
+    return None
+
+
+def lookup_sync(url, lines, threshold=32):
+  '''
+  Bring a local copy of the output of lookup_all() up to date.
+
+  The local and remote key hash trees are compared starting at the root, and
+  only the subtrees whose hashes differ are visited.  Buckets holding at most
+  threshold keys on the server, or named by a whole digest, are downloaded
+  instead of being descended into.  Returns the updated list of lines.
+  '''
+  tree_url = url + '/tree'
+
+  def fetch(prefix, keys=False):
+    query = {'prefix': prefix}
+    if keys:
+      query['keys'] = '1'
+    return lookup_request(tree_url, query)
+
+  def read_children(response):
+    children = {}
+    for line in response[0]:
+      child, count, h = line.split()
+      children[child] = (int(count), h)
+    return children
+
+  response = fetch('')
+  hash = response[1].get('X-SSHKey-Hash')
+  # Keys sharing a whole digest (the same key with different comments or
+  # options) have no children to descend into.
+  full = DIGEST_LENGTHS[hash or settings.SSHKEY_DEFAULT_HASH]
+  entries = []
+  for line in lines:
+    line = line.rstrip('\n')
+    try:
+      pubkey = authorized_keys_pubkey(line)
+    except PublicKeyParseError:
+      continue
+    digest = fingerprint_digest(pubkey.fingerprint(hash))
+    entries.append((digest, keytree_leaf(line), line))
+
+  result = []
+  stack = [('', read_children(response), entries)]
+  while stack:
+    prefix, remote, entries = stack.pop()
+    local = keytree_children([e[:2] for e in entries], prefix)
+    subtrees = {}
+    for e in entries:
+      subtrees.setdefault(e[0][:len(prefix) + 1], []).append(e)
+    for child, (count, h) in remote.items():
+      subtree = subtrees.get(child, [])
+      if local.get(child) == (count, h):
+        result.extend(e[2] for e in subtree)
+      elif count <= threshold or len(child) >= full:
+        response = fetch(child, keys=True)
+        result.extend(line.rstrip('\n') for line in response[0])
+      else:
+        stack.append((child, read_children(fetch(child)), subtree))
+  return [r + '\n' for r in result]
 
 
 def lookup_all_main():
@@ -276,9 +702,49 @@ def lookup_by_username_main():
     sys.stdout.write(key)
 
 
+def lookup_sync_main():
+  import os
+  import sys
+  if len(sys.argv) < 2:
+    sys.stderr.write('Usage: %s FILE\n' % sys.argv[0])
+    sys.exit(1)
+  path = sys.argv[1]
+  url = os.getenv('SSHKEY_LOOKUP_URL', SSHKEY_LOOKUP_URL_DEFAULT)
+  try:
+    with open(path) as f:
+      lines = f.readlines()
+  except IOError:
+    lines = []
+  lines = lookup_sync(url, lines)
+  tmp_path = path + '.tmp'
+  with open(tmp_path, 'w') as f:
+    f.writelines(lines)
+  os.rename(tmp_path, path)
+
+
+def lookup_bloom_main():
+  import os
+  import sys
+  if len(sys.argv) < 2:
+    sys.stderr.write('Usage: %s FILE\n' % sys.argv[0])
+    sys.exit(1)
+  path = sys.argv[1]
+  url = os.getenv('SSHKEY_LOOKUP_URL', SSHKEY_LOOKUP_URL_DEFAULT)
+  data = lookup_bloom(url).to_bytes()
+  tmp_path = path + '.tmp'
+  with open(tmp_path, 'wb') as f:
+    f.write(data)
+  os.rename(tmp_path, path)
+
+
 def lookup_by_fingerprint_main():
   import sys
   from os import getenv
+  url = getenv('SSHKEY_LOOKUP_URL', SSHKEY_LOOKUP_URL_DEFAULT)
+  # A filter saved by django-sshkey-pylookup-bloom answers definite misses
+  # without asking the server.
+  bloom_file = getenv('SSHKEY_LOOKUP_BLOOM_FILE')
+  bloom = bloom_file and read_bloom(bloom_file)
   fingerprint = getenv('SSH_KEY_FINGERPRINT')
   if fingerprint is None:
     key = getenv('SSH_KEY')
@@ -289,14 +755,25 @@ def lookup_by_fingerprint_main():
           "Error: cannot retrieve fingerprint from environment or stdin\n"
         )
         sys.exit(1)
-      try:
-        pubkey = pubkey_parse(key)
-      except PublicKeyParseError as e:
-        sys.stderr.write("Error: " + str(e))
-        sys.exit(1)
+    try:
+      pubkey = pubkey_parse(key)
+    except PublicKeyParseError as e:
+      sys.stderr.write("Error: " + str(e))
+      sys.exit(1)
+    if getenv('SSHKEY_LOOKUP_BY_KEY'):
+      # Servers before 2.5 ignore key and answer with every key, so the key
+      # is only sent when asked for.
+      digest = blob_digest(pubkey.keydata)
+      if bloom and bloom_item('key', digest) not in bloom:
+        return
+      response = lookup_by_key(url, pubkey.algorithm, pubkey.b64key)
+    else:
       fingerprint = pubkey.fingerprint()
-  url = getenv('SSHKEY_LOOKUP_URL', SSHKEY_LOOKUP_URL_DEFAULT)
-  for key in lookup_by_fingerprint(url, fingerprint):
+  if fingerprint is not None:
+    if bloom and bloom_item('fingerprint', fingerprint) not in bloom:
+      return
+    response = lookup_by_fingerprint(url, fingerprint)
+  for key in response:
     sys.stdout.write(key)
 
 
@@ -308,10 +785,12 @@ def lookup_main():
     "Usage: {prog} -a URL\n"
     "       {prog} -u URL USERNAME\n"
     "       {prog} -f URL FINGERPRINT\n"
+    "       {prog} -uf URL USERNAME FINGERPRINT\n"
+    "       {prog} -k URL KEY_TYPE KEY\n"
     "       {prog} URL [USERNAME]\n"
   ).format(prog=sys.argv[0])
   try:
-    opts, args = getopt.getopt(sys.argv[1:], 'hafu')
+    opts, args = getopt.getopt(sys.argv[1:], 'hafuk')
   except getopt.GetoptError as e:
     sys.stderr.write("Error: %s\n" % str(e))
     sys.stderr.write(usage)
@@ -321,6 +800,8 @@ def lookup_main():
     if o == '-h':
       sys.stdout.write(usage)
       sys.exit(0)
+    elif mode + o[1] in ('uf', 'fu'):
+      mode = 'uf'
     else:
       mode = o[1]
   if len(args) == 0:
@@ -340,6 +821,16 @@ def lookup_main():
       sys.stderr.write(usage)
       sys.exit(1)
     response = lookup_by_username(url, args[1])
+  elif mode == 'uf':
+    if len(args) < 3:
+      sys.stderr.write(usage)
+      sys.exit(1)
+    response = lookup_by_username_and_fingerprint(url, args[1], args[2])
+  elif mode == 'k':
+    if len(args) < 3:
+      sys.stderr.write(usage)
+      sys.exit(1)
+    response = lookup_by_key(url, args[1], args[2])
   else:
     if len(args) == 1:
       environ['SSHKEY_LOOKUP_URL'] = url
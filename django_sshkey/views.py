@@ -27,55 +27,260 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
-from django.http import HttpResponse, HttpResponseRedirect
+import hashlib
+from django.http import (
+  Http404,
+  HttpResponse,
+  HttpResponseNotModified,
+  HttpResponseRedirect,
+  StreamingHttpResponse,
+)
 from django.views.decorators.http import require_http_methods, require_GET
 from django.views.decorators.csrf import csrf_exempt
-from django.shortcuts import get_object_or_404, render_to_response
+from django.shortcuts import render_to_response
 from django.template import RequestContext
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.core.exceptions import PermissionDenied
-from django.core.urlresolvers import reverse
+from django.db import DEFAULT_DB_ALIAS
+try:
+  from django.urls import reverse
+except ImportError:  # Django < 1.10
+  from django.core.urlresolvers import reverse
+from django.utils.cache import patch_vary_headers
 from django.utils.http import is_safe_url
-from django_sshkey import settings
+from django_sshkey import (
+  admission,
+  audit,
+  bloom,
+  cache as lookup_cache,
+  coalesce,
+  deadline,
+  krl,
+  metrics,
+  profiling,
+  replicas,
+  settings,
+  sharding,
+)
 from django_sshkey.models import UserKey
 from django_sshkey.forms import UserKeyForm
+from django_sshkey.lookups import parse_lookup, rendered, servable
+from django_sshkey.util import (
+  accepted_encoding,
+  compress,
+  fingerprint_digest,
+  fingerprint_prefix,
+  keytree_children,
+  keytree_leaf,
+)
 
 
 @require_http_methods(['GET', 'POST'])
 @csrf_exempt
+@metrics.instrument
+@audit.trail
+@profiling.sample
 def lookup(request):
+  mode = metrics.lookup_mode(request)
+  expires = deadline.from_request(request)
   if request.method == 'POST':
-    payload = request.read()
-    key = UserKey.objects.get(id=int(payload))
-    key.touch()
+    request.sshkey_key_id = key_id = int(request.read())
+    try:
+      slot = admission.admit(mode)
+    except admission.Overloaded:
+      return admission.shed(mode)
+    try:
+      with slot, deadline.limit(DEFAULT_DB_ALIAS, expires):
+        key = sharding.get(id=key_id)
+        key.touch()
+    except deadline.DeadlineExceeded:
+      return deadline.exceeded(mode)
     return HttpResponse(str(key.last_used), content_type='text/plain')
+  parsed = parse_lookup(request)
+  if isinstance(parsed, HttpResponse):
+    return parsed
+  keys, query, content_type, render = parsed
+  request.sshkey_query = query
+  if bloom.enabled() and bloom.probe_item(query) is not None:
+    if bloom.definite_miss(query):
+      metrics.inc('sshkey_lookup_bloom_total', (('result', 'miss'),))
+      return HttpResponse('', content_type=content_type)
+    metrics.inc('sshkey_lookup_bloom_total', (('result', 'maybe'),))
+  served = audit.Served()
+  lines = rendered(lookup_rows(keys, query, expires), render, served)
+
+  def render_body():
+    # Only the request that renders a coalesced lookup queries the database,
+    # so only it needs to be admitted.
+    with admission.admit(mode):
+      body = ''.join(lines).encode('utf-8')
+    return {None: body, 'served': served.to_entry()}
+  encoding = accepted_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''))
   try:
-    fingerprint = request.GET['fingerprint']
-    keys = UserKey.objects.filter(fingerprint=fingerprint)
-  except KeyError:
-    try:
-      username = request.GET['username']
-      keys = UserKey.objects.filter(user__username=username)
-    except KeyError:
-      keys = UserKey.objects.iterator()
-  response = ''
-  for key in keys:
-    if settings.SSHKEY_AUTHORIZED_KEYS_OPTIONS:
-      options = settings.SSHKEY_AUTHORIZED_KEYS_OPTIONS.format(
-        username=key.user.username,
-        key_id=key.id,
-      ) + ' '
+    # With a deadline the body is rendered before it is sent, so that the
+    # whole query runs under the deadline.
+    response = lookup_response(mode, query, encoding, content_type, lines,
+                               served, render_body, expires)
+  except admission.Overloaded:
+    response = admission.shed(mode, query, encoding, content_type)
+  except deadline.DeadlineExceeded:
+    response = deadline.exceeded(mode)
+  patch_vary_headers(response, ('Accept-Encoding',))
+  return response
+
+
+def lookup_rows(keys, query, expires=None):
+  '''
+  Yield the rows of keys for a lookup.  The database is only chosen once
+  they are iterated, so that lookups served from the lookup cache never
+  check replica pins or connections.
+  '''
+  if sharding.enabled():
+    # Each shard is queried under the deadline by sharding.gather()
+    for row in sharding.gather(keys, expires):
+      yield row
+    return
+  database = replicas.lookup_database(query)
+  with deadline.limit(database, expires):
+    for row in keys.using(database).iterator():
+      yield row
+
+
+def lookup_response(mode, query, encoding, content_type, lines, served,
+                    render_body, expires=None):
+  '''
+  Return the response to a lookup, with the keys it serves as its
+  sshkey_served for the audit log.
+
+  render_body() returns a cache entry for the lookup; when the response is
+  streamed instead, served is added to as lines are sent.
+  '''
+  if lookup_cache.enabled():
+    # The compressed body is kept next to the identity body so that it is
+    # compressed once per cache entry rather than once per response.
+    entry = lookup_cache.get(query)
+    if entry is None or encoding not in entry:
+      metrics.inc('sshkey_lookup_cache_total', (('result', 'miss'),))
+      if entry is None:
+        # Coalesced lookups share the entry, so each adds to its own copy
+        entry = dict(coalesce.do(query, render_body, expires))
+      if encoding:
+        entry[encoding] = b''.join(compress([entry[None]], encoding))
+      lookup_cache.store(query, entry)
     else:
-      options = ''
-    response += options + key.key + '\n'
-  return HttpResponse(response, content_type='text/plain')
+      metrics.inc('sshkey_lookup_cache_total', (('result', 'hit'),))
+    response = HttpResponse(entry[encoding], content_type=content_type)
+    response.sshkey_served = audit.Served.from_entry(entry)
+  elif encoding and expires is None and not settings.SSHKEY_LOOKUP_COALESCE:
+    slot = admission.admit(mode)
+    response = StreamingHttpResponse(
+      admission.HeldStream(compress(lines, encoding), slot),
+      content_type=content_type)
+    response.sshkey_served = served
+  else:
+    entry = coalesce.do(query, render_body, expires)
+    lookup_cache.store_stale(query, entry)
+    body = entry[None]
+    if encoding:
+      body = b''.join(compress([body], encoding))
+    response = HttpResponse(body, content_type=content_type)
+    response.sshkey_served = audit.Served.from_entry(entry)
+  if encoding:
+    response['Content-Encoding'] = encoding
+  return response
+
+
+@require_GET
+def lookup_tree(request):
+  prefix = request.GET.get('prefix', '')
+  with_keys = 'keys' in request.GET
+  # Every sync starts from the root, which covers all keys, so the tree is
+  # served from the lookup cache when possible.
+  query = ('tree', prefix, with_keys, settings.SSHKEY_DEFAULT_HASH)
+  entry = lookup_cache.get(query) if lookup_cache.enabled() else None
+  if entry is None:
+    entry = {None: keytree_body(prefix, with_keys)}
+    if lookup_cache.enabled():
+      lookup_cache.store(query, entry)
+  response = HttpResponse(entry[None], content_type='text/plain')
+  response['X-SSHKey-Hash'] = settings.SSHKEY_DEFAULT_HASH
+  return response
+
+
+def keytree_body(prefix, with_keys):
+  keys = servable(UserKey.objects.exclude(fingerprint=''))
+  if prefix:
+    keys = keys.filter(fingerprint__startswith=fingerprint_prefix(prefix))
+  keys = keys.values_list('fingerprint', 'authorized_keys_line')
+  if sharding.enabled():
+    keys = sharding.gather(keys)
+  else:
+    keys = keys.using(replicas.lookup_database()).iterator()
+  # startswith may be case-insensitive (e.g. SQLite), so check again here
+  entries = (
+    (fingerprint_digest(fingerprint), line)
+    for fingerprint, line in keys
+  )
+  entries = ((digest, line) for digest, line in entries
+             if digest.startswith(prefix))
+  if with_keys:
+    body = ''.join(line + '\n' for digest, line in entries)
+  else:
+    children = keytree_children(
+      ((digest, keytree_leaf(line)) for digest, line in entries),
+      prefix,
+    )
+    body = ''.join('%s %d %s\n' % ((child,) + children[child])
+                   for child in sorted(children))
+  return body.encode('utf-8')
+
+
+@require_GET
+def lookup_krl(request):
+  body = krl.revoked_krl()
+  etag = '"%s"' % hashlib.md5(body).hexdigest()
+  if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+    response = HttpResponseNotModified()
+  else:
+    response = HttpResponse(body, content_type='application/octet-stream')
+  response['ETag'] = etag
+  return response
+
+
+@require_GET
+def lookup_bloom(request):
+  if not bloom.enabled():
+    raise Http404
+  body = (bloom.current() or bloom.build()).to_bytes()
+  etag = '"%s"' % hashlib.md5(body).hexdigest()
+  if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+    response = HttpResponseNotModified()
+  else:
+    response = HttpResponse(body, content_type='application/octet-stream')
+  response['ETag'] = etag
+  return response
+
+
+@require_GET
+def lookup_metrics(request):
+  if not metrics.enabled():
+    raise Http404
+  return HttpResponse(metrics.render(),
+                      content_type='text/plain; version=0.0.4')
+
+
+def get_userkey_or_404(pk):
+  try:
+    return sharding.get(pk=pk)
+  except UserKey.DoesNotExist:
+    raise Http404
 
 
 @login_required
 @require_GET
 def userkey_list(request):
-  userkey_list = UserKey.objects.filter(user=request.user)
+  userkey_list = sharding.user_keys(request.user)
   return render_to_response(
     'sshkey/userkey_list.html',
     {'userkey_list': userkey_list, 'allow_edit': settings.SSHKEY_ALLOW_EDIT},
@@ -113,9 +318,12 @@ def userkey_add(request):
 def userkey_edit(request, pk):
   if not settings.SSHKEY_ALLOW_EDIT:
     raise PermissionDenied
-  userkey = get_object_or_404(UserKey, pk=pk)
+  userkey = get_userkey_or_404(pk)
   if userkey.user != request.user:
     raise PermissionDenied
+  # Changing or deleting a revoked key would take it out of the KRL
+  if userkey.revoked is not None:
+    raise PermissionDenied
   if request.method == 'POST':
     form = UserKeyForm(request.POST, instance=userkey)
     if form.is_valid():
@@ -139,9 +347,12 @@ def userkey_edit(request, pk):
 @login_required
 @require_GET
 def userkey_delete(request, pk):
-  userkey = get_object_or_404(UserKey, pk=pk)
+  userkey = get_userkey_or_404(pk)
   if userkey.user != request.user:
     raise PermissionDenied
+  # Changing or deleting a revoked key would take it out of the KRL
+  if userkey.revoked is not None:
+    raise PermissionDenied
   userkey.delete()
   message = 'SSH public key %s was deleted.' % userkey.name
   messages.success(request, message, fail_silently=True)
@@ -76,9 +76,8 @@ setup(
         'django_sshkey.util:lookup_by_username_main',
       'django-sshkey-pylookup-by-fingerprint = '
         'django_sshkey.util:lookup_by_fingerprint_main',
+      'django-sshkey-pylookup-sync = django_sshkey.util:lookup_sync_main',
+      'django-sshkey-pylookup-bloom = django_sshkey.util:lookup_bloom_main',
     ],
   },
-  install_requires=[
-    'pyasn1',
-  ],
 )
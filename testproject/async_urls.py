@@ -0,0 +1,5 @@
+from django.urls import include, re_path
+
+urlpatterns = [
+  re_path(r'^', include('django_sshkey.async_urls')),
+]